@@ -4,6 +4,9 @@ from collections import namedtuple
 from datetime import datetime
 import gevent
 from gevent.lock import RLock
+from robotActionController.Data.configWatcher import ConfigWatcher
+from robotActionController.Data.storage import StorageFactory
+from robotActionController.Data.Model import Action
 
 
 class ActionRunner(gevent.greenlet.Greenlet):
@@ -116,14 +119,16 @@ class ActionRunner(gevent.greenlet.Greenlet):
 class ActionManager(object):
 
     # Increase memory usage but hopefully reduce CPU usage...
-    # TODO: When to expire cached items?
+    # cached items are rebuilt by ConfigWatcher when the action tables change
     _runnerClasses = None
+    configTables = ['Action', 'PoseAction', 'SequenceAction', 'GroupAction', 'SoundAction', 'JointPosition', 'SequenceOrder']
     __managers = {}
 
     def __init__(self, robot):
         self._logger = logging.getLogger(self.__class__.__name__)
         self._robot = robot
         self.__actionCache = {}
+        self.__nameIndex = {}
         self.__cacheLock = RLock()
         ActionManager._getRunners()
 
@@ -137,6 +142,19 @@ class ActionManager(object):
             ActionManager.__managers[robot.id] = ActionManager(robot)
         return ActionManager.__managers[robot.id]
 
+    @staticmethod
+    def clearAllCaches(changedTables=None):
+        for manager in ActionManager.__managers.values():
+            manager.clearCache()
+
+    @staticmethod
+    def refreshAllCaches(changedTables=None):
+        for manager in ActionManager.__managers.values():
+            try:
+                manager.refreshCache()
+            except Exception:
+                manager._logger.critical("Unable to refresh the action cache of robot %s" % manager.robot.id, exc_info=True)
+
     @staticmethod
     def _getRunners():
         if ActionManager._runnerClasses == None:
@@ -185,18 +203,65 @@ class ActionManager(object):
         for action in actions:
             self.getRunable(action)
 
+    def cacheRunables(self, runables):
+        """
+        Add prebuilt runables to the cache, e.g. from Robot.snapshot.Snapshot.getRunables()
+        @param runables: dictionary {actionId: runable}
+        """
+        with self.__cacheLock:
+            self.__actionCache.update(runables)
+            for runable in runables.itervalues():
+                self.__nameIndex[runable.name] = runable
+
     def clearCache(self):
         with self.__cacheLock:
             self.__actionCache.clear()
+            self.__nameIndex.clear()
+
+    def refreshCache(self):
+        """
+        Rebuild the cached runables from the database, the new cache is swapped in once it is complete
+        Only whole tables are versioned, and group and sequence runables embed the actions they run,
+        so every cached action is rebuilt.  Actions that no longer exist are dropped
+        """
+        with self.__cacheLock:
+            actionIds = self.__actionCache.keys()
+        if not actionIds:
+            return
+
+        cache = {}
+        with StorageFactory.sessionScope(commit=False) as session:
+            for action in session.query(Action).filter(Action.id.in_(actionIds)):
+                runable = ActionRunner.getRunable(action)
+                if runable:
+                    cache[action.id] = runable
+
+        with self.__cacheLock:
+            self.__actionCache = cache
+            self.__nameIndex = dict((runable.name, runable) for runable in cache.itervalues())
+        self._logger.debug("Rebuilt %s cached actions" % len(cache))
 
     def getCachedActionByName(self, actionName):
+        """the runable of the named action, loaded and cached if it is not cached yet"""
         with self.__cacheLock:
-            actions = filter(lambda x: x.name==actionName, self.__actionCache.itervalues())
-        return actions[0] if actions else None
+            runable = self.__nameIndex.get(actionName, None)
+        if runable == None:
+            with StorageFactory.sessionScope(commit=False) as session:
+                action = session.query(Action).filter(Action.name == actionName).first()
+                if action != None:
+                    runable = self.getRunable(action)
+        return runable
 
     def getCachedActionById(self, actionId):
+        """the runable of the action, loaded and cached if it is not cached yet"""
         with self.__cacheLock:
-            return self.__actionCache.get(actionId, None)
+            runable = self.__actionCache.get(actionId, None)
+        if runable == None:
+            with StorageFactory.sessionScope(commit=False) as session:
+                action = session.query(Action).get(actionId)
+                if action != None:
+                    runable = self.getRunable(action)
+        return runable
 
     def executeAction(self, action):
         if type(action) == str:
@@ -242,6 +307,7 @@ class ActionManager(object):
                 runable = ActionRunner.getRunable(action)
                 if runable:
                     self.__actionCache[action.id] = runable
+                    self.__nameIndex[runable.name] = runable
                 else:
                     return None
             else:
@@ -257,3 +323,5 @@ class ActionManager(object):
             self._logger.critical("Could not determine action runner for type %s" % action.type, exc_info=True)
             raise ValueError("Could not determine action runner for type %s" % action.type)
 
+
+ConfigWatcher.register(ActionManager.refreshAllCaches, ActionManager.configTables)
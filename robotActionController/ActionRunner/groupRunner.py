@@ -35,9 +35,8 @@ class GroupRunner(ActionRunner):
                 if 'action' not in groupAction:
                     id_ = groupAction.get('action_id', None) or groupAction.get('id', None)
                     if id_:
-                        session = StorageFactory.getNewSession()
-                        action = ActionRunner.getRunable(session.query(Action).get(id_))
-                        session.close()
+                        with StorageFactory.sessionScope(commit=False) as session:
+                            action = ActionRunner.getRunable(session.query(Action).get(id_))
                 else:
                     action = ActionRunner.getRunable(groupAction['action'])
 
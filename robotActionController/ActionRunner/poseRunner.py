@@ -2,6 +2,7 @@ from base import ActionRunner
 from collections import namedtuple
 import logging
 from gevent import sleep
+from robotActionController.Robot.ServoInterface import ServoInterface
 
 
 class PoseRunner(ActionRunner):
@@ -18,7 +19,7 @@ class PoseRunner(ActionRunner):
 
         l = []
         for jointPosition in action.jointPositions:
-            servos = filter(lambda s: s.jointName == jointPosition.jointName, self._robot.servos)
+            servos = self._getServos(jointPosition.jointName)
             if len(servos) != 1:
                 self._logger.critical("Could not determine appropriate servo(%s) on Robot(%s).  Expected 1 match, got %s" % (jointPosition.jointName, self._robot.name, len(servos)))
                 raise ValueError("Could not determine appropriate servo(%s) on Robot(%s).  Expected 1 match, got %s" % (jointPosition.jointName, self._robot.name, len(servos)))
@@ -29,7 +30,7 @@ class PoseRunner(ActionRunner):
             l.append((position, speed, servo))
             sleep(0)
 
-        [servoInterface.setPosition(position, speed, False) for (position, speed, servoInterface) in l]
+        ServoInterface.setPositions([(servoInterface, position, speed) for (position, speed, servoInterface) in l], False)
         moving = [si for _, _, si in l]
 
         # TODO: status messages now that it's non-blocking
@@ -48,6 +49,13 @@ class PoseRunner(ActionRunner):
 
         return result
 
+    def _getServos(self, jointName):
+        # runable robots carry a joint name index, anything else is scanned
+        index = getattr(self._robot, 'servosByJoint', None)
+        if index != None:
+            return index.get(jointName, [])
+        return filter(lambda s: s.jointName == jointName, self._robot.servos)
+
     @staticmethod
     def getRunable(action):
         if type(action) == dict and action.get('type', None) == PoseRunner.supportedClass:
@@ -81,7 +89,7 @@ class PoseRunner(ActionRunner):
     def isValid(self, pose):
         if len(pose.jointPositions) > 0:
             for jointPosition in pose.jointPositions:
-                if len(filter(lambda s: s.jointName == jointPosition.jointName, self._robot.servos)) == 0:
+                if len(self._getServos(jointPosition.jointName)) == 0:
                     return False
             return True
         else:
@@ -52,9 +52,8 @@ class SequenceRunner(ActionRunner):
                 action = None
                 if 'action' not in orderedAction:
                     if 'action_id' in orderedAction:
-                        session = StorageFactory.getNewSession()
-                        action = ActionRunner.getRunable(session.query(Action).get(orderedAction['action_id']))
-                        session.close()
+                        with StorageFactory.sessionScope(commit=False) as session:
+                            action = ActionRunner.getRunable(session.query(Action).get(orderedAction['action_id']))
                 else:
                     action = ActionRunner.getRunable(orderedAction['action'])
 
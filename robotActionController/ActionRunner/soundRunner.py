@@ -6,8 +6,11 @@ import audioop
 import cStringIO
 import wave
 import math
+import Queue
 from gevent import sleep, GreenletExit
+from gevent.hub import get_hub
 from robotActionController.Data.Model import SoundAction
+from robotActionController.Data.soundStore import SoundStore
 
 
 class SoundRunner(ActionRunner):
@@ -16,11 +19,39 @@ class SoundRunner(ActionRunner):
     __audio = None
     _CHUNKSIZE = 1024
 
+    # streaming playback reads and scales the clip in a background thread while it plays
+    streaming = True
+    # frames per buffer, smaller chunks lower the latency at the cost of more callbacks
+    chunkSize = _CHUNKSIZE
+    # number of chunks read ahead of the output
+    prefetch = 4
+
     def __init__(self, sound, *args, **kwargs):
         super(SoundRunner, self).__init__(sound)
         self._cancel = True
         self._logger = logging.getLogger(self.__class__.__name__)
         self._file = None
+        self._stopReading = False
+        self._underruns = 0
+
+    @staticmethod
+    def configure(streaming=None, chunkSize=None, prefetch=None):
+        """
+        @param streaming: play from a prefetching reader instead of loading the whole clip first
+        @param chunkSize: frames per audio buffer
+        @param prefetch: number of buffers to read ahead when streaming
+        """
+        if streaming != None:
+            SoundRunner.streaming = streaming
+        if chunkSize != None:
+            SoundRunner.chunkSize = int(chunkSize)
+        if prefetch != None:
+            SoundRunner.prefetch = max(int(prefetch), 1)
+
+    @staticmethod
+    def _getGain(volume):
+        volume = (volume / 100.0) or 1
+        return (math.exp(volume) - 1) / (math.e - 1)
 
     @property
     def _audio(self):
@@ -41,15 +72,17 @@ class SoundRunner(ActionRunner):
         return ret
 
     def _runInternal(self, action):
+        if SoundRunner.streaming:
+            return self._runStreaming(action)
+
         p = self._audio
         try:
-            volume = (action.volume / 100.0) or 1
-            volMul = (math.exp(volume) - 1) / (math.e - 1)
+            volMul = SoundRunner._getGain(action.volume)
             self._logger.log(1, "Volume: %s, Raw: %s (%s)" % (volMul, action.volume, volMul))
             data = cStringIO.StringIO(action.data)
             self._file = wave.open(data, 'rb')
             frame_width = self._file.getsampwidth()
-            callback = lambda in_data, frame_count, time_info, status: self._callback(SoundRunner._CHUNKSIZE, frame_width, volMul)
+            callback = lambda in_data, frame_count, time_info, status: self._callback(SoundRunner.chunkSize, frame_width, volMul)
             self._cancel = False
             stream = p.open(format=p.get_format_from_width(frame_width),
                             channels=self._file.getnchannels(),
@@ -76,6 +109,102 @@ class SoundRunner(ActionRunner):
 
         return not self._cancel
 
+    def _openClip(self, action):
+        """file object over the clip, mapped lazily from the sound store when possible"""
+        clip = SoundStore.getStore().open(action.uuid) if action.uuid else None
+        if clip == None and action.data:
+            clip = cStringIO.StringIO(action.data)
+        if clip == None:
+            raise ValueError("Sound %s has no data" % action.name)
+        return clip
+
+    def _readChunk(self, chunkSize, frameWidth, gain):
+        data = self._file.readframes(chunkSize)
+        if data and gain != 1.0:
+            data = audioop.mul(data, frameWidth, gain)
+        return data
+
+    def _prefetch(self, buffers, chunkSize, frameWidth, gain):
+        """runs in the threadpool, fills buffers until the clip ends or playback stops, None marks the end"""
+        while not self._stopReading:
+            data = self._readChunk(chunkSize, frameWidth, gain) or None
+            while not self._stopReading:
+                try:
+                    buffers.put(data, timeout=0.1)
+                    break
+                except Queue.Full:
+                    continue
+            if data == None:
+                return
+
+    def _streamCallback(self, buffers, silence):
+        # called from the portaudio thread, must not block or touch the hub
+        if self._cancel:
+            return (None, pyaudio.paAbort)
+        try:
+            data = buffers.get_nowait()
+        except Queue.Empty:
+            self._underruns += 1
+            return (silence, pyaudio.paContinue)
+        if data == None:
+            return ('', pyaudio.paComplete)
+        return (data, pyaudio.paContinue)
+
+    def _runStreaming(self, action):
+        p = self._audio
+        pool = get_hub().threadpool
+        chunkSize = SoundRunner.chunkSize
+        reader = None
+        stream = None
+        try:
+            gain = SoundRunner._getGain(action.volume)
+            self._logger.log(1, "Volume: %s, Raw: %s" % (gain, action.volume))
+            self._file = wave.open(self._openClip(action), 'rb')
+            frameWidth = self._file.getsampwidth()
+            channels = self._file.getnchannels()
+            buffers = Queue.Queue(maxsize=SoundRunner.prefetch)
+            self._stopReading = False
+            self._underruns = 0
+
+            # output starts as soon as the first chunk is ready, the rest is read ahead while playing
+            first = pool.apply(self._readChunk, (chunkSize, frameWidth, gain))
+            if not first:
+                return True
+            buffers.put(first)
+            reader = pool.spawn(self._prefetch, buffers, chunkSize, frameWidth, gain)
+
+            silence = '\0' * (chunkSize * frameWidth * channels)
+            callback = lambda in_data, frame_count, time_info, status: self._streamCallback(buffers, silence)
+            self._cancel = False
+            stream = p.open(format=p.get_format_from_width(frameWidth),
+                            channels=channels,
+                            rate=self._file.getframerate(),
+                            output=True,
+                            frames_per_buffer=chunkSize,
+                            stream_callback=callback)
+            stream.start_stream()
+            while stream.is_active():
+                sleep(0.01)
+        except (Exception, GreenletExit) as e:
+            self._cancel = True
+            if isinstance(e, GreenletExit):
+                raise
+            self._logger.error("Error in portaudio: ", exc_info=True)
+            return False
+        finally:
+            self._stopReading = True
+            if stream != None:
+                stream.stop_stream()
+                stream.close()
+            if reader != None:
+                reader.wait()
+            if self._file != None:
+                self._file.close()
+                self._file = None
+            if self._underruns:
+                self._logger.debug("%s buffer underruns playing %s" % (self._underruns, action.name))
+
+        return not self._cancel
 
     @staticmethod
     def getRunable(action):
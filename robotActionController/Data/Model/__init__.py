@@ -5,3 +5,4 @@ from sensor import *
 from servo import *
 from trigger import *
 from user import *
+from version import *
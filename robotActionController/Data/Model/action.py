@@ -1,9 +1,7 @@
-import os
-import uuid
-from robotActionController.Data.config import database_config
+from robotActionController.Data.soundStore import SoundStore
 from base import StandardMixin, Base
-from sqlalchemy import Column, String, Integer, ForeignKey, Table, Float, event
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, String, Integer, ForeignKey, Table, Float, event, select, func, inspect
+from sqlalchemy.orm import relationship, object_session, Session
 from sqlalchemy.ext.orderinglist import ordering_list
 
 
@@ -18,7 +16,7 @@ nextActions_table = Table('nextActions', Base.metadata,
 
 class Action(StandardMixin, Base):
 
-    name = Column(String(50))
+    name = Column(String(50), index=True)
     type = Column(String(50))
 
     next_actions = relationship("Action", secondary=nextActions_table)
@@ -73,6 +71,7 @@ class SoundAction(Action):
             'inherit_condition': (id == Action.id),
     }
 
+    # md5 key of the clip in the SoundStore (uuid1 names from older databases still resolve)
     uuid = Column(String(36))
 
     @property
@@ -81,55 +80,105 @@ class SoundAction(Action):
 
     @data.setter
     def data(self, value):
+        # the previous clip is released once the change commits, see receive_after_update
         self.uuid = SoundAction.saveData(value, self.uuid)
 
     @property
     def _fileName(self):
-        self.uuid, path = SoundAction.__fileName(self.uuid)
-        return path
+        return SoundStore.getStore().path(self.uuid) if self.uuid else None
 
     @staticmethod
     def saveData(value, uuid=None):
-        uuid, fileName = SoundAction.__fileName(uuid)
-        if value:
-            with open(fileName, 'wb') as f:
-                f.write(value)
-        elif uuid != None:
-            os.remove(fileName)
-            uuid = None
-        return uuid
+        """stores value in the sound store and returns its key, None if there is no data"""
+        if not value:
+            return None
+        return SoundStore.getStore().put(value)
 
     @staticmethod
     def readData(uuid=None):
+        """returns a read only buffer over the memory mapped clip"""
         if not uuid:
             return None
-        fileName = SoundAction.__fileName(uuid)[1]
-        if os.path.isfile(fileName):
-            with open(fileName, 'rb') as f:
-                b = f.read()
-            return b
-        else:
-            return None
-
-    @staticmethod
-    def __fileName(uuid_=None):
-        basePath = os.path.join(database_config['dataFolder'], 'soundFiles')
-        if not os.path.isdir(basePath):
-            os.makedirs(basePath)
-
-        if uuid_ == None:
-            uuid_ = str(uuid.uuid1())
-
-        return (uuid_, os.path.join(basePath, uuid_))
+        return SoundStore.getStore().read(uuid)
 
     def __init__(self, uuid=None, volume=100, **kwargs):
         super(SoundAction, self).__init__(**kwargs)
         self.uuid = uuid
         self.volume = volume
 
+
+def _sessionSounds(target, name):
+    """the set of clip keys the session of target collected under name, None for a detached target"""
+    session = object_session(target)
+    if session == None:
+        return None
+    return session.info.setdefault(name, set())
+
+
+def _claimSound(target, key):
+    """keep the clip while the flushed, uncommitted reference may still commit"""
+    claimed = _sessionSounds(target, 'claimedSounds')
+    if key and claimed != None and key not in claimed:
+        claimed.add(key)
+        SoundStore.getStore().claim(key)
+
+
+def _releaseSound(target, key):
+    """queue the clip for removal, it is only removed after the commit, see receive_after_commit"""
+    released = _sessionSounds(target, 'releasedSounds')
+    if key and released != None:
+        released.add(key)
+
+
+@event.listens_for(SoundAction, 'after_insert')
+def receive_after_insert(mapper, connection, target):
+    _claimSound(target, target.uuid)
+
+
 @event.listens_for(SoundAction, 'after_delete')
 def receive_after_delete(mapper, connection, target):
-    target.data = None
+    _releaseSound(target, target.uuid)
+
+
+@event.listens_for(SoundAction, 'after_update')
+def receive_after_update(mapper, connection, target):
+    history = inspect(target).attrs.uuid.history
+    for key in history.added or ():
+        _claimSound(target, key)
+    for key in history.deleted or ():
+        if key != target.uuid:
+            _releaseSound(target, key)
+
+
+def _unclaimSounds(session):
+    store = SoundStore.getStore()
+    for key in session.info.pop('claimedSounds', ()):
+        store.unclaim(key)
+
+
+@event.listens_for(Session, 'after_commit')
+def receive_after_commit(session):
+    _unclaimSounds(session)
+    released = session.info.pop('releasedSounds', None)
+    if not released:
+        return
+
+    # the session can not emit sql after its commit, recount the committed references on a new connection
+    store = SoundStore.getStore()
+    column = SoundAction.__table__.c.uuid
+    with session.get_bind(SoundAction.__mapper__).connect() as connection:
+        for key in released:
+            if store.isClaimed(key):
+                continue
+            if not connection.scalar(select([func.count(column)]).where(column == key)):
+                store.remove(key)
+
+
+@event.listens_for(Session, 'after_rollback')
+def receive_after_rollback(session):
+    _unclaimSounds(session)
+    session.info.pop('releasedSounds', None)
+
 
 class JointPosition(StandardMixin, Base):
 
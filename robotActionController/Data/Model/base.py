@@ -1,9 +1,12 @@
 from sqlalchemy.ext.declarative import declared_attr, declarative_base
 from sqlalchemy import inspect, Column, Integer, Sequence
+from sqlalchemy.orm import aliased, object_session
 from sqlalchemy.orm.properties import RelationshipProperty, ColumnProperty
+from collections import namedtuple
 from dateutil.tz import tzutc
 import robotActionController.Data.config
 import datetime
+import logging
 
 
 __all__ = ['Base', 'SerializeMixin', 'SettingMixin', 'StandardMixin']
@@ -43,34 +46,97 @@ class IDBase(robotActionController.Data.config.modelBase):
         self.id = id
 
 
+class _CompiledClass(namedtuple('_CompiledClass', ['desc', 'columns', 'relations', 'fields'])):
+    """
+    Serialization plan for a mapped class, built once from the mapper
+    columns: ((key, toJson), ...) for serialize, large binary columns are left out
+    relations: ((key, itemType, uselist), ...)
+    fields: ((key, relation, fromJson), ...) in mapper order for deserialize, relation is None for columns
+    """
+    __slots__ = ()
+
+
 class SerializeMixin(object):
 
+    _compiled = {}
+
     @staticmethod
-    def getDesc(cls):
+    def _compile(cls):
+        compiled = SerializeMixin._compiled.get(cls)
+        if compiled != None:
+            return compiled
+
         desc = {}
+        columns = []
+        relations = []
+        fields = []
         mapper = inspect(cls)
         for attr in mapper.attrs:
             if isinstance(attr, RelationshipProperty):
+                itemType = attr.mapper.class_
+                relation = (attr.key, itemType, attr.uselist == True)
                 if attr.uselist == True:
-                    try:
-                        desc[attr.key] = "[%s]" % attr.mapper.class_.__name__
-                    except:
-                        print "Error reading attribute %s on class %s!" % (attr.key, cls.__name__)
-                        print type(attr.target)
-                        print dir(attr.target)
+                    desc[attr.key] = "[%s]" % itemType.__name__
                 else:
-                    desc[attr.key] = attr.mapper.class_.__name__
+                    desc[attr.key] = itemType.__name__
+                relations.append(relation)
+                fields.append((attr.key, relation, None))
             elif isinstance(attr, ColumnProperty):
-                desc[attr.key] = attr.columns[0].type.python_type
+                columnType = attr.columns[0].type
+                try:
+                    pythonType = columnType.python_type
+                except NotImplementedError:
+                    pythonType = None
+                desc[attr.key] = pythonType
+
+                if columnType.__visit_name__ == 'large_binary':
+                    continue
+                if pythonType == datetime.datetime:
+                    columns.append((attr.key, SerializeMixin._utcDateTime))
+                    fields.append((attr.key, None, SerializeMixin._parseDateTime))
+                else:
+                    columns.append((attr.key, None))
+                    fields.append((attr.key, None, SerializeMixin._converter(pythonType)))
+
+        compiled = _CompiledClass(desc, tuple(columns), tuple(relations), tuple(fields))
+        SerializeMixin._compiled[cls] = compiled
+        return compiled
 
-        return desc
+    @staticmethod
+    def _converter(pythonType):
+        if not pythonType:
+            return None
+
+        def convert(value):
+            if value == None:
+                return None
+            try:
+                return pythonType(value)
+            except Exception:
+                logging.getLogger(SerializeMixin.__name__).warning("Unable to convert %r to %s" % (value, pythonType.__name__), exc_info=True)
+                return None
+
+        return convert
+
+    @staticmethod
+    def getDesc(cls):
+        return dict(SerializeMixin._compile(cls).desc)
 
     @staticmethod
     def _utcDateTime(dt):
+        if not isinstance(dt, datetime.datetime):
+            return dt
         if dt.tzinfo:
             dt = dt.astimezone(tzutc()).replace(tzinfo=None)
         return dt.isoformat() + 'Z'
 
+    @staticmethod
+    def _parseDateTime(value):
+        try:
+            return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
+        except ValueError:
+            return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ')
+
     @staticmethod
     def deserialize(cls, dictObj, session, depth=3):
         if 'id' in dictObj:
@@ -79,137 +145,195 @@ class SerializeMixin(object):
                 raise ValueError("Invalid id specified: %s %s", (cls.__name__, dictObj['id']))
         else:
             newObj = cls()
-        mapper = inspect(newObj.__class__)
         props = {}
-        for attr in mapper.attrs:
-            if attr.key not in dictObj:
+        for (key, relation, convert) in SerializeMixin._compile(newObj.__class__).fields:
+            if key not in dictObj:
                 continue
 
-            if isinstance(attr, RelationshipProperty):
-                itemType = attr.mapper.class_
+            if relation != None:
+                (_, itemType, uselist) = relation
                 # newData can be [{objectDict}, ...], {objectDict}, {'proxyObject':true, 'ids':[oid, ...], ... }
-                newData = dictObj[attr.key]
+                newData = dictObj[key]
                 if isinstance(newData, dict) and 'proxyObject' in newData:
                     # newData = {'proxyList':true, 'ids':[oid, ...], 'type', 'ObjType', 'url': 'objUrl/:id' }
-                    if attr.uselist == True:
-                        attrList = getattr(newObj, attr.key)
-                        curIds = map(lambda x: x.id, attrList)
-                        newIds = newData['ids']
-
-                        adds = filter(lambda x: x not in curIds, newIds)
-                        dels = filter(lambda x: x not in newIds, curIds)
-
-                        for o in adds:
-                            attrList.append(session.query(itemType).get(o))
-                        for o in dels:
-                            attrList.remove(session.query(itemType).get(o))
+                    if uselist:
+                        attrList = getattr(newObj, key)
+                        curIds = set(x.id for x in attrList)
+                        newIds = set(newData['ids'])
+
+                        dels = curIds - newIds
+                        if dels:
+                            for i in reversed([i for (i, x) in enumerate(attrList) if x.id in dels]):
+                                del attrList[i]
+
+                        adds = [i for i in SerializeMixin._unique(newData['ids']) if i not in curIds]
+                        if adds:
+                            items = SerializeMixin._getMany(itemType, adds, session)
+                            attrList.extend([items[i] for i in adds])
+                        if hasattr(attrList, 'reorder'):
+                            attrList.reorder()
                     else:
                         if len(newData['ids']) == 0:
-                            setattr(newObj, attr.key, None)
-                        elif getattr(newObj, attr.key) == None or getattr(newObj, attr.key).id != newData['ids'][0]:
-                            setattr(newObj, attr.key, session.query(itemType).get(newData['ids'][0]))
+                            setattr(newObj, key, None)
+                        elif getattr(newObj, key) == None or getattr(newObj, key).id != newData['ids'][0]:
+                            setattr(newObj, key, session.query(itemType).get(newData['ids'][0]))
                 else:
                     # newData can be [{objectDict}, ...], {objectDict}
-                    props[attr.key] = {}
-                    if attr.uselist == True:
-                        attrList = getattr(newObj, attr.key)
-                        map(attrList.remove, attrList)
+                    props[key] = {}
+                    if uselist:
+                        attrList = getattr(newObj, key)
+                        del attrList[:]
 
-                        for o in newData:
-                            if depth > 0:
+                        # load every referenced item up front, the per item lookups below then hit the identity map
+                        items = SerializeMixin._getMany(itemType, [o['id'] for o in newData if 'id' in o], session)
+                        if depth > 0:
+                            for o in newData:
                                 item, subProps = itemType.deserialize(itemType, o, session, depth - 1)
                                 attrList.append(item)
-                                props[attr.key].update(subProps)
-                            else:
-                                attrList.append(session.query(itemType).get(o['id']))
+                                props[key].update(subProps)
+                        else:
+                            attrList.extend([items[o['id']] for o in newData])
+                        if hasattr(attrList, 'reorder'):
+                            # ordering_list only numbers appended items that have no position yet
+                            attrList.reorder()
                     else:
                         if depth > 0:
                             item, subProps = itemType.deserialize(itemType, newData, session, depth - 1)
-                            setattr(newObj, attr.key, item)
-                            props[attr.key] = subProps
+                            setattr(newObj, key, item)
+                            props[key] = subProps
                         else:
-                            setattr(newObj, attr.key, session.query(itemType).get(newData['id']))
-            elif isinstance(attr, ColumnProperty):
-                try:
-                    if attr.columns[0].type.python_type == datetime.datetime:
-                        try:
-                            item = datetime.datetime.strptime(dictObj[attr.key], '%Y-%m-%dT%H:%M:%SZ')
-                        except ValueError:
-                            item = datetime.datetime.strptime(dictObj[attr.key], '%Y-%m-%dT%H:%M:%S.%fZ')
-                    elif attr.columns[0].type.__visit_name__ == 'large_binary':
-                        continue
-                    elif attr.columns[0].type.python_type:
-                        try:
-                            if dictObj[attr.key] == None:
-                                item = None
-                            else:
-                                item = attr.columns[0].type.python_type(dictObj[attr.key])
-                        except Exception as e:
-                            # TODO: Error logging
-                            print e
-                            item = None
-                    else:
-                        item = dictObj[attr.key]
-                except Exception as e:
-                    item = dictObj[attr.key]
+                            setattr(newObj, key, session.query(itemType).get(newData['id']))
+            else:
+                item = dictObj[key]
+                if convert != None:
+                    try:
+                        item = convert(item)
+                    except Exception:
+                        item = dictObj[key]
 
-                if not getattr(newObj, attr.key) == item:
-                    setattr(newObj, attr.key, item)
+                if not getattr(newObj, key) == item:
+                    setattr(newObj, key, item)
 
         return (newObj, props)
 
-    def serialize(self, useProxies=True, urlResolver=None, resolveProps={}):
-        mapper = inspect(self.__class__)
+    @staticmethod
+    def _unique(ids):
+        seen = set()
+        return [i for i in ids if not (i in seen or seen.add(i))]
+
+    @staticmethod
+    def _getMany(itemType, ids, session):
+        """returns {id: object} for all ids, loaded with a single IN query, raises ValueError for unknown ids"""
+        ids = set(ids)
+        if not ids:
+            return {}
+        # load subclass columns in the same query so polymorphic items do not each issue their own select
+        query = session.query(itemType).with_polymorphic('*').filter(itemType.id.in_(ids))
+        items = dict((o.id, o) for o in query)
+        missing = ids.difference(items)
+        if missing:
+            raise ValueError("Invalid id specified: %s %s" % (itemType.__name__, sorted(missing)))
+        return items
+
+    def serialize(self, useProxies=True, urlResolver=None, resolveProps={}, _proxyIds=None):
+        compiled = SerializeMixin._compile(self.__class__)
         obj = {}
-        for attr in mapper.attrs:
-            if isinstance(attr, RelationshipProperty):
-                if useProxies and attr.key not in resolveProps:
-                    proxy = {
-                             'proxyObject': True,
-                             'type': attr.mapper.class_.__name__,
-                             'isList': attr.uselist,
-                             'uri': attr.key
-                    }
-
-#                     if urlResolver != None:
-#                         if type(urlResolver) == str:
-#                             proxy['uri'] = urlResolver
-#                             urlResolver = None
-#                         else:
-#                             proxy['uri'] = urlResolver(attr.mapper.class_)
-#
-#                     proxy['ids'] = object_session(self).query(getattr(attr.class_attribute.class_, 'id')).all()
-#                     if proxy['ids']:
-#                         proxy['ids'] = [tup[0] for tup in proxy['ids']]
-
-                    obj[attr.key] = proxy
+        for (key, toJson) in compiled.columns:
+            item = getattr(self, key)
+            if toJson != None and item != None:
+                item = toJson(item)
+            obj[key] = item
+
+        for (key, itemType, uselist) in compiled.relations:
+            if useProxies and key not in resolveProps:
+                proxy = {
+                         'proxyObject': True,
+                         'type': itemType.__name__,
+                         'isList': uselist,
+                         'uri': key
+                }
+                if _proxyIds != None and key in _proxyIds:
+                    proxy['ids'] = _proxyIds[key].get(self.id, [])
+
+                obj[key] = proxy
+            else:
+                # This has potential circular reference issues
+                if uselist:
+                    items = []
+                    for item in getattr(self, key):
+                        items.append(item.serialize(useProxies, urlResolver, resolveProps=resolveProps[key]))
+                    obj[key] = items
                 else:
-                    # This has potential circular reference issues
-                    if attr.uselist == True:
-                        items = []
-                        for item in getattr(self, attr.key):
-                            items.append(item.serialize(useProxies, urlResolver, resolveProps=resolveProps[attr.key]))
-                        obj[attr.key] = items
+                    prop = getattr(self, key)
+                    if prop != None:
+                        obj[key] = prop.serialize()
                     else:
-                        prop = getattr(self, attr.key)
-                        if prop != None:
-                            obj[attr.key] = prop.serialize()
-                        else:
-                            obj[attr.key] = {}
-            elif isinstance(attr, ColumnProperty):
-                item = getattr(self, attr.key)
-                if attr.columns[0].type.__visit_name__ == 'large_binary':
-                    continue
-                if type(item) == datetime.datetime:
-                    item = SerializeMixin._utcDateTime(item)
-
-                obj[attr.key] = item
+                        obj[key] = {}
 
         return obj
 
+    @staticmethod
+    def serialize_many(objs, useProxies=True, urlResolver=None, resolveProps={}, session=None):
+        """
+        Serialize a list of objects, proxies get their 'ids' filled in
+        The ids are fetched with a single query per relationship for all objects of a class
+        @param objs: list of mapped objects
+        @param session: session to query the ids with, defaults to the session of the objects
+        """
+        objs = list(objs)
+        proxyIds = {}
+        if useProxies and objs:
+            session = session or object_session(objs[0])
+            byClass = {}
+            for o in objs:
+                byClass.setdefault(o.__class__, []).append(o.id)
+            if session != None:
+                for (cls, ids) in byClass.iteritems():
+                    proxyIds[cls] = SerializeMixin._loadProxyIds(cls, ids, session, resolveProps)
+
+        return [o.serialize(useProxies, urlResolver, resolveProps=resolveProps, _proxyIds=proxyIds.get(o.__class__))
+                for o in objs]
+
+    @staticmethod
+    def _loadProxyIds(cls, ids, session, resolveProps={}):
+        """returns {relationKey: {ownerId: [itemId, ...]}} for the proxied relations of cls"""
+        proxyIds = {}
+        ids = [i for i in ids if i != None]
+        if not ids:
+            return proxyIds
+
+        for (key, itemType, _) in SerializeMixin._compile(cls).relations:
+            if key in resolveProps:
+                continue
+            # alias the owner so self referential relations (next_actions) join cleanly and the
+            # relationship order_by still applies to the item table
+            owner = aliased(cls)
+            query = session.query(owner.id, itemType.id)\
+                           .join(itemType, getattr(owner, key))\
+                           .filter(owner.id.in_(ids))
+            relationOrder = inspect(cls).attrs[key].order_by
+            if relationOrder:
+                query = query.order_by(*relationOrder)
+
+            owners = proxyIds[key] = {}
+            for (ownerId, itemId) in query:
+                owners.setdefault(ownerId, []).append(itemId)
+
+        return proxyIds
+
+
+def _alwaysRefresh():
+    config = robotActionController.Data.config.database_config
+    alwaysRefresh = config.get('alwaysRefresh', None)
+    if alwaysRefresh == None:
+        return not config.get('configPollInterval', None)
+    return alwaysRefresh
+
 
 class SettingMixin(object):
-    __mapper_args__ = {'always_refresh': True}
+    # the runtime caches refresh through Data.configWatcher on real changes (see ConfigVersion),
+    # without the watcher every query overwrites the loaded objects instead
+    __mapper_args__ = {'always_refresh': _alwaysRefresh()}
 
 
 class DisplayMixin(object):
@@ -1,6 +1,8 @@
 from base import StandardMixin, Base
-from sqlalchemy import Column, Integer, ForeignKey, String, PickleType
+from sqlalchemy import Column, Integer, ForeignKey, String, PickleType, event
 from sqlalchemy.orm import relationship
+from sensor import Sensor
+from servo import Servo
 
 
 __all__ = ['Robot', 'RobotModel', ]
@@ -38,6 +40,49 @@ class Robot(StandardMixin, Base):
         self.sensorConfigs = sensorConfigs
         self.servoConfigs = servoConfigs
 
+    def getSensorByName(self, name):
+        """first sensor with the given name, looked up in an index built on first use"""
+        sensors = self._lookup('_sensorIndex', 'sensors', 'name', name)
+        return sensors[0] if sensors else None
+
+    def getServosByJointName(self, jointName):
+        """list of the servos with the given joint name, looked up in an index built on first use"""
+        return self._lookup('_servoIndex', 'servos', 'jointName', jointName)
+
+    def _lookup(self, indexName, collection, key, value):
+        index = getattr(self, indexName, None)
+        if index == None:
+            index = {}
+            for item in getattr(self, collection):
+                index.setdefault(getattr(item, key), []).append(item)
+            setattr(self, indexName, index)
+        return index.get(value, [])
+
+    def clearNameIndexes(self):
+        self._sensorIndex = None
+        self._servoIndex = None
+
+
+def _clearNameIndexes(target, *args):
+    target.clearNameIndexes()
+
+# the indexes are rebuilt on the next lookup whenever the collections may have changed
+for _collection in (Robot.sensors, Robot.servos):
+    for _event in ('append', 'remove', 'set'):
+        event.listen(_collection, _event, _clearNameIndexes)
+for _event in ('load', 'refresh', 'expire'):
+    event.listen(Robot, _event, _clearNameIndexes)
+
+
+def _clearRobotNameIndexes(target, *args):
+    robot = getattr(target, 'robot', None)
+    if robot != None:
+        robot.clearNameIndexes()
+
+# a renamed sensor or servo moves to another key
+event.listen(Sensor.name, 'set', _clearRobotNameIndexes, propagate=True)
+event.listen(Servo.jointName, 'set', _clearRobotNameIndexes)
+
 
 class RobotModel(StandardMixin, Base):
     extraData = Column(PickleType)
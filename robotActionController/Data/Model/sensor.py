@@ -14,7 +14,7 @@ sensorGroups_table = Table('sensorGroups', Base.metadata,
 
 class Sensor(StandardMixin, Base):
 
-    name = Column(String(50))
+    name = Column(String(50), index=True)
     type = Column(String(50))
 
     model_id = Column(Integer, ForeignKey("SensorModel.id"))
@@ -7,7 +7,7 @@ __all__ = ['ButtonHotkey', 'ButtonTrigger', 'SensorTrigger', 'TimeTrigger', 'Tri
 
 class Trigger(StandardMixin, Base):
 
-    name = Column(String(50))
+    name = Column(String(50), index=True)
     type = Column(String(50))
 
     action_id = Column(Integer, ForeignKey('Action.id'))
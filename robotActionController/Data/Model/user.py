@@ -6,7 +6,7 @@ __all__ = ['User', 'CustomTrigger', 'CustomAction', ]
 
 
 class User(StandardMixin, Base):
-    name = Column(String(50))
+    name = Column(String(50), index=True)
     fullname = Column(String(50))
     speedmodifier = Column(Integer)
     customTriggers = relationship("CustomTrigger")
@@ -0,0 +1,94 @@
+from base import Base
+from sqlalchemy import Column, String, Integer, select, inspect, event
+from sqlalchemy.orm import Session
+
+
+__all__ = ['ConfigVersion', ]
+
+
+class ConfigVersion(Base):
+    """
+    Change counter for the configuration tables, bumped whenever a session flushes changes to them
+    The row named '*' holds the global version, every other row holds the global version
+    at which its table was last changed, so 'what changed since X' is a single query
+    Only the configuration tables are tracked, frequent writes to the other tables (users, locations...)
+    never touch the counter
+    """
+
+    GLOBAL = '*'
+
+    # the tables the runtime caches depend on, every process writing configuration has to bump them
+    # whether or not it loaded the caches itself, ConfigWatcher.register adds any others
+    trackedTables = set([
+                         'Action', 'PoseAction', 'SequenceAction', 'GroupAction', 'SoundAction', 'JointPosition', 'SequenceOrder',
+                         'Robot', 'RobotModel', 'Servo', 'ServoModel', 'ServoConfig', 'ServoGroup',
+                         'Sensor', 'RobotSensor', 'ExternalSensor', 'SensorModel', 'SensorConfig', 'SensorValueType',
+                         'DiscreteValueType', 'ContinuousValueType', 'DiscreteSensorValue',
+                         'Trigger', 'SensorTrigger', 'CompoundTrigger', 'TimeTrigger', 'ButtonTrigger', 'ButtonHotkey',
+                         ])
+
+    name = Column(String(50), unique=True, nullable=False)
+    version = Column(Integer, nullable=False, default=0)
+
+    def __init__(self, name=None, version=0, **kwargs):
+        super(ConfigVersion, self).__init__(**kwargs)
+        self.name = name
+        self.version = version
+
+    @staticmethod
+    def currentVersion(session):
+        table = ConfigVersion.__table__
+        return session.scalar(select([table.c.version]).where(table.c.name == ConfigVersion.GLOBAL)) or 0
+
+    @staticmethod
+    def changedSince(session, version, tables=None):
+        """
+        returns {tableName: version} for the tables changed after version
+        @param tables: optional list of table names to limit the result to
+        """
+        table = ConfigVersion.__table__
+        query = select([table.c.name, table.c.version]).where(table.c.version > version).where(table.c.name != ConfigVersion.GLOBAL)
+        if tables != None:
+            query = query.where(table.c.name.in_(list(tables)))
+        return dict(session.execute(query).fetchall())
+
+    @staticmethod
+    def track(tables):
+        ConfigVersion.trackedTables.update(tables)
+
+    @staticmethod
+    def bump(connection, tableNames):
+        """increment the global version and stamp it on tableNames, returns the new version"""
+        table = ConfigVersion.__table__
+        update = table.update().where(table.c.name == ConfigVersion.GLOBAL).values(version=table.c.version + 1)
+        if not connection.execute(update).rowcount:
+            connection.execute(table.insert().values(name=ConfigVersion.GLOBAL, version=1))
+        version = connection.scalar(select([table.c.version]).where(table.c.name == ConfigVersion.GLOBAL))
+
+        tableNames = list(tableNames)
+        updated = connection.execute(table.update().where(table.c.name.in_(tableNames)).values(version=version)).rowcount
+        if updated < len(tableNames):
+            existing = set(row[0] for row in connection.execute(select([table.c.name]).where(table.c.name.in_(tableNames))))
+            missing = [{'name': name, 'version': version} for name in tableNames if name not in existing]
+            if missing:
+                connection.execute(table.insert(), missing)
+
+        return version
+
+
+def _changedTables(session):
+    tables = set()
+    for obj in session.new.union(session.deleted):
+        tables.update(t.name for t in inspect(obj).mapper.tables)
+    for obj in session.dirty:
+        if session.is_modified(obj):
+            tables.update(t.name for t in inspect(obj).mapper.tables)
+    return tables.intersection(ConfigVersion.trackedTables)
+
+
+@event.listens_for(Session, 'after_flush')
+def receive_after_flush(session, flushContext):
+    # same connection and transaction as the flush, the version only moves if the changes commit
+    tables = _changedTables(session)
+    if tables:
+        ConfigVersion.bump(session.connection(), tables)
@@ -9,5 +9,9 @@ database_config = {
                               },
                    'debug': False,
                    'autocommit': False,
+                   # seconds between checks for configuration changes, 0 or None disables the watcher
+                   'configPollInterval': 5,
+                   # None refreshes every query only while the watcher is disabled
+                   'alwaysRefresh': None,
                    'dataFolder': os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Files')),
                    }
@@ -0,0 +1,258 @@
+import copy
+import logging
+from gevent.lock import RLock
+from sqlalchemy import inspect, PickleType
+from sqlalchemy.orm import joinedload, subqueryload
+from robotActionController.Data.storage import StorageFactory
+from robotActionController.Data.configWatcher import ConfigWatcher
+from robotActionController.Data.Model import ConfigVersion, Robot, RobotSensor, Servo, SensorConfig, ServoConfig, \
+    ServoGroup, SensorGroup, Sensor, DiscreteValueType, ContinuousValueType
+
+__all__ = ['ConfigSnapshot', ]
+
+
+class _Frozen(object):
+    """Read only copy of a model object, attributes carry the same names as on the model"""
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is a read only configuration snapshot" % self.__class__.__name__)
+
+    __delattr__ = __setattr__
+
+    def _set(self, name, value):
+        object.__setattr__(self, name, value)
+
+    def __repr__(self):
+        if hasattr(self, 'name'):
+            return "%s('%s')" % (self.__class__.__name__, self.name)
+        else:
+            return "%s('%s')" % (self.__class__.__name__, self.id)
+
+
+class _FrozenRobot(_Frozen):
+    __slots__ = ('_servosByJoint', '_sensorsByName')
+
+    def getSensorByName(self, name):
+        return self._sensorsByName.get(name, None)
+
+    def getServosByJointName(self, jointName):
+        return list(self._servosByJoint.get(jointName, ()))
+
+    def _buildIndexes(self):
+        servosByJoint = {}
+        for servo in self.servos:
+            servosByJoint.setdefault(servo.jointName, []).append(servo)
+        sensorsByName = {}
+        for sensor in self.sensors:
+            sensorsByName.setdefault(sensor.name, sensor)
+        self._set('_servosByJoint', dict((k, tuple(v)) for (k, v) in servosByJoint.iteritems()))
+        self._set('_sensorsByName', sensorsByName)
+
+
+class _FrozenServo(_Frozen):
+    __slots__ = ()
+
+    __repr__ = Servo.__repr__.im_func
+
+
+class _FrozenSensor(_Frozen):
+    __slots__ = ()
+
+    normalize = Sensor.normalize.im_func
+    isValid = Sensor.isValid.im_func
+
+
+class _FrozenDiscreteValueType(_Frozen):
+    __slots__ = ()
+
+    normalize = DiscreteValueType.normalize.im_func
+    isValid = DiscreteValueType.isValid.im_func
+
+
+class _FrozenContinuousValueType(_Frozen):
+    __slots__ = ()
+
+    normalize = ContinuousValueType.normalize.im_func
+    isValid = ContinuousValueType.isValid.im_func
+
+
+class ConfigSnapshot(object):
+    """
+    Immutable copy of the complete configuration of one robot, loaded in a single pass
+    Runtime subsystems resolve the model objects they are given to the snapshot copies
+    and never touch the session again.  A reload builds a new snapshot and swaps it in with
+    a single assignment, holders of the previous snapshot keep a consistent (if stale) view
+    Reloads are triggered by ConfigWatcher, or when it is not running by get() finding a newer ConfigVersion
+        robot = ConfigSnapshot.get(robotId).robot
+        servo = ConfigSnapshot.resolve(servo)
+    """
+
+    __slots__ = ('robotId', 'robot', 'version', '_objects')
+
+    # relationships followed into the snapshot, everything else is copied as columns only
+    # (the default action is copied without its poses or child actions)
+    _links = {
+              'Robot': ('model', 'servos', 'sensors', 'servoConfigs', 'sensorConfigs', 'servoGroups', 'sensorGroups', 'defaultAction'),
+              'Servo': ('model', 'robot', 'groups'),
+              'RobotSensor': ('model', 'robot', 'value_type', 'groups'),
+              'ServoGroup': ('robot', 'servos'),
+              'SensorGroup': ('robot', 'sensors'),
+              'ServoConfig': ('model', ),
+              'SensorConfig': ('model', ),
+              'DiscreteValueType': ('values', ),
+              }
+    # model methods carried over to the snapshot copies
+    _bases = {
+              'Robot': _FrozenRobot,
+              'Servo': _FrozenServo,
+              'RobotSensor': _FrozenSensor,
+              'ExternalSensor': _FrozenSensor,
+              'DiscreteValueType': _FrozenDiscreteValueType,
+              'ContinuousValueType': _FrozenContinuousValueType,
+              }
+    configTables = ['Robot', 'RobotModel', 'Servo', 'ServoModel', 'ServoConfig', 'ServoGroup', 'Sensor', 'RobotSensor', 'ExternalSensor',
+                    'SensorModel', 'SensorConfig', 'SensorGroup', 'SensorValueType', 'DiscreteValueType', 'ContinuousValueType',
+                    'DiscreteSensorValue', 'Action', 'PoseAction', 'SequenceAction', 'GroupAction', 'SoundAction']
+
+    _snapshots = {}
+    _classes = {}
+    _lock = RLock()
+
+    def __init__(self, robotId, robot, version, objects):
+        self.robotId = robotId
+        self.robot = robot
+        self.version = version
+        self._objects = objects
+
+    def find(self, typeName, objectId):
+        """the snapshot copy of the model object typeName(objectId), or None"""
+        return self._objects.get((typeName, objectId), None)
+
+    @staticmethod
+    def get(robotId):
+        """the current snapshot of the robot, loaded on first use"""
+        snapshot = ConfigSnapshot._snapshots.get(robotId, None)
+        if snapshot == None or not ConfigWatcher.isRunning():
+            with ConfigSnapshot._lock:
+                snapshot = ConfigSnapshot._snapshots.get(robotId, None)
+                if snapshot == None:
+                    snapshot = ConfigSnapshot.load(robotId)
+                elif not ConfigWatcher.isRunning():
+                    with StorageFactory.sessionScope(commit=False) as session:
+                        if ConfigVersion.currentVersion(session) != snapshot.version:
+                            snapshot = ConfigSnapshot.load(robotId, session)
+        return snapshot
+
+    @staticmethod
+    def load(robotId, session=None):
+        """(re)load the robot's configuration and swap the new snapshot in"""
+        if session == None:
+            with StorageFactory.sessionScope(commit=False) as session:
+                return ConfigSnapshot.load(robotId, session)
+
+        robot = session.query(Robot).options(
+                                             joinedload(Robot.model),
+                                             joinedload(Robot.defaultAction),
+                                             subqueryload(Robot.servos).joinedload(Servo.model),
+                                             subqueryload(Robot.servos).subqueryload(Servo.groups),
+                                             subqueryload(Robot.sensors).joinedload(RobotSensor.model),
+                                             subqueryload(Robot.sensors).joinedload(RobotSensor.value_type),
+                                             subqueryload(Robot.sensors).subqueryload(RobotSensor.groups),
+                                             subqueryload(Robot.servoConfigs).joinedload(ServoConfig.model),
+                                             subqueryload(Robot.sensorConfigs).joinedload(SensorConfig.model),
+                                             subqueryload(Robot.servoGroups).subqueryload(ServoGroup.servos),
+                                             subqueryload(Robot.sensorGroups).subqueryload(SensorGroup.sensors),
+                                             ).filter(Robot.id == robotId).first()
+        if robot == None:
+            raise ValueError("Unknown robot id: %s" % robotId)
+
+        objects = {}
+        frozenRobot = ConfigSnapshot._freeze(robot, objects)
+        snapshot = ConfigSnapshot(robotId, frozenRobot, ConfigVersion.currentVersion(session), objects)
+        ConfigSnapshot._snapshots[robotId] = snapshot
+        logging.getLogger(ConfigSnapshot.__name__).debug("Loaded configuration of robot %s at version %s" % (robot.name, snapshot.version))
+        return snapshot
+
+    @staticmethod
+    def reload(changedTables=None):
+        """reload every loaded snapshot, registered with ConfigWatcher for the configuration tables"""
+        for robotId in ConfigSnapshot._snapshots.keys():
+            try:
+                ConfigSnapshot.load(robotId)
+            except ValueError:
+                # the robot was removed, the holders of its last snapshot keep running on it
+                ConfigSnapshot._snapshots.pop(robotId, None)
+
+    @staticmethod
+    def clear():
+        ConfigSnapshot._snapshots.clear()
+
+    @staticmethod
+    def resolve(obj):
+        """
+        The snapshot copy of a robot, or of a servo, sensor or config belonging to a robot
+        snapshot copies are returned as is, objects not attached to a robot are returned unchanged
+        """
+        if obj == None or isinstance(obj, _Frozen):
+            return obj
+
+        typeName = obj.__class__.__name__
+        robotId = obj.id if isinstance(obj, Robot) else getattr(obj, 'robot_id', None)
+        if robotId == None:
+            return obj
+
+        try:
+            found = ConfigSnapshot.get(robotId).find(typeName, obj.id)
+        except ValueError:
+            found = None
+        if found == None:
+            # not committed yet, the next reload picks it up
+            logging.getLogger(ConfigSnapshot.__name__).debug("%s is not in the configuration snapshot of robot %s" % (obj, robotId))
+            return obj
+        return found
+
+    @staticmethod
+    def _getClass(typeName, mapper):
+        frozenClass = ConfigSnapshot._classes.get(typeName, None)
+        if frozenClass == None:
+            slots = tuple(a.key for a in mapper.column_attrs) + ConfigSnapshot._links.get(typeName, ())
+            base = ConfigSnapshot._bases.get(typeName, _Frozen)
+            frozenClass = type(typeName, (base, ), {'__slots__': slots})
+            ConfigSnapshot._classes[typeName] = frozenClass
+        return frozenClass
+
+    @staticmethod
+    def _freeze(obj, objects):
+        if obj == None:
+            return None
+
+        state = inspect(obj)
+        typeName = obj.__class__.__name__
+        key = (typeName, obj.id)
+        if key in objects:
+            return objects[key]
+
+        frozenClass = ConfigSnapshot._getClass(typeName, state.mapper)
+        frozen = frozenClass.__new__(frozenClass)
+        # registered before following the links, servos and sensors link back to the robot
+        objects[key] = frozen
+        for attr in state.mapper.column_attrs:
+            value = getattr(obj, attr.key)
+            if isinstance(attr.columns[0].type, PickleType):
+                # pickled values (extraData...) are mutable, the snapshot must not share them with the session
+                value = copy.deepcopy(value)
+            frozen._set(attr.key, value)
+        for link in ConfigSnapshot._links.get(typeName, ()):
+            value = getattr(obj, link)
+            if isinstance(value, (list, tuple)):
+                frozen._set(link, tuple(ConfigSnapshot._freeze(item, objects) for item in value))
+            else:
+                frozen._set(link, ConfigSnapshot._freeze(value, objects))
+
+        if isinstance(frozen, _FrozenRobot):
+            frozen._buildIndexes()
+        return frozen
+
+
+ConfigWatcher.register(ConfigSnapshot.reload, ConfigSnapshot.configTables)
@@ -0,0 +1,110 @@
+import logging
+import gevent
+from gevent.lock import RLock
+from robotActionController.Data.storage import StorageFactory
+from robotActionController.Data.Model import ConfigVersion
+
+__all__ = ['ConfigWatcher', ]
+
+
+class ConfigWatcher(object):
+    """
+    Polls ConfigVersion and calls the registered refresh hooks when the tables they depend on change
+    A check costs one query while nothing has changed, so the runtime caches can stay loaded
+    instead of having every query refresh them (SettingMixin always_refresh)
+    StorageFactory starts polling every database_config['configPollInterval'] seconds on the main
+    hub, see StorageFactory.startConfigWatcher
+        ConfigWatcher.register(ActionManager.refreshAllCaches, ['Action', 'PoseAction'])
+    """
+
+    _hooks = []
+    _lock = RLock()
+    _version = None
+    _greenlet = None
+
+    @staticmethod
+    def register(callback, tables=None):
+        """
+        @param callback: called with {tableName: version} of the changed tables
+        @param tables: table names the callback depends on, None for any change to the tracked tables
+        """
+        if tables != None:
+            ConfigVersion.track(tables)
+        with ConfigWatcher._lock:
+            ConfigWatcher._hooks.append((callback, set(tables) if tables != None else None))
+
+    @staticmethod
+    def unregister(callback):
+        with ConfigWatcher._lock:
+            ConfigWatcher._hooks = [(c, t) for (c, t) in ConfigWatcher._hooks if c != callback]
+
+    @staticmethod
+    def check(session=None):
+        """
+        Run the hooks of the tables changed since the last check, returns the changed tables
+        The first check only records the current version
+        """
+        with ConfigWatcher._lock:
+            if session == None:
+                with StorageFactory.sessionScope(commit=False) as session:
+                    return ConfigWatcher._check(session)
+            return ConfigWatcher._check(session)
+
+    @staticmethod
+    def _check(session):
+        version = ConfigVersion.currentVersion(session)
+        lastVersion = ConfigWatcher._version
+        ConfigWatcher._version = version
+        if lastVersion == None or version == lastVersion:
+            return {}
+
+        changed = ConfigVersion.changedSince(session, lastVersion)
+        logger = logging.getLogger(ConfigWatcher.__name__)
+        logger.debug("Configuration changed from version %s to %s: %s" % (lastVersion, version, ', '.join(sorted(changed))))
+        for (callback, tables) in list(ConfigWatcher._hooks):
+            hookChanges = changed if tables == None else dict((k, v) for (k, v) in changed.iteritems() if k in tables)
+            if hookChanges:
+                try:
+                    callback(hookChanges)
+                except Exception:
+                    logger.critical("Error in configuration refresh hook %s" % callback, exc_info=True)
+
+        return changed
+
+    @staticmethod
+    def start(interval=5):
+        """
+        poll for changes every interval seconds from a greenlet on the calling thread's hub
+        the current version is recorded before returning, changes made after start() are never missed
+        """
+        with ConfigWatcher._lock:
+            if ConfigWatcher.isRunning():
+                return
+            if ConfigWatcher._version == None:
+                try:
+                    ConfigWatcher.check()
+                except Exception:
+                    logging.getLogger(ConfigWatcher.__name__).warning("Unable to read the configuration version", exc_info=True)
+            ConfigWatcher._greenlet = gevent.spawn(ConfigWatcher._poll, interval)
+
+    @staticmethod
+    def isRunning():
+        greenlet = ConfigWatcher._greenlet
+        return greenlet != None and not greenlet.dead
+
+    @staticmethod
+    def stop():
+        with ConfigWatcher._lock:
+            greenlet = ConfigWatcher._greenlet
+            ConfigWatcher._greenlet = None
+        if greenlet != None:
+            greenlet.kill()
+
+    @staticmethod
+    def _poll(interval):
+        while True:
+            gevent.sleep(interval)
+            try:
+                ConfigWatcher.check()
+            except Exception:
+                logging.getLogger(ConfigWatcher.__name__).warning("Unable to check the configuration version", exc_info=True)
@@ -0,0 +1,141 @@
+import os
+import mmap
+import hashlib
+import logging
+from gevent.lock import RLock
+from robotActionController.Data.config import database_config
+
+__all__ = ['SoundStore', ]
+
+
+class _MappedFile(object):
+    """Read only file object over a shared mapping, each reader keeps its own position"""
+
+    def __init__(self, data):
+        self._data = data
+        self._pos = 0
+
+    def read(self, size=-1):
+        end = len(self._data) if size < 0 else min(self._pos + size, len(self._data))
+        chunk = self._data[self._pos:end]
+        self._pos = max(end, self._pos)
+        return chunk
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += len(self._data)
+        self._pos = max(0, offset)
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._data = None
+
+
+class SoundStore(object):
+    """
+    Content addressed store for sound clips, files are named by the md5 of their data
+    Identical clips are stored once, the number of SoundActions using a key is the reference count
+    Keys referenced by flushed but uncommitted rows are claimed, so another transaction never removes them
+    Clips are memory mapped once and shared by every reader
+    """
+
+    _stores = {}
+    _storesLock = RLock()
+
+    @staticmethod
+    def getStore(basePath=None):
+        basePath = basePath or os.path.join(database_config['dataFolder'], 'soundFiles')
+        with SoundStore._storesLock:
+            if basePath not in SoundStore._stores:
+                SoundStore._stores[basePath] = SoundStore(basePath)
+            return SoundStore._stores[basePath]
+
+    def __init__(self, basePath):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._basePath = basePath
+        self._lock = RLock()
+        self._maps = {}
+        self._claims = {}
+        if not os.path.isdir(basePath):
+            os.makedirs(basePath)
+
+    @staticmethod
+    def getKey(data):
+        return hashlib.md5(data).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self._basePath, key)
+
+    def exists(self, key):
+        return bool(key) and os.path.isfile(self.path(key))
+
+    def put(self, data):
+        """stores data if no identical clip exists yet, returns its key"""
+        key = SoundStore.getKey(data)
+        with self._lock:
+            fileName = self.path(key)
+            if not os.path.isfile(fileName):
+                tempName = fileName + '.tmp'
+                with open(tempName, 'wb') as f:
+                    f.write(data)
+                os.rename(tempName, fileName)
+        return key
+
+    def read(self, key):
+        """returns a read only buffer over the clip (no copy), or None if the key is unknown"""
+        mapped = self._map(key)
+        if mapped == None:
+            return None
+        return buffer(mapped)
+
+    def open(self, key):
+        """returns a file object over the shared mapping, or None if the key is unknown"""
+        mapped = self._map(key)
+        if mapped == None:
+            return None
+        return _MappedFile(buffer(mapped))
+
+    def claim(self, key):
+        with self._lock:
+            self._claims[key] = self._claims.get(key, 0) + 1
+
+    def unclaim(self, key):
+        with self._lock:
+            count = self._claims.get(key, 0) - 1
+            if count > 0:
+                self._claims[key] = count
+            else:
+                self._claims.pop(key, None)
+
+    def isClaimed(self, key):
+        with self._lock:
+            return key in self._claims
+
+    def remove(self, key):
+        with self._lock:
+            # readers may still hold buffers into the mapping, it is unmapped once the last one is released
+            self._maps.pop(key, None)
+            if self.exists(key):
+                os.remove(self.path(key))
+                self._logger.debug("Removed sound %s" % key)
+
+    def _map(self, key):
+        if not key:
+            return None
+        with self._lock:
+            mapped = self._maps.get(key)
+            if mapped == None:
+                fileName = self.path(key)
+                if not os.path.isfile(fileName):
+                    return None
+                with open(fileName, 'rb') as f:
+                    if os.fstat(f.fileno()).st_size == 0:
+                        mapped = ''
+                    else:
+                        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[key] = mapped
+            return mapped
@@ -1,6 +1,10 @@
-from sqlalchemy import create_engine
+import threading
+import gevent
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event
 from config import database_config
 from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import StaticPool
 from sqlalchemy.engine import reflection
 from sqlalchemy.schema import (
     MetaData,
@@ -15,34 +19,130 @@ class StorageFactory(object):
 
     _dataStore = None
     _sessionMaker = None
+    _sessionRegistry = None
+    _initLock = threading.RLock()
+    _watcherStarted = False
     config = database_config
 
     @staticmethod
-    def getNewSession():
+    def _getSessionMaker():
         if StorageFactory._sessionMaker == None:
-            StorageFactory._sessionMaker = sessionmaker(autoflush=True, autocommit=False, bind=StorageFactory.getDefaultDataStore().engine)
+            with StorageFactory._initLock:
+                if StorageFactory._sessionMaker == None:
+                    StorageFactory._sessionMaker = sessionmaker(autoflush=True, autocommit=False, bind=StorageFactory.getDefaultDataStore().engine)
+
+        if not StorageFactory._watcherStarted and isinstance(threading.current_thread(), threading._MainThread):
+            # the processors open sessions from their own threads, the watcher has to live on the main hub
+            StorageFactory.startConfigWatcher()
+
+        return StorageFactory._sessionMaker
+
+    @staticmethod
+    def startConfigWatcher():
+        """
+        Poll for configuration changes made by other sessions and processes, see Data.configWatcher
+        Call from the main thread before the runtime caches are loaded, otherwise the watcher is
+        started by the first session opened on the main thread
+        """
+        with StorageFactory._initLock:
+            if StorageFactory._watcherStarted:
+                return
+            StorageFactory._watcherStarted = True
+        interval = StorageFactory.config.get('configPollInterval', None)
+        if interval:
+            from robotActionController.Data.configWatcher import ConfigWatcher
+            ConfigWatcher.start(interval)
+
+    @staticmethod
+    def getNewSession():
+        """Returns a new session, the caller is responsible for closing it"""
+        return StorageFactory._getSessionMaker()()
+
+    @staticmethod
+    def getSession():
+        """
+        Returns the session of the current greenlet
+        call StorageFactory.removeSession() once the unit of work is done
+        """
+        if StorageFactory._sessionRegistry == None:
+            with StorageFactory._initLock:
+                if StorageFactory._sessionRegistry == None:
+                    StorageFactory._sessionRegistry = scoped_session(StorageFactory._getSessionMaker(), scopefunc=gevent.getcurrent)
+
+        return StorageFactory._sessionRegistry()
 
-        session = scoped_session(StorageFactory._sessionMaker)
-        return session
+    @staticmethod
+    def removeSession():
+        if StorageFactory._sessionRegistry != None:
+            StorageFactory._sessionRegistry.remove()
+
+    @staticmethod
+    @contextmanager
+    def sessionScope(commit=True):
+        """
+        Short lived session for a single unit of work, committed on success (if commit is set),
+        rolled back on error and always closed
+            with StorageFactory.sessionScope() as session:
+                ...
+        """
+        session = StorageFactory.getNewSession()
+        try:
+            yield session
+            if commit:
+                session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
 
     @staticmethod
     def getDefaultDataStore():
         if StorageFactory._dataStore == None:
-            StorageFactory._dataStore = StorageFactory._buildDataStore(StorageFactory.config['engine']['type'])
+            with StorageFactory._initLock:
+                if StorageFactory._dataStore == None:
+                    StorageFactory._dataStore = StorageFactory._buildDataStore(StorageFactory.config['engine']['type'])
 
         return StorageFactory._dataStore
 
     @staticmethod
     def _buildDataStore(dbtype):
+        engineConfig = StorageFactory.config['engine']
         if dbtype == 'MySql':
             return MySQLDataStore(
-                                  StorageFactory.config['engine']['host'],
-                                  StorageFactory.config['engine']['user'],
-                                  StorageFactory.config['engine']['pass'],
-                                  StorageFactory.config['engine']['db'])
+                                  engineConfig['host'],
+                                  engineConfig['user'],
+                                  engineConfig['pass'],
+                                  engineConfig['db'],
+                                  poolSize=engineConfig.get('poolSize', 10),
+                                  maxOverflow=engineConfig.get('maxOverflow', 20),
+                                  poolRecycle=engineConfig.get('poolRecycle', 3600))
         elif dbtype == 'Sqlite':
             return SqliteDataStore(
-                                   StorageFactory.config['engine']['file'])
+                                   engineConfig['file'],
+                                   wal=engineConfig.get('wal', True))
+
+    @staticmethod
+    def createMissingIndexes(engine=None):
+        """
+        Migrate a database created before the model gained its indexes (e.g. the name indexes),
+        creates every index of the models that does not exist yet, returns the names of the created indexes
+        """
+        from robotActionController.Data.Model import Base
+        engine = engine or StorageFactory.getDefaultDataStore().engine
+        inspector = reflection.Inspector.from_engine(engine)
+        tables = set(inspector.get_table_names())
+        created = []
+        for table in Base.metadata.sorted_tables:
+            if table.name not in tables:
+                continue
+            existing = set(index['name'] for index in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(bind=engine)
+                    created.append(index.name)
+
+        return created
 
     @staticmethod
     def drop_keys(engine):
@@ -73,8 +173,8 @@ class StorageFactory(object):
 
 class DataStore(object):
 
-    def __init__(self, uri, debug=False):
-        self._engine = create_engine(uri, echo=debug)
+    def __init__(self, uri, debug=False, **engineArgs):
+        self._engine = create_engine(uri, echo=debug, **engineArgs)
 
     @property
     def engine(self):
@@ -83,17 +183,32 @@ class DataStore(object):
 
 class SqliteDataStore(DataStore):
 
-    def __init__(self, fileName):
+    def __init__(self, fileName, wal=True):
         uri = "sqlite:///%(file)s" % {
                                      'file': fileName,
                                      }
 
-        super(SqliteDataStore, self).__init__(uri, StorageFactory.config['debug'])
+        engineArgs = {}
+        if fileName == ':memory:':
+            # every connection to :memory: is a separate database, share a single connection instead
+            engineArgs['poolclass'] = StaticPool
+            engineArgs['connect_args'] = {'check_same_thread': False}
+
+        super(SqliteDataStore, self).__init__(uri, StorageFactory.config['debug'], **engineArgs)
+
+        if wal and fileName != ':memory:':
+            # WAL lets the sensor and trigger readers run alongside a writer
+            @event.listens_for(self._engine, 'connect')
+            def setPragmas(dbapiConnection, connectionRecord):
+                cursor = dbapiConnection.cursor()
+                cursor.execute('PRAGMA journal_mode=WAL')
+                cursor.execute('PRAGMA synchronous=NORMAL')
+                cursor.close()
 
 
 class MySQLDataStore(DataStore):
 
-    def __init__(self, host, user, pw, db):
+    def __init__(self, host, user, pw, db, poolSize=10, maxOverflow=20, poolRecycle=3600):
         # uri = "mysql://anonymous@%(host)s/%(db)s"
         uri = "mysql://%(user)s:%(pass)s@%(host)s/%(db)s" % {
                                                              'user': user,
@@ -101,4 +216,9 @@ class MySQLDataStore(DataStore):
                                                              'host': host,
                                                              'db': db}
 
-        super(MySQLDataStore, self).__init__(uri, StorageFactory.config['debug'])
+        # recycle before the server's wait_timeout drops idle connections
+        super(MySQLDataStore, self).__init__(uri,
+                                             StorageFactory.config['debug'],
+                                             pool_size=poolSize,
+                                             max_overflow=maxOverflow,
+                                             pool_recycle=poolRecycle)
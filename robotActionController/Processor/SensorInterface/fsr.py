@@ -1,7 +1,10 @@
 from robotActionController import connections
 from robotActionController.Processor.SensorInterface import SensorPoller
+from robotActionController.clock import monotonic
+import struct
 import logging
-from gevent import spawn
+from array import array
+from gevent import spawn, sleep
 from gevent.lock import RLock
 
 __all__ = ['FSR_Arduino', ]
@@ -10,48 +13,106 @@ __all__ = ['FSR_Arduino', ]
 class FSR_Arduino(object):
     sensorType = 'FSR_Arduino'
 
-    def __init__(self, port, speed):
+    _syncByte = 0xAB
+    _maxValue = 1023
+
+    def __init__(self, port, speed, chunkSize=512):
+        """
+        @param port: serial port the arduino is attached to
+        @param speed: baud rate of the port
+        @param chunkSize: maximum number of bytes pulled from the port per read
+        """
         self._logger = logging.getLogger(self.__class__.__name__)
         self._port = connections.Connection.getConnection('arduino', port, speed)
         self._portLock = connections.Connection.getLock(self._port)
         self._filterLength = 10
+        self._chunkSize = chunkSize
+        self._buffer = bytearray()
+        self._consumed = 0
         self._dataLock = RLock()
-        self._data = []
+        self._frames = 0
+        self._droppedFrames = 0
+        self._skippedBytes = 0
+        self._bytesRead = 0
+        self._startTime = monotonic()
         self._packetLength = self._getPacketLength()
+        self._frameFormat = struct.Struct('>%sH' % (self._packetLength // 2))
         (self._offsets, self._postscalers) = self._getFilter()
+        self._values = array('d', [0.0] * len(self._offsets))
+        self._hasData = False
         self._run = True
         self._sensorPoller = spawn(self._pollSensors)
-        self._sensorPoller.start()
 
     def __del__(self):
         self._run = False
         self._sensorPoller.join()
 
-    def _getPacketLength(self):
+    def _readChunk(self):
+        """ Append whatever is waiting on the port (at least one byte, at most chunkSize) to the buffer """
         with self._portLock:
-            while ord(self._port.read()) & 0xFF != 0xAB:
-                pass
+            size = min(max(self._port.inWaiting(), 1), self._chunkSize)
+            data = self._port.read(size)
+        self._buffer.extend(data)
+        self._bytesRead += len(data)
+        return len(data)
 
-            c = 0
-            while ord(self._port.read()) & 0xFF != 0xAB:
-                c += 1
-        return c
+    def _getPacketLength(self):
+        while True:
+            start = self._buffer.find(chr(self._syncByte))
+            if start >= 0:
+                end = self._buffer.find(chr(self._syncByte), start + 1)
+                if end >= 0:
+                    del self._buffer[:end]
+                    return end - start - 1
+            self._readChunk()
+
+    def _parseFrames(self, limit=None):
+        """
+        Consume complete frames from the buffer, all of them unless a limit is given
+        returns the offset of the newest complete frame in the buffer, or -1 if none were found
+        the buffer is compacted on the next call, so the offset is only valid until then
+        """
+        frameSize = self._packetLength + 1
+        sync = chr(self._syncByte)
+        buf = self._buffer
+        pos = 0
+        latest = -1
+        frames = self._frames
+        while limit is None or self._frames - frames < limit:
+            start = buf.find(sync, pos)
+            if start < 0:
+                self._skippedBytes += len(buf) - pos
+                pos = len(buf)
+                break
+            if start > pos:
+                self._skippedBytes += start - pos
+                self._logger.info("Skipped %s bytes to start, packet length = %s" % (start - pos, self._packetLength))
+            if start + frameSize > len(buf):
+                pos = start
+                break
+            if latest >= 0:
+                self._droppedFrames += 1
+            latest = start + 1
+            self._frames += 1
+            pos = start + frameSize
+
+        self._consumed = pos
+        return latest
+
+    def _compact(self):
+        del self._buffer[:self._consumed]
+        self._consumed = 0
 
     def _getNextPacket(self):
-        # Discard data to the start of the packet
-        with self._portLock:
-            byte = ord(self._port.read()) & 0xFF
-            c = 0
-            while byte != 0xAB:
-                byte = ord(self._port.read()) & 0xFF
-                c += 1
-
-            if c > 0:
-                self._logger.info("Skipped %s bytes to start, packet length = %s" % (c, self._packetLength))
-
-            packetRaw = self._port.read(self._packetLength)
-        packet = [1023 - (ord(packetRaw[i]) * 256) - ord(packetRaw[i + 1]) for i in range(0, len(packetRaw), 2)]
-        return packet
+        """ Block until a complete frame is available and return its raw sensor values """
+        while True:
+            offset = self._parseFrames(1)
+            if offset >= 0:
+                packet = self._frameFormat.unpack_from(self._buffer, offset)
+                self._compact()
+                return [self._maxValue - v for v in packet]
+            self._compact()
+            self._readChunk()
 
     def _getFilter(self):
         data_values = []
@@ -68,7 +129,7 @@ class FSR_Arduino(object):
     def _calculatePostScaler(self, offsets):
         postscaler = []
         for offset in offsets:
-            postscaler.append(1023 / (1023 - min(offset, 1022)))
+            postscaler.append(float(self._maxValue) / (self._maxValue - min(offset, self._maxValue - 1)))
         return postscaler
 
     """ calculate the offset once we have the data on the data """
@@ -86,25 +147,55 @@ class FSR_Arduino(object):
 
     def getValue(self, id_):
         with self._dataLock:
-            if id_ < len(self._data):
-                data = self._data[id_]
+            if self._hasData and id_ < len(self._values):
+                return self._values[id_]
             else:
                 self._logger.debug("FSR id %s out of range", id_)
                 return None
 
-        return self._postscalers[id_] * (data - self._offsets[id_])
+    def getStats(self):
+        """ returns the parser throughput since the sensor was created """
+        elapsed = max(monotonic() - self._startTime, 1e-6)
+        return {
+                'frames': self._frames,
+                'droppedFrames': self._droppedFrames,
+                'skippedBytes': self._skippedBytes,
+                'bytes': self._bytesRead,
+                'framesPerSecond': self._frames / elapsed,
+                'bytesPerSecond': self._bytesRead / elapsed,
+                }
+
+    def _publish(self, offset):
+        packet = self._frameFormat.unpack_from(self._buffer, offset)
+        maxValue = self._maxValue
+        # a frame holds a handful of values, a plain pass is cheaper than the numpy call overhead
+        values = array('d', [p * (maxValue - v - o) for (v, o, p) in zip(packet, self._offsets, self._postscalers)])
+        with self._dataLock:
+            self._values[:len(values)] = values
+            self._hasData = True
 
     def _pollSensors(self):
         while self._run:
-            data = self._getNextPacket()
-            with self._dataLock:
-                self._data = data
+            try:
+                if not self._readChunk():
+                    # nothing arrived before the port timeout, give other greenlets a chance
+                    sleep(0)
+                    continue
+            except Exception as e:
+                self._logger.warning(e, exc_info=True)
+                sleep(0.1)
+                continue
+            offset = self._parseFrames()
+            if offset >= 0:
+                self._publish(offset)
+            self._compact()
 
 
 class FSR_MiniMaestro(object):
     sensorType = 'FSR_MiniMaestro'
 
     def __init__(self, sensor, config):
+        self._logger = logging.getLogger(self.__class__.__name__)
         port = config.port
         self._port = port
         speed = config.portSpeed
@@ -117,16 +208,10 @@ class FSR_MiniMaestro(object):
         self._numSamples = sensor.extraData.get('numSamples', 10)
         conn = connections.Connection.getConnection('minimaestro', port, speed)
         self._poller = SensorPoller.getPoller(conn)
-
+        self._poller.addId(self._externalId)
 
     def getCurrentValue(self):
-        hist = self._poller.getValues(self._externalId)
-
-        if hist:
-            samples = hist[-1 * min(len(hist), self._numSamples):]
-            return float(sum(samples)) / len(samples)
-        else:
-            return None
+        return self._poller.getValue(self._externalId, smoothing=self._numSamples)
 
 #TODO: Temporary hack until I can modify the robot.xml to support multiple sensors of the same type
 # on different ports
@@ -13,8 +13,8 @@ class HumanLocationSensor(object):
         # TODO: Don't hard code this
         self._userName = sensor.extraData.get('userName', None)
         self._locPart = sensor.extraData.get('externalId', None)
-        self._ds = StorageFactory.getNewSession()
-        user = self._ds.query(User.id).filter(User.name == self._userName).first()
+        with StorageFactory.sessionScope(commit=False) as ds:
+            user = ds.query(User.id).filter(User.name == self._userName).first()
         if user:
             self._userId, = user
         else:
@@ -25,7 +25,9 @@ class HumanLocationSensor(object):
         if self._userId == None:
             return None
 
-        rawValue = self._ds.query(User.locX, User.locY, User.locTheta).filter(User.id == self._userId).first()
+        # short lived session, a long held one would never see the location updates
+        with StorageFactory.sessionScope(commit=False) as ds:
+            rawValue = ds.query(User.locX, User.locY, User.locTheta).filter(User.id == self._userId).first()
 
         if rawValue:
             (locX, locY, locTheta) = rawValue
@@ -3,32 +3,93 @@ import os
 import sys
 import inspect
 import logging
+import math
 import random
+import ctypes
+import thread
+from multiprocessing import Value
+from array import array
 from gevent.lock import RLock
-from gevent import Greenlet
-from collections import deque
-from datetime import datetime
+from robotActionController.Data.configSnapshot import ConfigSnapshot
+from robotActionController.Data.configWatcher import ConfigWatcher
+from gevent import Greenlet, spawn
 from gevent import sleep
+from gevent.event import AsyncResult
 from robotActionController import connections
+from robotActionController.clock import monotonic
+from robotActionController.simulation import SnapshotStore
+from robotActionController.Processor.comparison import compileComparison
 
 __all__ = ['SensorInterface', 'SensorPoller']
 
 
 _modulesCache = {}
 
+class _History(object):
+    """Fixed size ring buffer of float samples with O(1) append"""
+
+    def __init__(self, size):
+        self._values = array('d', [0.0] * size)
+        self._size = size
+        self._head = 0
+        self._count = 0
+        self.samples = 0
+        self.lastSample = None
+        self.rate = None
+
+    def __len__(self):
+        return self._count
+
+    def append(self, value, timestamp):
+        self._values[self._head] = value
+        self._head = (self._head + 1) % self._size
+        self._count = min(self._count + 1, self._size)
+        self.samples += 1
+        if self.lastSample != None and timestamp > self.lastSample:
+            # exponentially weighted achieved sample rate
+            rate = 1.0 / (timestamp - self.lastSample)
+            self.rate = rate if self.rate == None else self.rate * 0.9 + rate * 0.1
+        self.lastSample = timestamp
+
+    def last(self):
+        return self._values[(self._head - 1) % self._size]
+
+    def window(self, count=None):
+        """the newest count samples (all if None), oldest first"""
+        count = self._count if count == None else min(count, self._count)
+        start = (self._head - count) % self._size
+        if start + count <= self._size:
+            return self._values[start:start + count]
+        return self._values[start:] + self._values[:(start + count) % self._size]
+
+    def mean(self, count=None):
+        window = self.window(count)
+        return sum(window) / len(window)
+
+    def median(self, count=None):
+        window = sorted(self.window(count))
+        mid = len(window) // 2
+        if len(window) % 2:
+            return window[mid]
+        return (window[mid - 1] + window[mid]) / 2.0
+
+
 class SensorPoller(Greenlet):
 
     __pollers = {}
     __pollerLock = RLock()
 
-    def __init__(self, connection, rate=20, maxHistory=60, ids=[]):
+    def __init__(self, connection, rate=20, maxHistory=60, ids=[], batch=None):
         """
         @param connection: connection object to use, must support getPosition(id)
         @param rate: rate of the polling loop in Hz
         @param maxHistory: size of the history for each sensor
         @param ids: the initial id set to poll
+        @param batch: poll all ids with one getPositions(ids) call per loop, defaults to
+                      True when the connection supports it
         """
         super(SensorPoller, self).__init__()
+        self._logger = logging.getLogger(self.__class__.__name__)
         self.daemon = True
         self._conn = connection
         self._portLock = connections.Connection.getLock(connection)
@@ -37,6 +98,11 @@ class SensorPoller(Greenlet):
         self._maxHistory = maxHistory
         self._sensors = {}
         self._threadLock = RLock()
+        self._loops = 0
+        self._overruns = 0
+        if batch == None:
+            batch = hasattr(connection, 'getPositions')
+        self._batch = batch
         map(self.addId, ids)
 
     @staticmethod
@@ -59,60 +125,103 @@ class SensorPoller(Greenlet):
 
     def addId(self, sid):
         with self._threadLock:
-            if id not in self._sensors:
-                self._sensors[sid] = deque(maxlen=self._maxHistory)
+            if sid not in self._sensors:
+                self._sensors[sid] = _History(self._maxHistory)
 
-    def getValue(self, sid, default=None, smoothing=1):
+    def getValue(self, sid, default=None, smoothing=1, method='mean'):
+        """
+        @param smoothing: number of the newest samples to combine
+        @param method: 'mean' or 'median' of the smoothed samples
+        """
         with self._threadLock:
-            if id in self._sensors:
-                if self._sensors[sid] != None:
-                    if smoothing > 1:
-                        vals = list(self._sensors[sid])[:-smoothing]
-                        return sum(vals) / float(len(vals))
-                    else:
-                        return self._sensors[sid][-1]
-                else:
+            if sid in self._sensors:
+                hist = self._sensors[sid]
+                if not len(hist):
                     return default
+                elif smoothing > 1:
+                    return hist.median(smoothing) if method == 'median' else hist.mean(smoothing)
+                else:
+                    return hist.last()
             else:
                 raise ValueError("Sensor %s is not tracked" % sid)
 
     def getValues(self, sid, default=None):
         with self._threadLock:
-            if id in self._sensors:
-                return list(self._sensors[sid]) if self._sensors[sid] else default
+            if sid in self._sensors:
+                hist = self._sensors[sid]
+                return hist.window().tolist() if len(hist) else default
             else:
                 raise ValueError("Sensor %s is not tracked" % sid)
 
+    def getStats(self):
+        """loop counters and the achieved sample rate (Hz) of each sensor"""
+        with self._threadLock:
+            return {
+                    'rate': self._rate,
+                    'loops': self._loops,
+                    'overruns': self._overruns,
+                    'sensors': dict([(sid, {'samples': h.samples, 'rate': h.rate}) for (sid, h) in self._sensors.iteritems()]),
+                    }
+
+    def _store(self, sid, hist, val):
+        self._logger.log(1, "Got value for sensor %s: %s" % (sid, val))
+        if val < 0:
+            # maestro/herkulex specific, might need to look into a general 'error_value' param
+            return
+
+        with self._threadLock:
+            hist.append(val, monotonic())
+
+    def _pollEach(self, sensors):
+        for (sid, hist) in sensors:
+            if not self._run:
+                break
+            try:
+                with self._portLock:
+                    val = self._conn.getPosition(sid)
+            except Exception as e:
+                self._logger.warning(e, exc_info=True)
+                continue
+
+            self._store(sid, hist, val)
+
+    def _pollBatch(self, sensors):
+        try:
+            with self._portLock:
+                vals = self._conn.getPositions([sid for (sid, _) in sensors])
+        except Exception as e:
+            self._logger.warning(e, exc_info=True)
+            return
+
+        for ((sid, hist), val) in zip(sensors, vals):
+            self._store(sid, hist, val)
+
     def _run(self):
         self._run = True
+        nextLoop = monotonic()
         while self._run:
             with self._threadLock:
                 sensors = self._sensors.items()
 
             if not sensors:
                 sleep(0.1)
+                nextLoop = monotonic()
                 continue
 
-            startTime = datetime.utcnow()
-            for (sid, hist) in sensors:
-                if not self._run:
-                    break
-                try:
-                    with self._portLock:
-                        val = self._conn.getPosition(sid)
-                    self._logger.log(1, "Got value for sensor %s: %s" % sid, val)
-                except Exception as e:
-                    self._logger.warning(e, exc_info=True)
-                    continue
-
-                if val < 0:
-                    # maestro/herkulex specific, might need to look into a general 'error_value' param
-                    continue
-
-                hist.append(val)
+            if self._batch:
+                self._pollBatch(sensors)
+            else:
+                self._pollEach(sensors)
 
-            sTime = (datetime.utcnow() - startTime).total_seconds() - self._loopTime
-            sleep(min(sTime, 0))
+            self._loops += 1
+            nextLoop += self._loopTime
+            delay = nextLoop - monotonic()
+            if delay < 0:
+                # fell behind, start a fresh schedule rather than trying to catch up
+                self._overruns += 1
+                nextLoop = monotonic()
+                delay = 0
+            sleep(delay)
 
 
 def loadModules(path=None):
@@ -161,6 +270,8 @@ class SensorInterface(object):
     _globalLock = RLock()
     _interfaces = {}
     disconnected = False
+    configTables = ['Sensor', 'RobotSensor', 'ExternalSensor', 'SensorModel', 'SensorConfig', 'SensorValueType',
+                    'DiscreteValueType', 'ContinuousValueType', 'Robot']
 
     """have to do it this way to get around circular referencing in the parser"""
     @staticmethod
@@ -176,8 +287,9 @@ class SensorInterface(object):
 
     @staticmethod
     def getSensorInterface(sensor):
+        sensor = ConfigSnapshot.resolve(sensor)
         with SensorInterface._globalLock:
-            if sensor not in SensorInterface._interfaces:
+            if sensor.id not in SensorInterface._interfaces:
                 if not SensorInterface.disconnected:
                     try:
                         servoInt = SensorInterface._getInterfaceClasses()[sensor.type]
@@ -189,20 +301,46 @@ class SensorInterface(object):
                 else:
                     servoInt = Dummy(sensor)
 
-                SensorInterface._interfaces[sensor] = servoInt
+                SensorInterface._interfaces[sensor.id] = servoInt
+
+            return SensorInterface._interfaces[sensor.id]
+
+    @staticmethod
+    def clearCache(changedTables=None):
+        """drop the cached interfaces, they are rebuilt from the current configuration on next use"""
+        with SensorInterface._globalLock:
+            interfaces = SensorInterface._interfaces.values()
+            SensorInterface._interfaces.clear()
 
-            return SensorInterface._interfaces[sensor]
+        # the background refresh of a dropped interface would otherwise poll the sensor forever
+        for sensorInt in interfaces:
+            if isinstance(sensorInt, SensorInterface):
+                sensorInt.stopRefresh()
 
     def __init__(self, sensor):
         # sensor properties
         self._sensorName = sensor.name
 
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        # values are cached for cacheTTL seconds, with cacheRefresh a greenlet keeps the cache warm
+        extraData = sensor.extraData or {}
+        self._maxAge = float(extraData.get('cacheTTL', 0))
+        self._autoRefresh = bool(extraData.get('cacheRefresh', False)) and self._maxAge > 0
+        self._cacheLock = RLock()
+        self._cached = None
+        self._cachedAt = None
+        self._pending = None
+        self._pendingThread = None
+        self._refresher = None
+
         if sensor.onStateComparison == None or sensor.onStateValue == None:
             self._onState = None
         else:
-            self._onState = sensor.onStateComparison + sensor.onStateValue
-
-        self._logger = logging.getLogger(self.__class__.__name__)
+            try:
+                self._onState = compileComparison(sensor.onStateComparison, sensor.onStateValue)
+            except ValueError as e:
+                raise ValueError("Sensor %s has an invalid onState: %s" % (sensor.name, e))
 
     @property
     def sensorName(self):
@@ -210,68 +348,142 @@ class SensorInterface(object):
 
     @property
     def onState(self):
+        """compiled onState comparison, onState(value) -> bool"""
         return self._onState
 
-    def getCurrentValue(self):
+    def getCurrentValue(self, maxAge=None):
+        """
+        @param maxAge: oldest cached value in seconds that is acceptable, defaults to the cacheTTL of the sensor
+        Concurrent reads of the same sensor share a single hardware read
+        """
+        if self._autoRefresh and self._refresher == None:
+            self.startRefresh()
+
+        maxAge = self._maxAge if maxAge == None else maxAge
+        with self._cacheLock:
+            if maxAge > 0 and self._cachedAt != None and monotonic() - self._cachedAt <= maxAge:
+                return self._cached
+
+            pending = self._pending
+            if pending != None and self._pendingThread == thread.get_ident():
+                waiter = pending
+            else:
+                waiter = None
+                pending = self._pending = AsyncResult()
+                self._pendingThread = thread.get_ident()
+
+        if waiter != None:
+            return waiter.get()
+
+        try:
+            value = self._readValue()
+        except Exception as e:
+            pending.set_exception(e)
+            raise
+        else:
+            self._store(value)
+            pending.set(value)
+            return value
+        finally:
+            with self._cacheLock:
+                if self._pending is pending:
+                    self._pending = None
+
+    def _store(self, value):
+        with self._cacheLock:
+            self._cached = value
+            self._cachedAt = monotonic()
+
+    def invalidate(self):
+        with self._cacheLock:
+            self._cachedAt = None
+
+    def startRefresh(self, interval=None):
+        """refresh the cached value every interval seconds (the cacheTTL by default) in the background"""
+        interval = interval or self._maxAge
+        if interval <= 0:
+            raise ValueError("Sensor %s has no refresh interval" % self._sensorName)
+        if self._refresher == None:
+            self._refresher = spawn(self._refresh, interval)
+
+    def stopRefresh(self):
+        if self._refresher != None:
+            self._refresher.kill()
+            self._refresher = None
+
+    def _refresh(self, interval):
+        while True:
+            try:
+                self.getCurrentValue(maxAge=0)
+            except Exception:
+                self._logger.warning("Error refreshing sensor %s" % self._sensorName, exc_info=True)
+            sleep(interval)
+
+    def _readValue(self):
         return None
 
 
 class Dummy(SensorInterface):
+    """
+    Simulated sensor, values live in memory and are snapshotted to disk periodically
+    extraData options:
+        latency: seconds each read takes
+        sharedMemory: keep the value in a multiprocessing.Value so driver processes can inject values
+    """
 
     sensor_values = {}
+    snapshotInterval = 5
 
     def __init__(self, sensor):
-        from multiprocessing import Value
-        import ctypes
         super(Dummy, self).__init__(sensor)
         self._sensorId = sensor.id
+        extraData = sensor.extraData or {}
+        self._latency = float(extraData.get('latency', 0))
+        self._shared = bool(extraData.get('sharedMemory', False))
 
         basePath = os.path.dirname(os.path.abspath(__file__))
-        basePath = os.path.join(basePath, 'sensorData')
-        if not os.path.exists(basePath):
-            os.makedirs(basePath)
-        fileName = 'dummySensorData_%s' % self._sensorId
-        self._fileName = os.path.join(basePath, fileName)
+        fileName = os.path.join(basePath, 'sensorData', 'dummySensorData')
+        self._snapshot = SnapshotStore.getStore(fileName, Dummy.snapshotInterval)
 
-        if sensor.id not in Dummy.sensor_values:
-            Dummy.sensor_values[sensor.id] = Value(ctypes.c_float)
+        if self._shared:
+            Dummy.getSharedValue(self._sensorId)
 
-        value = self._readData()
+        value = self._snapshot.get(self._sensorId)
         if value != None:
             self.setCurrentValue(value)
 
-    def __del__(self):
-        self.writeData(Dummy.sensor_values[self._sensorId].value)
+    @staticmethod
+    def getSharedValue(sensorId):
+        """
+        returns the multiprocessing.Value backing a sensor in shared memory mode, NaN when unset
+        create it before starting the driver processes so they inherit it
+        """
+        if sensorId not in Dummy.sensor_values:
+            Dummy.sensor_values[sensorId] = Value(ctypes.c_double, float('nan'))
+        return Dummy.sensor_values[sensorId]
 
     def setCurrentValue(self, value):
-        self._writeData(value)
+        if self._shared:
+            Dummy.sensor_values[self._sensorId].value = value
+        self._snapshot.set(self._sensorId, value)
+        self._store(value)
         self._logger.debug("%s Set value to: %s", self._sensorId, value)
 
-    def getCurrentValue(self):
-        val = self._readData()
+    def _readValue(self):
+        if self._latency:
+            sleep(self._latency)
+
+        if self._shared:
+            val = Dummy.sensor_values[self._sensorId].value
+            val = None if math.isnan(val) else val
+        else:
+            val = self._snapshot.get(self._sensorId)
+
         if val == None:
             return random.random()
         self._logger.log(1, "%s Got value: %s", self._sensorId, val)
         return val
 
-    def _readData(self):
-        import pickle
-        try:
-            f = open(self._fileName, 'r')
-            data = pickle.load(f)
-            return data['value']
-        except Exception:
-            pass
-
-    def _writeData(self, value):
-        import pickle
-        try:
-            data = {'value': value, 'name': self._sensor.name}
-            f = open(self._fileName, 'w')
-            pickle.dump(data, f)
-        except Exception:
-            pass
-
 
 class Robot(SensorInterface):
 
@@ -299,11 +511,11 @@ class Robot(SensorInterface):
 
         self._sensorInt = Robot._interfaceMap[sensor.model.name.lower()](sensor, config)
 
-    def getCurrentValue(self):
+    def _readValue(self):
         return self._sensorInt.getCurrentValue()
 
 
-def External(SensorInterface):
+class External(SensorInterface):
 
     _interfaceMap = None
 
@@ -323,6 +535,8 @@ def External(SensorInterface):
 
         self._sensorInt = External._interfaceMap[sensor.model.name.lower()](sensor, config)
 
-    def getCurrentValue(self):
+    def _readValue(self):
         return self._sensorInt.getCurrentValue()
 
+
+ConfigWatcher.register(SensorInterface.clearCache, SensorInterface.configTables)
@@ -27,6 +27,10 @@ class ButtonTrigger(TriggerInterface):
         self._disableActive = False
 
     def __del__(self):
+        self.close()
+
+    def close(self):
+        super(ButtonTrigger, self).close()
         try:
             ButtonTrigger.keyEvents.keyDownEvent -= self.handleKeyPress
             ButtonTrigger.keyEvents.keyUpEvent -= self.handleKeyRelease
@@ -43,7 +47,7 @@ class ButtonTrigger(TriggerInterface):
             logger.error("Trigger: %s has an unknown trigger type: %s" % (trigger.name, trigger.type))
             return None
 
-    def getActive(self):
+    def _evaluate(self, memo):
         active = self._active
         if self._disableActive:
             self._active = False
@@ -73,6 +77,8 @@ class ButtonTrigger(TriggerInterface):
         sleep(delayTime)
         if self._disableActive:
             self._active = False
+            if self._push:
+                self._update()
 
     def handleKeyRelease(self, sender, keyEventArg):
         released = self._formatKeyEvent(keyEventArg) in self._keybindings
@@ -88,5 +94,7 @@ class ButtonTrigger(TriggerInterface):
         if not self._active and pressed:
             self._disableActive = False
             self._active = True
+            if self._push:
+                self._update()
         if self._active:
             self._logger.debug("KeyEvent: %s, active: %s, keybindings: %s" % (keyEventArg, self._active, self._keybindings))
@@ -23,8 +23,23 @@ class CompoundTrigger(TriggerInterface):
             logger.error("Trigger: %s has an unknown trigger type: %s" % (trigger.name, trigger.type))
             return None
 
-    def getActive(self):
+    def _subscribe(self):
+        for i in self._interfaces:
+            i.enablePush()
+            i.changed += self._onInputChanged
+
+    def _unsubscribe(self):
+        for i in self._interfaces:
+            try:
+                i.changed -= self._onInputChanged
+            except ValueError:
+                pass
+
+    def _onInputChanged(self, sender, active):
+        self._update()
+
+    def _evaluate(self, memo):
         if self._requireAll:
-            return all([i.getActive() for i in self._interfaces])
+            return all(i.evaluate(memo) for i in self._interfaces)
         else:
-            return any([i.getActive() for i in self._interfaces])
+            return any(i.evaluate(memo) for i in self._interfaces)
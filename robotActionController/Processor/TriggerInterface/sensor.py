@@ -1,11 +1,17 @@
 from triggerInterface import TriggerInterface
+from robotActionController.Processor.SensorInterface.sensorInterface import SensorInterface
+from robotActionController.Processor.comparison import compileComparison
 from collections import namedtuple
 import logging
+from gevent.lock import RLock
 
 
 class SensorTrigger(TriggerInterface):
     supportedClass = 'SensorTrigger'
-    Runable = namedtuple('SensorTrigger', TriggerInterface.Runable._fields + ('sensorName', 'sensorValue', 'comparison', ))
+    Runable = namedtuple('SensorTrigger', TriggerInterface.Runable._fields + ('sensorName', 'sensorValue', 'comparison', 'compare', ))
+    _publishLock = RLock()
+    _values = {}
+    _subscribers = {}
 
     def __init__(self, trigger, robot, **kwargs):
         super(SensorTrigger, self).__init__(trigger, **kwargs)
@@ -15,36 +21,69 @@ class SensorTrigger(TriggerInterface):
             if not self._sensorInt:
                 raise ValueError('Unknown sensor %s on robot %s' % (trigger.sensorName, robot.name))
 
+            if trigger.compare == None and not self._sensorInt.onState:
+                raise ValueError("Cannot eval:: sensor %s, no onState set" % trigger.sensorName)
+
     def _getSensor(self, sensorName, robot):
-        sensors = [s for s in robot.sensors if s.sensorName == sensorName]
-        return sensors[0] if sensors else None
+        sensor = robot.getSensorByName(sensorName)
+        return SensorInterface.getSensorInterface(sensor) if sensor else None
+
+    @staticmethod
+    def publish(sensorName, value):
+        """
+        Publish a new sensor value, push mode triggers watching the sensor are re-evaluated once
+        and read the published value instead of querying the sensor themselves
+        """
+        with SensorTrigger._publishLock:
+            SensorTrigger._values[sensorName] = value
+            subscribers = list(SensorTrigger._subscribers.get(sensorName, ()))
+
+        for trigger in subscribers:
+            trigger._update()
+
+    def _subscribe(self):
+        with SensorTrigger._publishLock:
+            SensorTrigger._subscribers.setdefault(self._trigger.sensorName, []).append(self)
+
+    def _unsubscribe(self):
+        with SensorTrigger._publishLock:
+            subscribers = SensorTrigger._subscribers.get(self._trigger.sensorName, [])
+            if self in subscribers:
+                subscribers.remove(self)
+
+    def _getValue(self):
+        if self._push:
+            with SensorTrigger._publishLock:
+                if self._trigger.sensorName in SensorTrigger._values:
+                    return SensorTrigger._values[self._trigger.sensorName]
+        return self._sensorInt.getCurrentValue()
 
     @staticmethod
     def getRunable(trigger):
         if trigger.type == SensorTrigger.supportedClass:
-            return SensorTrigger.Runable(trigger.name, trigger.id, trigger.type, trigger.sensorName, trigger.sensorValue, trigger.comparison)
+            sensorValue = trigger.sensorValue or ''
+            if sensorValue.startswith('eval::'):
+                # sensorValue === eval::on || eval::off, compared against the onState of the sensor
+                if sensorValue[6:] not in ('on', 'off'):
+                    raise ValueError("Trigger: %s has an unknown sensor eval: %s" % (trigger.name, sensorValue[6:]))
+                compare = None
+            else:
+                try:
+                    compare = compileComparison(trigger.comparison, trigger.sensorValue)
+                except ValueError as e:
+                    raise ValueError("Trigger: %s has an invalid comparison: %s" % (trigger.name, e))
+            return SensorTrigger.Runable(trigger.name, trigger.id, trigger.type, trigger.sensorName, trigger.sensorValue, trigger.comparison, compare)
         else:
             logger = logging.getLogger(SensorTrigger.__name__)
             logger.error("Trigger: %s has an unknown trigger type: %s" % (trigger.name, trigger.type))
             return None
 
-    def getActive(self):
-        # Value is used in eval functions
-        value = self._sensorInt.getCurrentValue()
-        sensorValue = self._trigger.sensorValue
-        sensorCompare = self._trigger.comparison
-        if sensorValue.startswith('eval::'):
-            # sensorValue === eval::on || eval::off
-            if not self._sensorInt.onState:
-                self._logger.critical("Cannot eval:: sensor %s, no onState set" % self._trigger.sensorName)
-                return None
-            isOn = eval('%(value)s %(comp)s' % {'value': value, 'comp': self._sensorInt.onState})
-            if sensorValue[6:] == 'off':
-                return not isOn
-            elif sensorValue[6:] == 'on':
-                return isOn
-            else:
-                self._logger.critical("Unknown sensor eval: %s" % sensorValue[6:])
-                return None
-        else:
-            return eval('%(value) %(comp)s %(compVal)s' % {'value': value, 'comp': sensorCompare, 'compVal': sensorValue})
+    def _evaluate(self, memo):
+        value = self._getValue()
+        if self._trigger.compare != None:
+            return self._trigger.compare(value)
+
+        isOn = self._sensorInt.onState(value)
+        if self._trigger.sensorValue[6:] == 'off':
+            return not isOn
+        return isOn
@@ -3,6 +3,7 @@ from triggerInterface import TriggerInterface
 from collections import namedtuple
 import random
 import logging
+from gevent import spawn_later
 
 
 class TimeTrigger(TriggerInterface):
@@ -15,6 +16,7 @@ class TimeTrigger(TriggerInterface):
         self._lastActive = None
         self._lastChange = None
         self._ti = None
+        self._timer = None
 
     @property
     def _triggerInt(self):
@@ -39,12 +41,59 @@ class TimeTrigger(TriggerInterface):
             logger.error("Trigger: %s has an unknown trigger type: %s" % (trigger.name, trigger.type))
             return None
 
-    def getActive(self):
+    def _subscribe(self):
+        if self._triggerInt and self._triggerInt != self:
+            self._triggerInt.enablePush()
+            self._triggerInt.changed += self._onInputChanged
+        self._armTimer()
+
+    def _unsubscribe(self):
+        if self._ti:
+            try:
+                self._ti.changed -= self._onInputChanged
+            except ValueError:
+                pass
+        if self._timer:
+            self._timer.kill(block=False)
+            self._timer = None
+
+    def _onInputChanged(self, sender, active):
+        self._update()
+
+    def _onTimer(self):
+        self._timer = None
+        self._update()
+
+    def _update(self):
+        super(TimeTrigger, self)._update()
+        self._armTimer()
+
+    def _armTimer(self):
+        """schedule the next re-evaluation for when the time condition can next change"""
+        if self._timer:
+            self._timer.kill(block=False)
+            self._timer = None
+
+        if self._lastChange == None:
+            return
+
+        if self._triggerInt == self and self._state:
+            # self-referencing triggers pulse, reset straight after firing
+            delay = 0
+        else:
+            delay = (self._lastChange + self._time - datetime.now()).total_seconds()
+            if delay < 0:
+                return
+
+        # the loop clock can run slightly ahead of datetime, a short timer is re-armed on the next pass
+        self._timer = spawn_later(delay + 0.001, self._onTimer)
+
+    def _evaluate(self, memo):
         # triggers can be self-referencing
         if self._triggerInt == self:
             active = False
         elif self._triggerInt:
-            active = self._triggerInt.getActive()
+            active = self._triggerInt.evaluate(memo)
         else:
             #TODO: Error handling
             return False
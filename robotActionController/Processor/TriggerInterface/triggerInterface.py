@@ -1,6 +1,9 @@
 import logging
 from collections import namedtuple
 from gevent.lock import RLock
+from robotActionController.Processor.event import Event
+from robotActionController.Data.configWatcher import ConfigWatcher
+from robotActionController.Processor.SensorInterface.sensorInterface import SensorInterface
 
 __all__ = ['TriggerInterface', ]
 
@@ -12,7 +15,12 @@ class TriggerInterface(object):
     _servoInterfaces = {}
     _globalLock = RLock()
     _interfaces = {}
+    _generation = 0
     disconnected = False
+    # sensor triggers hold on to the sensor interfaces, they are dropped with them
+    configTables = ['Trigger', 'SensorTrigger', 'CompoundTrigger', 'TimeTrigger', 'ButtonTrigger', 'ButtonHotkey'] + SensorInterface.configTables
+
+    changed = Event('Trigger state changed event, only fired once push mode is enabled')
 
     """have to do it this way to get around circular referencing in the parser"""
     @staticmethod
@@ -52,6 +60,30 @@ class TriggerInterface(object):
 
             return TriggerInterface._interfaces[trigger.id]
 
+    @staticmethod
+    def clearCache(changedTables=None):
+        """
+        drop and close the cached interfaces, they are rebuilt from the current configuration on next use
+        holders of the dropped interfaces rebind once generation() has moved on, see TriggerProcessor
+        """
+        with TriggerInterface._globalLock:
+            interfaces = TriggerInterface._interfaces.values()
+            TriggerInterface._interfaces.clear()
+            TriggerInterface._generation += 1
+
+        for triggerInt in interfaces:
+            if triggerInt == None:
+                continue
+            try:
+                triggerInt.close()
+            except Exception:
+                logging.getLogger(TriggerInterface.__name__).warning("Error closing trigger interface %s" % triggerInt, exc_info=True)
+
+    @staticmethod
+    def generation():
+        """incremented every time the cached interfaces are dropped"""
+        return TriggerInterface._generation
+
     @staticmethod
     def getRunable(trigger):
         """
@@ -71,6 +103,60 @@ class TriggerInterface(object):
     def __init__(self, trigger, **kwargs):
         self._trigger = trigger
         self._logger = logging.getLogger(self.__class__.__name__)
+        self._push = False
+        self._state = None
 
-    def getActive(self):
+    def enablePush(self):
+        """
+        Switch the trigger to push mode, instead of being polled it subscribes to its inputs
+        and re-evaluates only when one of them changes, firing 'changed' on every state change
+        """
+        if self._push:
+            return
+        self._state = bool(self._evaluate({}))
+        self._push = True
+        self._subscribe()
+
+    def _subscribe(self):
+        """hook up to the inputs of the trigger, called once when push mode is enabled"""
+        pass
+
+    def close(self):
+        """leave push mode and unhook from the inputs, the interface is not used again"""
+        if self._push:
+            self._push = False
+            self._unsubscribe()
+
+    def _unsubscribe(self):
+        """undo _subscribe"""
+        pass
+
+    def _update(self):
+        """re-evaluate after an input changed"""
+        active = bool(self._evaluate({}))
+        if active != self._state:
+            self._state = active
+            self.changed(active)
+
+    def evaluate(self, memo=None):
+        """
+        Evaluate the trigger, sharing a memo between calls evaluates every trigger at most once
+        no matter how many compound or time triggers reference it
+        in push mode the state from the last input change is returned
+        """
+        if self._push:
+            return self._state
+        if memo == None:
+            return self._evaluate({})
+        if self not in memo:
+            memo[self] = self._evaluate(memo)
+        return memo[self]
+
+    def _evaluate(self, memo):
         return False
+
+    def getActive(self):
+        return self.evaluate()
+
+
+ConfigWatcher.register(TriggerInterface.clearCache, TriggerInterface.configTables)
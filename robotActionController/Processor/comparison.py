@@ -0,0 +1,63 @@
+import ast
+import operator
+from collections import namedtuple
+
+__all__ = ['Comparison', 'compileComparison', ]
+
+
+def _contains(value, container):
+    return value in container
+
+
+_operators = {
+              '==': operator.eq,
+              '=': operator.eq,
+              '!=': operator.ne,
+              '<>': operator.ne,
+              '<': operator.lt,
+              '<=': operator.le,
+              '>': operator.gt,
+              '>=': operator.ge,
+              'in': _contains,
+              }
+
+
+class Comparison(namedtuple('Comparison', ['symbol', 'function', 'value'])):
+    """A pre-parsed 'sensorValue <symbol> value' test, call it with the sensor value"""
+    __slots__ = ()
+
+    def __call__(self, sensorValue):
+        if sensorValue == None:
+            return False
+        return self.function(sensorValue, self.value)
+
+    def __str__(self):
+        return '%s %r' % (self.symbol, self.value)
+
+
+def _parseValue(value):
+    """Literals (numbers, quoted strings, lists...) are parsed, anything else is taken as a plain string"""
+    if not isinstance(value, basestring):
+        return value
+    try:
+        return ast.literal_eval(value.strip())
+    except (ValueError, SyntaxError):
+        return value.strip()
+
+
+def compileComparison(comparison, value):
+    """
+    Compile a config comparison into a Comparison
+    @param comparison: the operator, one of ==, =, !=, <>, <, <=, >, >=, in
+    @param value: the value to compare against, as stored in the config
+    raises ValueError for unknown operators or values that can not be compared
+    """
+    symbol = (comparison or '').strip()
+    if symbol not in _operators:
+        raise ValueError("Unknown comparison operator: '%s'" % comparison)
+
+    value = _parseValue(value)
+    if symbol == 'in' and not hasattr(value, '__contains__'):
+        raise ValueError("Comparison 'in' requires a collection, got: %r" % (value, ))
+
+    return Comparison(symbol, _operators[symbol], value)
@@ -1,6 +1,10 @@
 """credit: http://www.emptypage.jp/notes/pyevent.en.html"""
+import logging
+import threading
+from collections import deque, OrderedDict
+from gevent import spawn, sleep, get_hub
 
-__all__ = ['Event', ]
+__all__ = ['Event', 'QueuedSubscriber', ]
 
 
 class Event(object):
@@ -47,6 +51,18 @@ class EventHandler(object):
         self._getfunctionlist().remove(func)
         return self
 
+    def subscribe(self, func, **kwargs):
+        """Add func as a QueuedSubscriber, see QueuedSubscriber for the options
+        returns the subscriber, pass it to remove() to unsubscribe
+        """
+        subscriber = QueuedSubscriber(func, **kwargs)
+        self.add(subscriber)
+        return subscriber
+
+    def getStats(self):
+        """Queue metrics of the queued subscribers of this event"""
+        return [f.getStats() for f in self._getfunctionlist() if isinstance(f, QueuedSubscriber)]
+
     def fire(self, earg=None):
         """Fire event and call all handler functions
         You can call EventHandler object itself like e(earg) instead of
@@ -58,3 +74,122 @@ class EventHandler(object):
     __iadd__ = add
     __isub__ = remove
     __call__ = fire
+
+
+class QueuedSubscriber(object):
+    """
+    Event handler that queues events and delivers them from its own greenlet, so a slow
+    handler never blocks the firing greenlet or thread
+    Delivery happens on the hub of the thread that created the subscriber
+    """
+
+    def __init__(self, func, maxsize=100, policy='drop', key=None, batch=False, spawnEach=False):
+        """
+        @param func: handler, called as func(sender, earg), or func(sender, [earg, ...]) when batching
+        @param maxsize: maximum number of queued events, the oldest are dropped when full, None for unbounded
+        @param policy: 'drop' queues every event, 'merge' only keeps the latest event for each key
+        @param key: function(earg) -> key used by the merge policy
+        @param batch: deliver everything queued in one call instead of one call per event
+        @param spawnEach: run every delivery in its own greenlet, a slow or failing delivery then
+                          never holds up the next one
+        """
+        if policy not in ('drop', 'merge'):
+            raise ValueError("Unknown queue policy: %s" % policy)
+        if policy == 'merge' and key == None:
+            raise ValueError("The merge policy requires a key function")
+
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._func = func
+        self._maxsize = maxsize
+        self._key = key if policy == 'merge' else None
+        self._batch = batch
+        self._spawnEach = spawnEach
+        self._pending = OrderedDict() if self._key else deque()
+        self._lock = threading.Lock()
+        self._loop = get_hub().loop
+        self._scheduled = False
+        self.received = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.merged = 0
+        self.maxDepth = 0
+
+    def __call__(self, sender, earg):
+        with self._lock:
+            self.received += 1
+            if self._key:
+                k = self._key(earg)
+                if k in self._pending:
+                    self.merged += 1
+                self._pending[k] = (sender, earg)
+                if self._maxsize != None and len(self._pending) > self._maxsize:
+                    self._pending.popitem(last=False)
+                    self.dropped += 1
+            else:
+                self._pending.append((sender, earg))
+                if self._maxsize != None and len(self._pending) > self._maxsize:
+                    self._pending.popleft()
+                    self.dropped += 1
+
+            self.maxDepth = max(self.maxDepth, len(self._pending))
+            schedule = not self._scheduled
+            self._scheduled = True
+
+        if schedule:
+            # may be fired from another thread, start the delivery greenlet on our own hub
+            self._loop.run_callback_threadsafe(spawn, self._drain)
+
+    def _take(self):
+        with self._lock:
+            if not self._pending:
+                self._scheduled = False
+                return None
+
+            if self._batch:
+                items = self._pending.values() if self._key else list(self._pending)
+                self._pending.clear()
+            elif self._key:
+                items = [self._pending.popitem(last=False)[1]]
+            else:
+                items = [self._pending.popleft()]
+            return items
+
+    def _drain(self):
+        while True:
+            items = self._take()
+            if items == None:
+                return
+
+            if self._batch:
+                args = (items[-1][0], [earg for (_, earg) in items])
+            else:
+                args = items[0]
+
+            if self._spawnEach:
+                spawn(self._deliver, args)
+            else:
+                self._deliver(args)
+            self.delivered += len(items)
+            # let the producers and other subscribers run between deliveries
+            sleep(0)
+
+    def _deliver(self, args):
+        try:
+            self._func(*args)
+        except Exception:
+            self._logger.warning("Error in event handler %s" % self._func, exc_info=True)
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    def getStats(self):
+        return {
+                'handler': getattr(self._func, '__name__', repr(self._func)),
+                'depth': self.depth,
+                'maxDepth': self.maxDepth,
+                'received': self.received,
+                'delivered': self.delivered,
+                'dropped': self.dropped,
+                'merged': self.merged,
+                }
@@ -0,0 +1,129 @@
+import math
+import heapq
+import logging
+from itertools import count
+from gevent import spawn
+from gevent.event import Event as GEvent
+from gevent.pool import Pool
+from robotActionController.clock import monotonic
+
+__all__ = ['Scheduler', ]
+
+
+class _Job(object):
+    __slots__ = ('callback', 'interval', 'cancelled')
+
+    def __init__(self, callback, interval):
+        self.callback = callback
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler(object):
+    """
+    Runs periodic callbacks from a single greenlet, backed by a heap ordered by monotonic due time
+    A callback may return the delay in seconds until it should run next, or None to keep its interval
+    Due times are rounded up to the scheduler resolution so callbacks coalesce into shared wakeups,
+    all callbacks that are due are dispatched in one batch per wakeup.  The callbacks of a batch run
+    concurrently, a slow callback only delays its own next run
+    """
+
+    def __init__(self, name=None, resolution=0.005, concurrency=None):
+        """
+        @param name: name used for logging
+        @param resolution: granularity of the due times in seconds
+        @param concurrency: maximum number of callbacks running at once, None for no limit
+        """
+        self._logger = logging.getLogger(name or self.__class__.__name__)
+        self._resolution = resolution
+        self._heap = []
+        self._sequence = count()
+        self._wakeup = GEvent()
+        self._greenlet = None
+        self._pool = Pool(concurrency)
+        self.wakeups = 0
+        self.dispatched = 0
+
+    def schedule(self, callback, interval, delay=0):
+        """
+        @param callback: function to call, called without arguments
+        @param interval: default number of seconds between calls
+        @param delay: seconds until the first call
+        returns a job, call job.cancel() to stop it
+        """
+        job = _Job(callback, interval)
+        self._push(monotonic() + delay, job)
+        return job
+
+    def clear(self):
+        for (_, _, job) in self._heap:
+            job.cancel()
+        self._heap = []
+
+    def start(self):
+        if not self.running:
+            self._greenlet = spawn(self._run)
+
+    def stop(self):
+        if self._greenlet:
+            self._greenlet.kill()
+            self._greenlet = None
+        self._pool.kill()
+
+    @property
+    def running(self):
+        return self._greenlet != None and not self._greenlet.dead
+
+    def _push(self, due, job):
+        if self._resolution:
+            due = math.ceil(due / self._resolution) * self._resolution
+        entry = (due, next(self._sequence), job)
+        heapq.heappush(self._heap, entry)
+        if self._heap[0] is entry:
+            # new earliest job, wake the loop up to recompute its sleep
+            self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                self._wakeup.wait()
+                continue
+
+            now = monotonic()
+            delay = self._heap[0][0] - now
+            if delay > 0:
+                self._wakeup.wait(delay)
+                continue
+
+            self.wakeups += 1
+            heap = self._heap
+            batch = []
+            while heap and heap[0][0] <= now:
+                batch.append(heapq.heappop(heap))
+
+            for (due, _, job) in batch:
+                if not job.cancelled:
+                    # the job is only pushed back once its callback returns, it never runs twice at once
+                    self._pool.spawn(self._dispatch, due, job)
+
+    def _dispatch(self, due, job):
+        try:
+            nextDelay = job.callback()
+        except Exception:
+            self._logger.warning("Error running scheduled callback %s" % job.callback, exc_info=True)
+            nextDelay = None
+        self.dispatched += 1
+
+        if job.cancelled:
+            return
+        now = monotonic()
+        if nextDelay == None:
+            # keep to the original cadence unless we have fallen behind
+            nextDue = max(due + job.interval, now)
+        else:
+            nextDue = now + max(nextDelay, 0)
+        self._push(nextDue, job)
@@ -1,12 +1,16 @@
 import logging
-from datetime import datetime, timedelta
+import numpy
+from datetime import timedelta
 from collections import namedtuple
 from SensorInterface.sensorInterface import SensorInterface
 
-from gevent import Greenlet, sleep
+from gevent.pool import Pool
 from gevent.queue import Queue
 from threading import Thread
 from robotActionController.Processor.event import Event
+from robotActionController.Processor.scheduler import Scheduler
+from robotActionController.clock import monotonic, seconds
+from robotActionController.Data.configSnapshot import ConfigSnapshot
 
 
 __all__ = ['SensorProcessor', ]
@@ -20,24 +24,25 @@ class SensorProcessor(Thread):
 
     def __init__(self, sensors, maxUpdateInterval=None, maxPollRate=None):
         super(SensorProcessor, self).__init__(name=self.__class__.__name__)
-        self._handlers = []
+        self._handler = None
         self._updateInterval = maxUpdateInterval
         self._pollRate = maxPollRate
         self._sensors = set()
         for sensor in sensors:
+            sensor = ConfigSnapshot.resolve(sensor)
             config = [c for c in sensor.robot.sensorConfigs if c.model == sensor.model]
             if config and config[0].type == 'active':
-                self._sensors.add(_SensorHandler.getRunableSensor(sensor))
+                self._sensors.add(_SensorBank.getRunableSensor(sensor))
         self._stop = True
 
     def run(self):
         self._queue = Queue()
-        
-        for sensor in self._sensors:
-            handler = _SensorHandler(sensor, self._queue.put_nowait, self._updateInterval, self._pollRate)
-            self._handlers.append(handler)
+        # one scheduler greenlet polls every sensor, created here so it lives on this thread's hub
+        scheduler = Scheduler('SensorScheduler')
 
-        map(lambda h: h.start(), self._handlers)
+        self._handler = _SensorBank(self._sensors, self._queue.put_nowait, self._updateInterval, self._pollRate)
+        self._handler.start(scheduler)
+        scheduler.start()
 
         self._stop = False
         while not self._stop:
@@ -48,8 +53,9 @@ class SensorProcessor(Thread):
             if sensorData == StopIteration:
                 break
             self.newSensorData(sensorData)
-            
-        map(lambda h: h.kill(), self._handlers)
+
+        self._handler.kill()
+        scheduler.stop()
 
     def stop(self):
         self._stop = True
@@ -58,83 +64,171 @@ class SensorProcessor(Thread):
         self.stop()
 
 
-class _SensorHandler(Greenlet):
-    Sensor = namedtuple("Sensor", ['id', 'name', 'resolution', 'minValue', 'maxValue', 'interface'])
+def _float(value):
+    return numpy.nan if value == None else float(value)
+
 
-    def __init__(self, sensor, updateEvent, maxUpdateInterval=None, maxPollRate=None):
-        super(_SensorHandler, self).__init__()
+class _SensorBank(object):
+    """
+    Polls all active sensors once per tick and processes the samples as arrays
+    clamping, filtering, rounding, normalisation and change detection are done in one vectorised pass
+    and an update event is raised only for the sensors that changed
+    Sensors can be smoothed with extraData {'filter': 'ema', 'alpha': 0.3} or {'filter': 'median', 'window': 5}
+    """
+    Sensor = namedtuple("Sensor", ['id', 'name', 'resolution', 'minValue', 'maxValue', 'interface', 'filter', 'filterParam'])
+
+    def __init__(self, sensors, updateEvent, maxUpdateInterval=None, maxPollRate=None):
         self._logger = logging.getLogger(self.__class__.__name__)
-        if not isinstance(sensor, _SensorHandler.Sensor):
-            sensor = _SensorHandler.getRunable(sensor)
-        self._sensor = sensor
-        self._maxUpdateInterval = maxUpdateInterval
-        self._maxPollRate = maxPollRate or timedelta(milliseconds=100)
+        self._sensors = [s if isinstance(s, _SensorBank.Sensor) else _SensorBank.getRunableSensor(s) for s in sensors]
+        self._maxUpdateInterval = seconds(maxUpdateInterval) or 0
+        self._maxPollRate = seconds(maxPollRate or timedelta(milliseconds=100))
         self._updateEvent = updateEvent
-        self._stop = False
+        self._job = None
+        self._pool = Pool()
+
+        self._indexes = []
+        for sensor in self._sensors:
+            sensorIndex = None
+            if ':' in sensor.name:
+                sensorIndex = sensor.name[sensor.name.rindex(':') + 1:]
+                sensorIndex = int(sensorIndex) if sensorIndex.isdigit() else None
+            self._indexes.append(sensorIndex)
+
+        count = len(self._sensors)
+        self._minValues = numpy.array([_float(s.minValue) for s in self._sensors], dtype=float)
+        self._maxValues = numpy.array([_float(s.maxValue) for s in self._sensors], dtype=float)
+        self._scales = numpy.power(10.0, [s.resolution for s in self._sensors])
+        # nan where the sensor has no range, the raw value is reported as the normal value instead
+        self._normFactors = 1.0 / (self._maxValues - self._minValues)
+        self._lastValues = numpy.full(count, numpy.nan)
+        self._lastUpdates = numpy.full(count, -numpy.inf)
+
+        self._emaAlphas = numpy.array([float(s.filterParam) if s.filter == 'ema' else 0.0 for s in self._sensors])
+        self._emaValues = numpy.full(count, numpy.nan)
+        self._emaIndexes = numpy.flatnonzero(self._emaAlphas)
+
+        # median filters are grouped by window length, each group keeps a (sensors x window) ring
+        self._medians = []
+        windows = set(int(s.filterParam) for s in self._sensors if s.filter == 'median')
+        for window in windows:
+            indexes = numpy.array([i for (i, s) in enumerate(self._sensors) if s.filter == 'median' and int(s.filterParam) == window])
+            self._medians.append([indexes, numpy.full((len(indexes), window), numpy.nan), 0])
 
     @staticmethod
     def getRunableSensor(sensor):
+        sensor = ConfigSnapshot.resolve(sensor)
         sensorId = sensor.id
         sensorName = sensor.name
         sensorResolution = sensor.extraData.get('resolution', 3)
         minValue = sensor.value_type.minValue if sensor.value_type.type == 'ContinuousValueType' else None
         maxValue = sensor.value_type.maxValue if sensor.value_type.type == 'ContinuousValueType' else None
         sensorInt = SensorInterface.getSensorInterface(sensor)
-        return _SensorHandler.Sensor(
+        sensorFilter = sensor.extraData.get('filter', None)
+        if sensorFilter == 'ema':
+            filterParam = float(sensor.extraData.get('alpha', 0.5))
+            if not 0 < filterParam <= 1:
+                raise ValueError("Sensor %s has an invalid ema alpha: %s" % (sensorName, filterParam))
+        elif sensorFilter == 'median':
+            filterParam = int(sensor.extraData.get('window', 5))
+            if filterParam < 1:
+                raise ValueError("Sensor %s has an invalid median window: %s" % (sensorName, filterParam))
+        elif sensorFilter == None:
+            filterParam = None
+        else:
+            raise ValueError("Sensor %s has an unknown filter: %s" % (sensorName, sensorFilter))
+
+        return _SensorBank.Sensor(
                                      id=sensorId, 
                                      name=sensorName, 
                                      resolution=sensorResolution, 
                                      minValue=minValue, 
                                      maxValue=maxValue, 
-                                     interface=sensorInt)
-
-    def _run(self):
-        last_update = datetime.utcnow()
-        last_value = None
-        sensorIndex = None
-        if ':' in self._sensor.name:
-            sensorIndex = self._sensor.name[self._sensor.name.rindex(':'):]
-            if sensorIndex.isdigit():
-                sensorIndex = int(sensorIndex)
-                
-        normFactor = 1 / (self._sensor.maxValue - self._sensor.minValue)
-
-        while not self._stop:
-            value = self._sensor.interface.getCurrentValue()
-            if sensorIndex != None:
+                                     interface=sensorInt,
+                                     filter=sensorFilter,
+                                     filterParam=filterParam)
+
+    def start(self, scheduler):
+        self._job = scheduler.schedule(self._poll, self._maxPollRate or self._maxUpdateInterval)
+
+    def kill(self):
+        if self._job:
+            self._job.cancel()
+            self._job = None
+        self._pool.kill()
+
+    def _read(self):
+        # the sensors are read concurrently, a slow read only holds up the tick by its own latency
+        return numpy.array(self._pool.map(self._readSensor, zip(self._sensors, self._indexes)), dtype=float)
+
+    def _readSensor(self, (sensor, sensorIndex)):
+        # a failing or malformed sensor only loses its own sample
+        try:
+            value = sensor.interface.getCurrentValue()
+            if sensorIndex != None and value != None:
                 if sensorIndex > len(value) - 1:
-                    self._logger.warn("Sensor %s expected to be at index %s.  Actual data length %s.  Data: %s" % (self._sensor.name, 
+                    self._logger.warn("Sensor %s expected to be at index %s.  Actual data length %s.  Data: %s" % (sensor.name, 
                                                                                                                    sensorIndex, 
                                                                                                                    len(value), value))
                     value = None
                 else:
                     value = value[sensorIndex]
-
-            if value != None:
-                if self._sensor.minValue != None and value < self._sensor.minValue:
-                    self._logger.debug("Sensor %s returned %s.  Value less than min value, changing to %s" % (self._sensor.name, 
-                                                                                                              value, 
-                                                                                                              self._sensor.minValue))
-                    value = self._sensor.minValue
-                if self._sensor.maxValue != None and value > self._sensor.maxValue:
-                    self._logger.debug("Sensor %s returned %s.  Value more than max value, changing to %s" % (self._sensor.name, 
-                                                                                                              value, 
-                                                                                                              self._sensor.maxValue))
-                    value = self._sensor.maxValue
-
-                value = round(value, self._sensor.resolution)
-                if value != last_value and (self._maxUpdateInterval == None or datetime.utcnow() - last_update >= self._maxUpdateInterval):
-                    last_update = datetime.utcnow()
-                    last_value = value
-                    normal = round((value - self._sensor.minValue) * normFactor, self._sensor.resolution)
-                    self._updateEvent(SensorDataEventArg(self._sensor.id, self._sensor.name, value, normal))
-
-            if self._maxUpdateInterval and self._maxPollRate:
-                sleepTime = max(self._maxUpdateInterval - (datetime.utcnow() - last_update), self._maxPollRate).total_seconds()
-            elif self._maxUpdateInterval:
-                sleepTime = self._maxUpdateInterval - (datetime.utcnow() - last_update)
-            elif self._maxPollRate:
-                sleepTime = 1.0 / self._maxPollRate
-            else:
-                sleepTime = 0
-            sleep(sleepTime)
+            return _float(value)
+        except Exception:
+            self._logger.warning("Error reading sensor %s" % sensor.name, exc_info=True)
+            return numpy.nan
+
+    def _filter(self, values):
+        if len(self._emaIndexes):
+            idx = self._emaIndexes
+            alpha = self._emaAlphas[idx]
+            previous = self._emaValues[idx]
+            current = values[idx]
+            smoothed = numpy.where(numpy.isnan(previous), current, alpha * current + (1 - alpha) * previous)
+            # keep the previous average over missing samples
+            smoothed = numpy.where(numpy.isnan(current), previous, smoothed)
+            self._emaValues[idx] = smoothed
+            values[idx] = smoothed
+
+        for median in self._medians:
+            (idx, history, pos) = median
+            history[:, pos] = values[idx]
+            median[2] = (pos + 1) % history.shape[1]
+            valid = ~numpy.all(numpy.isnan(history), axis=1)
+            if valid.any():
+                values[idx[valid]] = numpy.nanmedian(history[valid], axis=1)
+
+        return values
+
+    def _poll(self):
+        values = self._read()
+        # nan marks missing samples and limits, comparisons against it are expected
+        with numpy.errstate(invalid='ignore'):
+            self._process(values)
+
+    def _process(self, values):
+
+        if self._logger.isEnabledFor(logging.DEBUG):
+            outOfRange = numpy.flatnonzero((values < self._minValues) | (values > self._maxValues))
+            for i in outOfRange:
+                self._logger.debug("Sensor %s returned %s.  Value outside of range %s - %s, clamping" % (self._sensors[i].name, values[i], 
+                                                                                                         self._minValues[i], self._maxValues[i]))
+
+        # comparisons with nan are false, missing samples and missing limits are left alone
+        values = numpy.where(values < self._minValues, self._minValues, values)
+        values = numpy.where(values > self._maxValues, self._maxValues, values)
+        values = self._filter(values)
+        values = numpy.round(values * self._scales) / self._scales
+
+        now = monotonic()
+        changed = ~numpy.isnan(values) & (values != self._lastValues) & (now - self._lastUpdates >= self._maxUpdateInterval)
+        indexes = numpy.flatnonzero(changed)
+        if not len(indexes):
+            return
+
+        self._lastValues[indexes] = values[indexes]
+        self._lastUpdates[indexes] = now
+        normals = (values - self._minValues) * self._normFactors
+        normals = numpy.where(numpy.isnan(normals), values, numpy.round(normals * self._scales) / self._scales)
+        for i in indexes:
+            sensor = self._sensors[i]
+            self._updateEvent(SensorDataEventArg(sensor.id, sensor.name, float(values[i]), float(normals[i])))
@@ -1,11 +1,16 @@
 from TriggerInterface import TriggerInterface
+from TriggerInterface.sensor import SensorTrigger
 from robotActionController.ActionRunner import ActionManager
-from robotActionController.Processor.event import Event
-from datetime import datetime, timedelta
+from robotActionController.Data.configWatcher import ConfigWatcher
+from robotActionController.Data.storage import StorageFactory
+from robotActionController.Data.Model import Trigger
+from robotActionController.Processor.event import Event, QueuedSubscriber
+from robotActionController.Processor.scheduler import Scheduler
+from robotActionController.clock import monotonic, seconds
+from datetime import timedelta
 from collections import namedtuple
 import logging
-from gevent.greenlet import Greenlet
-from gevent import sleep, spawn
+from gevent import sleep
 
 
 __all__ = ['TriggerProcessor', ]
@@ -16,81 +21,223 @@ TriggerActivatedEventArg = namedtuple('TriggerActivatedEvent', ['trigger_id', 'v
 class TriggerProcessor(object):
     triggerActivated = Event('Trigger activated event')
 
-    def __init__(self, triggers, robot, maxUpdateInterval=None):
+    def __init__(self, triggers, robot, maxUpdateInterval=None, mode='poll', sensorProcessor=None):
+        """
+        @param mode: 'poll' polls every trigger from a shared scheduler, 'push' re-evaluates triggers
+                     only when one of their inputs changes and fires on the rising edge
+        @param sensorProcessor: in push mode, sensor updates from this processor are published to
+                                the sensor triggers instead of each trigger reading the sensor
+        """
+        if mode not in ('poll', 'push'):
+            raise ValueError("Unknown trigger processor mode: %s" % mode)
+
         self._logger = logging.getLogger(self.__class__.__name__)
         self._handlers = []
         self._robot = robot
         self._maxUpdateInterval = maxUpdateInterval
+        self._mode = mode
         self._running = False
+        self._sensorProcessor = sensorProcessor
+        self._scheduler = Scheduler('TriggerScheduler')
+        # activations are queued off the trigger evaluation and every activation is delivered in its
+        # own greenlet, none are dropped and a long handler never holds up the next activation
+        self._activations = QueuedSubscriber(self._fireActivated, maxsize=None, spawnEach=True)
+        self._sensorSubscriber = None
+        self._triggerIds = []
+        self._generation = TriggerInterface.generation()
 
         if len(triggers):
             self.setTriggers(triggers)
 
     def start(self):
+        if self._generation != TriggerInterface.generation():
+            # the trigger interfaces were dropped while stopped, setTriggers starts the processor again
+            self._reloadTriggers()
+            return
+
         self._running = True
+        ConfigWatcher.register(self._reloadTriggers, TriggerInterface.configTables + ActionManager.configTables)
         self._logger.info("Starting trigger handlers")
+        if self._mode == 'push' and self._sensorProcessor:
+            # the sensor processor fires from its own thread, the subscriber hands the updates over
+            # to this hub and only the latest value of each sensor is delivered
+            self._sensorSubscriber = self._sensorProcessor.newSensorData.subscribe(self._onSensorData,
+                                                                                   policy='merge',
+                                                                                   key=lambda e: e.sensor_name,
+                                                                                   batch=True)
         map(lambda h: h.start(), self._handlers)
+        self._scheduler.start()
         sleep(0)
 
     def stop(self):
         self._running = False
         self._logger.info("Stopping trigger handlers")
+        ConfigWatcher.unregister(self._reloadTriggers)
+        if self._sensorSubscriber:
+            try:
+                self._sensorProcessor.newSensorData -= self._sensorSubscriber
+            except ValueError:
+                pass
+            self._sensorSubscriber = None
         map(lambda h: h.kill(), self._handlers)
-
-    def setTriggers(self, triggers):
+        self._scheduler.stop()
+        self._scheduler.clear()
+
+    def _onSensorData(self, sender, sensorData):
+        for data in sensorData:
+            SensorTrigger.publish(data.sensor_name, data.value)
+
+    def _fireActivated(self, sender, earg):
+        self.triggerActivated(earg)
+
+    def _activated(self, earg):
+        self._activations(self, earg)
+
+    def getStats(self):
+        """queue metrics of the activation and sensor update queues"""
+        stats = {'activations': self._activations.getStats()}
+        if self._sensorSubscriber:
+            stats['sensorData'] = self._sensorSubscriber.getStats()
+        return stats
+
+    def _reloadTriggers(self, changedTables=None):
+        """rebuild the handlers from the current configuration of the triggers, registered with ConfigWatcher while running"""
+        self._logger.info("Configuration changed, reloading the trigger handlers")
+        with StorageFactory.sessionScope(commit=False) as session:
+            triggers = session.query(Trigger).filter(Trigger.id.in_(self._triggerIds)).all() if self._triggerIds else []
+            self.setTriggers(triggers, start=True)
+
+    def setTriggers(self, triggers, start=None):
+        """
+        @param start: start the processor once the handlers are built, None to keep it running only if it was
+        """
         running = self._running
         if running:
             self.stop()
+        if start == None:
+            start = running
 
+        self._triggerIds = [t.id for t in triggers]
+        self._generation = TriggerInterface.generation()
         self._handlers = []
+        handlerClass = _PushTriggerHandler if self._mode == 'push' else _TriggerHandler
+        pollRate = timedelta(seconds=seconds(self._maxUpdateInterval) / 10.0)
+        # all poll handlers share one memo per poll period, triggers referenced by several
+        # compound/time triggers are then only evaluated once per period
+        tick = _EvaluationTick(pollRate.total_seconds())
         for trigger in triggers:
             try:
-                handler = _TriggerHandler(trigger,
-                                          self.triggerActivated,
-                                          self._robot,
-                                          self._maxUpdateInterval,
-                                          timedelta(seconds=self._maxUpdateInterval.seconds / 10.0))
+                handler = handlerClass(trigger,
+                                       self._activated,
+                                       self._robot,
+                                       self._maxUpdateInterval,
+                                       pollRate,
+                                       tick,
+                                       self._scheduler)
                 self._handlers.append(handler)
             except Exception:
                 self._logger.warning("Error handling trigger! %s" % trigger, exc_info=True)
                 continue
 
         self._logger.debug("Handlers: %s" % self._handlers)
-        if running:
+        if start:
             self.start()
 
     def __del__(self):
         self.stop()
 
 
-class _TriggerHandler(Greenlet):
+class _EvaluationTick(object):
+    """Hands out the evaluation memo for the current tick, a fresh one once the tick has expired"""
+
+    def __init__(self, period):
+        self._period = period
+        self._expires = None
+        self._memo = {}
+
+    def memo(self):
+        now = monotonic()
+        if self._expires == None or now >= self._expires:
+            self._memo = {}
+            self._expires = now + self._period
+        return self._memo
+
 
-    def __init__(self, trigger, activatedEvent, robot, maxUpdateInterval=None, maxPollRate=None):
-        super(_TriggerHandler, self).__init__()
+class _TriggerHandler(object):
+    """Polls a trigger from the shared scheduler, fires the activated event on the rising edge"""
+
+    def __init__(self, trigger, activatedEvent, robot, maxUpdateInterval=None, maxPollRate=None, tick=None, scheduler=None):
         self._logger = logging.getLogger(self.__class__.__name__)
         self._triggerId = trigger.id
         self._triggerInt = TriggerInterface.getTriggerInterface(trigger, robot)
         self._action = ActionManager.getManager(robot).getRunable(trigger.action)
-        self._maxUpdateInterval = maxUpdateInterval
-        self._maxPollRate = maxPollRate or timedelta(milliseconds=100)
+        self._maxUpdateInterval = seconds(maxUpdateInterval)
+        self._maxPollRate = seconds(maxPollRate) or 0.1
+        self._activatedEvent = activatedEvent
+        self._tick = tick or _EvaluationTick(self._maxPollRate)
+        self._scheduler = scheduler
+        self._job = None
+
+    def start(self):
+        self._logger.debug("Handler for %s Starting" % self._triggerInt)
+        self._lastUpdate = monotonic()
+        self._lastValue = False
+        self._job = self._scheduler.schedule(self._poll, self._maxPollRate)
+
+    def kill(self):
+        if self._job:
+            self._job.cancel()
+            self._job = None
+
+    def _poll(self):
+        value = self._triggerInt.evaluate(self._tick.memo())
+        if value and value != self._lastValue and monotonic() - self._lastUpdate >= self._maxUpdateInterval:
+            self._lastUpdate = monotonic()
+            self._activatedEvent(TriggerActivatedEventArg(self._triggerId,
+                                                          value,
+                                                          self._action,
+                                                          self._triggerInt.supportedClass))
+            self._logger.debug("Activated trigger event for action %s" % (self._action.name, ))
+
+        self._lastValue = value
+        return max(self._maxUpdateInterval - (monotonic() - self._lastUpdate), self._maxPollRate)
+
+
+class _PushTriggerHandler(object):
+    """Fires the activated event on the rising edge of a push mode trigger, no greenlet of its own"""
+
+    def __init__(self, trigger, activatedEvent, robot, maxUpdateInterval=None, maxPollRate=None, tick=None, scheduler=None):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._triggerId = trigger.id
+        self._triggerInt = TriggerInterface.getTriggerInterface(trigger, robot)
+        self._action = ActionManager.getManager(robot).getRunable(trigger.action)
+        self._maxUpdateInterval = seconds(maxUpdateInterval)
         self._activatedEvent = activatedEvent
+        self._lastUpdate = None
+        self._running = False
 
-    def _run(self, *args, **kwargs):
-        last_update = datetime.utcnow()
-        last_value = False
+    def start(self):
         self._logger.debug("Handler for %s Starting" % self._triggerInt)
-        while True:
-            value = self._triggerInt.getActive()
-            if value and value != last_value and datetime.utcnow() - last_update >= self._maxUpdateInterval:
-                last_update = datetime.utcnow()
-                last_value = value
-                # Fire the handlers in thread to prevent long handlers from interrupting the loop
-                spawn(self._activatedEvent, TriggerActivatedEventArg(self._triggerId,
-                                                                    value,
-                                                                    self._action,
-                                                                    self._triggerInt.supportedClass))
-                self._logger.debug("Activated trigger event for action %s" % (self._action.name, ))
-
-            last_value = value
-            sleepTime = max(self._maxUpdateInterval - (datetime.utcnow() - last_update), self._maxPollRate).total_seconds()
-            sleep(sleepTime)
+        self._triggerInt.changed += self._onChanged
+        self._triggerInt.enablePush()
+        self._running = True
+
+    def kill(self):
+        if self._running:
+            self._triggerInt.changed -= self._onChanged
+        self._running = False
+
+    def _onChanged(self, sender, active):
+        if not self._running or not active:
+            return
+
+        now = monotonic()
+        if self._lastUpdate != None and now - self._lastUpdate < self._maxUpdateInterval:
+            return
+
+        self._lastUpdate = now
+        self._activatedEvent(TriggerActivatedEventArg(self._triggerId,
+                                                      active,
+                                                      self._action,
+                                                      self._triggerInt.supportedClass))
+        self._logger.debug("Activated trigger event for action %s" % (self._action.name, ))
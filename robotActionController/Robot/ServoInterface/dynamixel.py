@@ -32,7 +32,7 @@
 
 import sys
 from robotActionController import connections
-import time
+from gevent import sleep
 
 __all__ = ['ServoController', ]
 
@@ -63,6 +63,10 @@ ERRORS = {
          }
 
 
+class ChecksumError(ValueError):
+    pass
+
+
 def _Checksum(s):
     """Calculate the Dynamixel checksum (~(id_ + length + ...)) & 0xFF."""
     return (~sum(s)) & 0xFF
@@ -108,7 +112,7 @@ class Response:
         if len(data) == 0 or data[0] != 0xFF or data[1] != 0xFF:
             raise ValueError("Bad Header! ('%s')" % str(data))
         if _Checksum(data[2:-1]) != data[-1]:
-            raise ValueError("Checksum %s should be %s" % (_Checksum(data[2:-1]), data[-1]))
+            raise ChecksumError("Checksum %s should be %s" % (_Checksum(data[2:-1]), data[-1]))
         self.data = data
         self.id_, self.length = data[2:4]
         self.errors = []
@@ -176,16 +180,19 @@ class ServoController:
         """
         _VerifyID(id_)
         P = [id_, len(packet) + 1] + packet
-        with self.portLock:
+        with self.portLock, self.port.transaction():
             self.port.write("".join(map(chr, [0xFF, 0xFF] + P + [_Checksum(P)])))
             self.port.flushOutput()
-            time.sleep(0.05)
+            sleep(0.05)
 
             # Handle the read.
-            res = []
-            while self.port.inWaiting() > 0:
-                res.append(self.port.read())
-        return Response(map(ord, res)).Verify()
+            res = self.port.read(self.port.inWaiting())
+        try:
+            response = Response(map(ord, res))
+        except ChecksumError:
+            self.port.stats.addChecksumError()
+            raise
+        return response.Verify()
 
     # From here on out, you're looking at functions that really do something to
     # the servo itself. You should look at the user manual for details on what
@@ -361,7 +368,7 @@ class ServoController:
         Spinlock until the servo has stopped moving.
         """
         while self.Moving(id_):
-            time.sleep(0.001)
+            sleep(0.001)
 
 # Handy for interactive testing.
 if __name__ == "__main__":
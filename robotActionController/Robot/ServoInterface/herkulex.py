@@ -27,6 +27,7 @@ import sys
 import time
 import logging
 from gevent.lock import RLock
+from gevent import sleep
 from robotActionController import connections
 
 __all__ = ['HerkuleX', ]
@@ -361,11 +362,11 @@ class HerkuleX(object):
         sId = servoId or HerkuleX.BROADCAST_ID
 
         try:
-            time.sleep(0.100)
+            sleep(0.100)
             self.clearError(sId)  # clear error for servo
-            time.sleep(0.010)
+            sleep(0.010)
             self.torqueON(sId)  # torqueON for servo
-            time.sleep(0.010)
+            sleep(0.010)
         except:
             self._logger.error(sys.exc_info()[0])
 
@@ -1051,10 +1052,12 @@ class HerkuleX(object):
         chksum2 = self.checksum2(chksum1)  # Checksum2
 
         if chksum1 != buf[5]:
+            self.mPort.stats.addChecksumError()
             self._logger.warning("Invalid packet checksum1! %s", [str(x) for x in buf])
             # print [str(x) for x in buf]
             return False
         if chksum2 != buf[6]:
+            self.mPort.stats.addChecksumError()
             self._logger.warning("Invalid packet checksum2! %s", [str(x) for x in buf])
             # print [str(x) for x in buf]
             return False
@@ -1107,7 +1110,7 @@ class HerkuleX(object):
             self.mPort.write(packet)
 
     def sendDataForResult(self, buf):
-        with self.portLock:
+        with self.portLock, self.mPort.transaction():
             self.sendData(buf)
             ackDelay = HerkuleX.WAIT_TIME_BY_ACK / 1000.0
 
@@ -130,7 +130,7 @@ class minimaestro(object):
         cmd = minimaestro.uscRequest.REQUEST_GET_PARAMETER
         param = minimaestro.uscParameter.PARAMETER_SERIAL_DEVICE_NUMBER
         data = chr(cmd) + chr(param)
-        with self._lock:
+        with self._lock, self._conn.transaction():
             self._conn.write(data)
             byte = self._conn.read()
         if len(byte) == 0:
@@ -140,15 +140,14 @@ class minimaestro(object):
     def getPosition(self, id_):
         cmd = minimaestro.uscCommand.COMMAND_GET_POSITION
         data = chr(cmd) + chr(id_)
-        with self._lock:
+        with self._lock, self._conn.transaction():
             self._conn.write(data)
-            lowByte = self._conn.read()
-            highByte = self._conn.read()
+            response = self._conn.read(2)
 
-        if len(highByte) == 0 or len(lowByte) == 0:
+        if len(response) != 2:
             return -1
 
-        rawVal = (ord(highByte) << 8) + ord(lowByte)
+        rawVal = (ord(response[1]) << 8) + ord(response[0])
 
         """
         Note that the position value returned by this command is equal to four times the number displayed in the Position box
@@ -156,10 +155,40 @@ class minimaestro(object):
         """
         return rawVal / 4
 
+    def getPositions(self, ids):
+        """
+        Batched getPosition, all requests are written back to back and the replies collected in one read
+        The port is held for a single transaction so servo commands interleave between batches
+        returns the positions in the order of ids, -1 for any channel that did not reply
+        """
+        if not ids:
+            return []
+
+        cmd = chr(minimaestro.uscCommand.COMMAND_GET_POSITION)
+        data = ''.join([cmd + chr(id_) for id_ in ids])
+        expected = len(ids) * 2
+        with self._lock, self._conn.transaction():
+            self._conn.write(data)
+            response = self._conn.read(expected)
+            while len(response) < expected:
+                # replies arrive at bus speed, keep reading until the port times out
+                chunk = self._conn.read(expected - len(response))
+                if not chunk:
+                    break
+                response += chunk
+
+        positions = []
+        for i in range(0, len(ids)):
+            if i * 2 + 2 > len(response):
+                positions.append(-1)
+            else:
+                positions.append(((ord(response[i * 2 + 1]) << 8) + ord(response[i * 2])) / 4)
+        return positions
+
     def getMovingState(self):
         cmd = minimaestro.uscCommand.COMMAND_GET_MOVING_STATE
         data = chr(cmd)
-        with self._lock:
+        with self._lock, self._conn.transaction():
             self._conn.write(data)
             byte = self._conn.read()
         if len(byte) == 0:
@@ -169,7 +198,7 @@ class minimaestro(object):
     def getErrors(self):
         cmd = minimaestro.uscCommand.COMMAND_GET_ERRORS
         data = chr(cmd)
-        with self._lock:
+        with self._lock, self._conn.transaction():
             self._conn.write(data)
             lowByte = self._conn.read()
             highByte = self._conn.read()
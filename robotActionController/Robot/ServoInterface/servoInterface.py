@@ -1,9 +1,12 @@
 import logging
 import datetime
-import time
 from gevent.lock import RLock
 from gevent import spawn_later, sleep
 from robotActionController.connections import Connection
+from robotActionController.clock import monotonic
+from robotActionController.simulation import SnapshotStore
+from robotActionController.Data.configWatcher import ConfigWatcher
+from robotActionController.Data.configSnapshot import ConfigSnapshot
 
 __all__ = ['ServoInterface', ]
 
@@ -14,6 +17,7 @@ class ServoInterface(object):
     _globalLock = RLock()
     _interfaces = {}
     disconnected = False
+    configTables = ['Servo', 'ServoModel', 'ServoConfig', 'ServoGroup', 'Robot']
 
     """have to do it this way to get around circular referencing in the parser"""
     @staticmethod
@@ -31,6 +35,8 @@ class ServoInterface(object):
 
     @staticmethod
     def getServoInterface(servo):
+        # interfaces are built from the configuration snapshot, never from the session
+        servo = ConfigSnapshot.resolve(servo)
         with ServoInterface._globalLock:
             if servo.id not in ServoInterface._interfaces:
                 if not ServoInterface.disconnected:
@@ -48,6 +54,12 @@ class ServoInterface(object):
 
             return ServoInterface._interfaces[servo.id]
 
+    @staticmethod
+    def clearCache(changedTables=None):
+        """drop the cached interfaces, they are rebuilt from the current configuration on next use"""
+        with ServoInterface._globalLock:
+            ServoInterface._interfaces.clear()
+
     def __init__(self, servo):
         # servo type properties
         configs = filter(lambda c: c.model_id == servo.model_id, servo.robot.servoConfigs)
@@ -99,8 +111,65 @@ class ServoInterface(object):
     def getPosition(self):
         raise ValueError('Getting position not supported on servo %s' % self._servoId)
 
+    @staticmethod
+    def setPositions(moves, blocking=False):
+        """
+        Move several servos at once, servos sharing a controller that supports batched
+        commands are sent to the controller together
+        @param moves: list of (servoInterface, position, speed)
+        """
+        results = []
+        batches = {}
+        for move in moves:
+            key = move[0]._getBatchKey()
+            if key == None:
+                results.append(move[0].setPosition(move[1], move[2], blocking))
+            else:
+                batches.setdefault(key, []).append(move)
+
+        for batch in batches.itervalues():
+            results.extend(batch[0][0]._setPositionBatch(batch, blocking))
+
+        return all(results)
+
+    @staticmethod
+    def getPositions(servos):
+        """
+        Read the position of several servos, servos sharing a controller that supports batched
+        queries are read together.  Returns the positions in the same order as servos
+        """
+        positions = {}
+        batches = {}
+        for servo in servos:
+            key = servo._getBatchKey()
+            if key == None:
+                positions[servo] = servo.getPosition()
+            else:
+                batches.setdefault(key, []).append(servo)
+
+        for batch in batches.itervalues():
+            positions.update(zip(batch, batch[0]._getPositionBatch(batch)))
+
+        return [positions[s] for s in servos]
+
+    def _getBatchKey(self):
+        """servos returning the same (not None) key can be moved and read with a single command"""
+        return None
+
+    def _setPositionBatch(self, moves, blocking=False):
+        return [servo.setPosition(position, speed, blocking) for (servo, position, speed) in moves]
+
+    def _getPositionBatch(self, servos):
+        return [servo.getPosition() for servo in servos]
+
+    def _checkMinMaxValues(self):
+        pass
+
     def _isInPosition(self, position):
-        return abs(self._tolerance - self.getPosition()) >= self._tolerance
+        return self._comparePosition(position, self.getPosition())
+
+    def _comparePosition(self, position, currentPosition):
+        return abs(position - currentPosition) <= self._tolerance
 
     def _scaleToRealPos(self, value):
         try:
@@ -193,7 +262,7 @@ class AX12(ServoInterface):
 
         if blocking:
             while self.isMoving():
-                time.sleep(0.001)
+                sleep(0.001)
 
         try:
             return self._isInPosition(position)
@@ -279,7 +348,7 @@ class MINISSC(ServoInterface):
             self._moving = False
 
         if blocking:
-            time.sleep(1)
+            sleep(1)
 
         return True
 
@@ -351,7 +420,7 @@ class HerkuleX(ServoInterface):
             for step in steps:
                 with Connection.getLock(self._conn):
                     self._conn.moveOne(self._externalId, step[0], step[1])
-                time.sleep(max(0, step[1] - 30) / 1000)
+                sleep(max(0, step[1] - 30) / 1000.0)
         else:
             #Todo, if another setPosition happens while callback is running, cancel callback
             def callback(steps, currentStep):
@@ -410,45 +479,74 @@ class SSC32(ServoInterface):
         self._checkMinMaxValues()
 
     def getPosition(self):
-        send = "QP %s\r" % self._externalId
-        with Connection.getLock(self._conn):
-            self._conn.write(send)
-            lastChar = ""
-            response = ""
-            while lastChar != '\r':
-                lastChar = self._conn.read(1)
-                response += lastChar
-
-        response = response.strip(['\r', ])
-        p = int(response)
-        return self._realToScalePos(p * 10)
+        return self._getPositionBatch([self, ])[0]
 
     def setPosition(self, position=None, speed=None, blocking=False):
-        if position == None:
-            position = self._defaultPosition
-        if speed == None:
-            speed = self._defaultSpeed
+        return self._setPositionBatch([(self, position, speed), ], blocking)[0]
 
-        validTarget = self._getInRangeVal(position, self._minPos, self._maxPos)
-        if position != validTarget:
-            self._logger.warning("Target position has to be between %s and %s, got %s", self._minPos, self._maxPos, position)
-            # Force target to be within range
-            position = validTarget
+    def _getBatchKey(self):
+        return (SSC32, self._conn)
 
-        pos = self._scaleToRealPos(position)
-        spd = self._scaleToRealSpeed(speed)
+    def _getPositionBatch(self, servos):
+        """
+        Query the pulse width of all servos in one command: 'QP 0 QP 1 ...<cr>'
+        The controller answers with one byte per servo, the pulse width in tens of microseconds
+        """
+        send = "%s\r" % ' '.join(['QP %s' % s._externalId for s in servos])
+        with Connection.getLock(self._conn):
+            self._conn.write(send)
+            response = self._conn.read(len(servos))
 
-        send = "#%sP%s T%s\r" % (self._externalId, pos, spd)
+        if len(response) != len(servos):
+            self._logger.warning("Expected %s bytes in response to '%s', got %s", len(servos), send.strip(), len(response))
+
+        positions = []
+        for i, servo in enumerate(servos):
+            if i < len(response):
+                positions.append(servo._realToScalePos(ord(response[i]) * 10))
+            else:
+                positions.append(None)
+        return positions
+
+    def _setPositionBatch(self, moves, blocking=False):
+        """
+        All servos that share a move time are sent as a single command group: '#0P1500#1P1600T1000<cr>',
+        all groups are sent in one write
+        """
+        groups = {}
+        targets = []
+        for (servo, position, speed) in moves:
+            if position == None:
+                position = servo._defaultPosition
+            if speed == None:
+                speed = servo._defaultSpeed
+
+            validTarget = servo._getInRangeVal(position, servo._minPos, servo._maxPos)
+            if position != validTarget:
+                servo._logger.warning("Target position has to be between %s and %s, got %s", servo._minPos, servo._maxPos, position)
+                # Force target to be within range
+                position = validTarget
+
+            pos = int(round(servo._scaleToRealPos(position)))
+            spd = int(round(servo._scaleToRealSpeed(speed)))
+            groups.setdefault(spd, []).append("#%sP%s" % (servo._externalId, pos))
+            targets.append((servo, position))
+
+        send = ''.join(["%sT%s\r" % (''.join(commands), spd) for (spd, commands) in groups.iteritems()])
         self._logger.log(1, "Sending SSC32 String: %s", send)
         with Connection.getLock(self._conn):
-            self._moving = True
+            for (servo, _) in targets:
+                servo._moving = True
             self._conn.write(send)
-            self._moving = False
+            for (servo, _) in targets:
+                servo._moving = False
 
         if blocking:
-            time.sleep(1)
+            sleep(1)
 
-        return self._isInPosition(position)
+        servos = [servo for (servo, _) in targets]
+        currentPositions = self._getPositionBatch(servos)
+        return [current != None and servo._comparePosition(position, current) for ((servo, position), current) in zip(targets, currentPositions)]
 
 
 class HS82MG(ServoInterface):
@@ -518,70 +616,88 @@ class HS82MG(ServoInterface):
 
 
 class Dummy(ServoInterface):
+    """
+    Simulated servo, moves towards its target at the requested speed and keeps its state in memory
+    with periodic snapshots to disk
+    extraData options:
+        latency: seconds each command or query takes
+    """
+
+    snapshotInterval = 5
 
     def __init__(self, servo):
         super(Dummy, self).__init__(servo)
-        self._position = 0
-        self._posable = False
         self._logger = logging.getLogger(self.__class__.__name__)
+        extraData = servo.extraData or {}
+        self._latency = float(extraData.get('latency', 0))
+
         import os
         basePath = os.path.dirname(os.path.abspath(__file__))
-        basePath = os.path.join(basePath, 'servoData')
-        if not os.path.exists(basePath):
-            os.makedirs(basePath)
-        fileName = 'dummyServoData_%s' % self._servoId
-        self._fileName = os.path.join(basePath, fileName)
+        fileName = os.path.join(basePath, 'servoData', 'dummyServoData')
+        self._snapshot = SnapshotStore.getStore(fileName, Dummy.snapshotInterval)
+
+        data = self._snapshot.get(self._servoId, {})
+        self._posable = data.get('posable', False)
+        # motion profile: moving linearly from _startPos to _position between _startTime and _endTime
+        self._position = data.get('position', 0)
+        self._startPos = self._position
+        self._startTime = self._endTime = monotonic()
+
+    def _delay(self):
+        if self._latency:
+            sleep(self._latency)
+
+    def _save(self):
+        self._snapshot.set(self._servoId, {'position': self._position, 'posable': self._posable})
 
     def setPositioning(self, enablePositioning):
+        self._delay()
         self._posable = enablePositioning
         self._logger.log(1, "%s Set positioning to: %s", self._servoId, enablePositioning)
-        self._writeData()
+        self._save()
 
     def getPositioning(self):
-        self._readData()
+        self._delay()
         return self._posable
 
+    def isMoving(self):
+        return monotonic() < self._endTime
+
+    def _currentPosition(self):
+        now = monotonic()
+        if now >= self._endTime:
+            return self._position
+        progress = (now - self._startTime) / (self._endTime - self._startTime)
+        return self._startPos + (self._position - self._startPos) * progress
+
     def setPosition(self, position=None, speed=None, blocking=False):
         if position == None:
             position = self._defaultPosition
         if speed == None:
             speed = self._defaultSpeed
 
-        diff = abs(self._position - position)
-        secs = 1.0 / 1024 * diff
-        self._position = position
-        self._moving = True
+        self._delay()
+        current = self._currentPosition()
+        # a full 1024 step sweep takes one second at speed 100
+        duration = abs(current - position) / 1024.0 / (max(speed, 1) / 100.0)
         self._logger.log(1, "%s Seting position to: %s, speed: %s", self._servoId, position, speed)
-        time.sleep(secs / (speed / 100.0))
-        self._writeData()
-        self._logger.log(1, "%s Set position to: %s", self._servoId, position)
+        self._startPos = current
+        self._position = position
+        self._startTime = monotonic()
+        self._endTime = self._startTime + duration
+        self._save()
+
         if blocking:
-            time.sleep(0.5)
+            sleep(duration)
+            self._logger.log(1, "%s Set position to: %s", self._servoId, position)
 
-        self._moving = False
         return True
 
     def getPosition(self):
-        self._readData()
-        self._logger.log(1, "%s Got position: %s", self._servoId, self._position)
-        return self._position
-
-    def _readData(self):
-        import pickle
-        try:
-            data = pickle.load(self._fileName, 'r')
-            self._position = data['position']
-            self._posable = data['posable']
-        except:
-            pass
-
-    def _writeData(self):
-        import pickle
-        try:
-            data = {'position': self._position, 'posable': self._posable}
-            pickle.dump(data, self._fileName, 'w')
-        except:
-            pass
+        self._delay()
+        position = self._currentPosition()
+        self._logger.log(1, "%s Got position: %s", self._servoId, position)
+        return position
 
 
 class Virtual(ServoInterface):
@@ -590,8 +706,8 @@ class Virtual(ServoInterface):
         super(Virtual, self).__init__(servo)
         masterServoName = servo.extraData.get('MASTER', None)
         slaveServoName = servo.extraData.get('SLAVE', None)
-        masterServo = filter(lambda s: s.jointName == masterServoName, servo.robot.servos)
-        slaveServo = filter(lambda s: s.jointName == slaveServoName, servo.robot.servos)
+        masterServo = servo.robot.getServosByJointName(masterServoName)
+        slaveServo = servo.robot.getServosByJointName(slaveServoName)
         self._ratio = int(servo.extraData.get('RATIO', 1))
         self._absolute = servo.extraData.get('absolute', True)
         self._jointName = servo.jointName
@@ -679,3 +795,6 @@ class Robot(ServoInterface):
             def callback(result):
                 self._moving = False
             return self._robot.setComponentState(self._componentName, scaledPosition, blocking, callback) == 'ACTIVE'
+
+
+ConfigWatcher.register(ServoInterface.clearCache, ServoInterface.configTables)
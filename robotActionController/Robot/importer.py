@@ -1,6 +1,12 @@
 import os
-from xml.etree import ElementTree as et
+import pickle
+import hashlib
 import logging
+import threading
+from collections import namedtuple, OrderedDict, deque
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree as et
+from sqlalchemy import event
 
 from robotActionController.Data.Model import Robot, RobotModel, Servo, ServoGroup, ServoModel, \
     ServoConfig, RobotSensor, SensorModel, SensorConfig, DiscreteValueType, ContinuousValueType, PoseAction, SequenceAction, SequenceOrder, JointPosition, SensorTrigger, ButtonTrigger, ButtonHotkey
@@ -9,18 +15,26 @@ from robotActionController.Data.Model.sensor import DiscreteSensorValue
 logger = logging.getLogger('importer')
 
 
-def loadAllDirectories(rootDir, loadActions=True, loadTriggers=True, loadRobots=True):
-    loadedActions = {}
-    loadedTriggers = {}
-    loadedRobots = []
-
-    dirs = [os.path.join(rootDir, o) for o in os.listdir(rootDir) if os.path.isdir(os.path.join(rootDir, o))]
-    for subDir in dirs:
-        files = [os.path.join(subDir, o) for o in os.listdir(subDir) if os.path.isfile(os.path.join(subDir, o)) and o.endswith('.xml')]
-        for fileName in files:
-            loadDirectory(loadedActions, loadedTriggers, loadedRobots, subDir, fileName, loadActions, loadTriggers, loadRobots)
-
-    return (loadedRobots, loadedActions, loadedTriggers)
+def loadAllDirectories(rootDir, loadActions=True, loadTriggers=True, loadRobots=True, cacheFile=None, changedOnly=False, existingActions=None, workers=4, session=None):
+    """
+    Import the robots, actions and triggers of every subdirectory of rootDir
+    Every xml file in a subdirectory with a ROBOT root element is imported as a robot
+    @param cacheFile: file to keep the parsed files in between runs, unchanged files are not parsed again
+    @param changedOnly: only build objects for files that changed since the cache was written
+    @param existingActions: {name: Action} already imported, used to resolve references to unchanged actions
+    @param workers: number of threads used to read and parse the files
+    @param session: session the imported objects are committed with, the cache is only written once
+                    it commits.  Without a session the cache is written as soon as the import is built
+    """
+    dirs = sorted([os.path.join(rootDir, o) for o in os.listdir(rootDir) if os.path.isdir(os.path.join(rootDir, o))])
+    loader = DirectoryLoader(cacheFile, workers)
+    result = loader.load(dirs, robotConfig=None, loadActions=loadActions, loadTriggers=loadTriggers, loadRobots=loadRobots,
+                         changedOnly=changedOnly, existingActions=existingActions)
+    if session == None:
+        loader.saveCache()
+    else:
+        loader.saveCacheOnCommit(session)
+    return result
 
 
 def getConfigRoot(configFile):
@@ -39,94 +53,313 @@ def getConfigRoot(configFile):
 
 
 def loadDirectory(actions, triggers, robots, subDir, robotConfig='robot.xml', loadActions=True, loadTriggers=True, loadRobots=True):
+    """@param robotConfig: robot xml file name or Element, None imports every xml file with a ROBOT root"""
+    return DirectoryLoader().load([subDir], actions, triggers, robots, robotConfig, loadActions, loadTriggers, loadRobots)
 
-    if loadActions:
-        a = ActionImporter()
-        searchDir = os.path.join(subDir, 'pos')
-        if os.path.exists(searchDir):
-            files = [os.path.join(searchDir, o) for o in os.listdir(searchDir) if os.path.isfile(os.path.join(searchDir, o))]
-            for fileName in files:
-                fName = os.path.basename(fileName)
-                f = open(fileName)
-                lines = f.readlines()
-                name = lines[0].strip()
-                if name not in actions:
-                    pose = a.getPose(lines)
-                    if pose:
-                        actions[pose.name] = pose
-                    else:
-                        logger.info("Unable to load pose (%s)" % (fName))
-                else:
-                    logger.info("Skipping pose %s (%s), another by the same name already exists" % (pose.name, fName))
-
-        searchDir = os.path.join(subDir, 'seq')
-        recheck = []
-        if os.path.exists(searchDir):
-            files = [os.path.join(searchDir, o) for o in os.listdir(searchDir) if os.path.isfile(os.path.join(searchDir, o))]
-            for fileName in files:
-                fName = os.path.basename(fileName)
-                f = open(fileName)
-                lines = f.readlines()
-                name = lines[0].strip()
-                if name not in actions:
-                    seq = a.getSequence(lines, actions)
-                    if seq == None:
-                        recheck.append(lines)
-                        continue
-                    else:
-                        actions[seq.name] = seq
-                else:
-                    logger.info("Skipping sequence %s, another by the same name already exists" % seq.name)
-        progress = True
-        while recheck and progress:
-            progress = False
-            for lines in recheck:
-                seq = a.getSequence(lines, actions)
-                if seq == None:
+
+_CacheEntry = namedtuple('_CacheEntry', ['mtime', 'size', 'digest', 'parsed'])
+
+
+class ImportCache(object):
+    """
+    Parsed import files keyed by path
+    An entry is reused when the file mtime and size are unchanged, or else when the md5 of its contents matches
+    New fingerprints are only kept once accept() marks the file as imported, a file that failed to
+    build is parsed and built again on the next run
+    """
+
+    VERSION = 1
+
+    def __init__(self, fileName=None):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._fileName = fileName
+        self._lock = threading.Lock()
+        self._entries = self._load()
+        self._pending = {}
+        self._dirty = False
+
+    def _load(self):
+        if not self._fileName or not os.path.exists(self._fileName):
+            return {}
+        try:
+            with open(self._fileName, 'rb') as f:
+                (version, entries) = pickle.load(f)
+            if version == ImportCache.VERSION:
+                return entries
+        except Exception:
+            self._logger.warning("Unable to load import cache %s" % self._fileName, exc_info=True)
+        return {}
+
+    def save(self):
+        if not self._fileName or not self._dirty:
+            return
+        with self._lock:
+            entries = dict(self._entries)
+            self._dirty = False
+        try:
+            tempName = self._fileName + '.tmp'
+            with open(tempName, 'wb') as f:
+                pickle.dump((ImportCache.VERSION, entries), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tempName, self._fileName)
+        except Exception:
+            self._logger.warning("Unable to write import cache %s" % self._fileName, exc_info=True)
+
+    def read(self, path, parser):
+        """
+        returns (parsed, changed), parser is called with the lines of the file when it is not cached
+        """
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry and entry.mtime == stat.st_mtime and entry.size == stat.st_size:
+            return (entry.parsed, False)
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.md5(data).hexdigest()
+        changed = not entry or entry.digest != digest
+        if changed:
+            try:
+                parsed = parser(data.splitlines(True))
+            except Exception:
+                self._logger.error("Unable to parse %s" % path, exc_info=True)
+                parsed = None
+            with self._lock:
+                self._pending[path] = _CacheEntry(stat.st_mtime, stat.st_size, digest, parsed)
+        else:
+            # only the timestamp moved, the imported contents are still current
+            parsed = entry.parsed
+            with self._lock:
+                self._entries[path] = _CacheEntry(stat.st_mtime, stat.st_size, digest, parsed)
+                self._dirty = True
+        return (parsed, changed)
+
+    def changed(self, path):
+        """True when the file is new or its contents changed since it was last accepted"""
+        return self.read(path, lambda lines: None)[1]
+
+    def accept(self, path):
+        """keep the fingerprint read for path, call once the file has been imported"""
+        with self._lock:
+            entry = self._pending.pop(path, None)
+            if entry != None:
+                self._entries[path] = entry
+                self._dirty = True
+
+
+class DirectoryLoader(object):
+    """
+    Imports robot directories (pos/, seq/, keyMaps/ and the robot xml)
+    Files are read and parsed in a thread pool, sequences are built in dependency order
+    """
+
+    _ImportFile = namedtuple('_ImportFile', ['path', 'kind'])
+
+    def __init__(self, cacheFile=None, workers=4):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._cache = ImportCache(cacheFile)
+        self._workers = workers
+        self._actionImporter = ActionImporter()
+        self._parsers = {
+                         'pos': ActionImporter.parsePose,
+                         'seq': ActionImporter.parseSequence,
+                         'keyMaps': TriggerImporter.parseTriggers,
+                         }
+
+    def load(self, dirs, actions=None, triggers=None, robots=None, robotConfig='robot.xml',
+             loadActions=True, loadTriggers=True, loadRobots=True, changedOnly=False, existingActions=None):
+        """
+        @param robotConfig: robot xml file name or Element, None imports every xml file with a ROBOT root
+        The cache is not written here, call saveCache() once the imported objects are committed
+        """
+        actions = {} if actions == None else actions
+        triggers = {} if triggers == None else triggers
+        robots = [] if robots == None else robots
+
+        kinds = []
+        if loadActions:
+            kinds.extend(['pos', 'seq'])
+        if loadTriggers:
+            kinds.append('keyMaps')
+        parsed = self._parseAll(self._listFiles(dirs, kinds))
+
+        # references resolve to the actions imported now first, then to the ones that already exist
+        lookup = dict(existingActions or {})
+        lookup.update(actions)
+        if loadActions:
+            # names claimed by earlier files, including unchanged ones that are not rebuilt
+            seen = set(actions)
+            self._buildPoses(parsed['pos'], actions, lookup, seen, changedOnly)
+            self._buildSequences(parsed['seq'], actions, lookup, seen, changedOnly)
+        if loadTriggers:
+            self._buildTriggers(parsed['keyMaps'], triggers, lookup, changedOnly)
+        if loadRobots:
+            for subDir in dirs:
+                robots.extend(self._loadRobots(subDir, robotConfig, lookup, changedOnly))
+
+        return (robots, actions, triggers)
+
+    def saveCache(self):
+        self._cache.save()
+
+    def saveCacheOnCommit(self, session):
+        """write the cache when session commits, a rollback discards it"""
+        state = {'done': False}
+
+        def afterCommit(session):
+            if not state['done']:
+                state['done'] = True
+                self.saveCache()
+
+        def afterRollback(session):
+            state['done'] = True
+
+        event.listen(session, 'after_commit', afterCommit, once=True)
+        event.listen(session, 'after_rollback', afterRollback, once=True)
+
+    def _listFiles(self, dirs, kinds):
+        files = []
+        for subDir in dirs:
+            for kind in kinds:
+                searchDir = os.path.join(subDir, kind)
+                if os.path.isdir(searchDir):
+                    files.extend([DirectoryLoader._ImportFile(os.path.join(searchDir, o), kind)
+                                  for o in sorted(os.listdir(searchDir)) if os.path.isfile(os.path.join(searchDir, o))])
+        return files
+
+    def _parseOne(self, importFile):
+        (parsed, changed) = self._cache.read(importFile.path, self._parsers[importFile.kind])
+        return (importFile, parsed, changed)
+
+    def _parseAll(self, files):
+        """returns {kind: [(path, parsed, changed), ...]} in file order"""
+        if self._workers > 1 and len(files) > 1:
+            pool = ThreadPool(min(self._workers, len(files)))
+            try:
+                results = pool.map(self._parseOne, files)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(self._parseOne, files)
+
+        byKind = dict((kind, []) for kind in self._parsers)
+        for (importFile, parsed, changed) in results:
+            byKind[importFile.kind].append((importFile.path, parsed, changed))
+        return byKind
+
+    def _buildPoses(self, poses, actions, lookup, seen, changedOnly):
+        for (path, parsed, changed) in poses:
+            fName = os.path.basename(path)
+            if not parsed:
+                self._logger.info("Unable to load pose (%s)" % fName)
+            elif parsed[0] in seen:
+                self._logger.info("Skipping pose %s (%s), another by the same name already exists" % (parsed[0], fName))
+            else:
+                seen.add(parsed[0])
+                if changedOnly and not changed:
+                    continue
+                pose = self._actionImporter.buildPose(parsed)
+                actions[pose.name] = pose
+                lookup[pose.name] = pose
+                self._cache.accept(path)
+
+    def _buildSequences(self, sequences, actions, lookup, seen, changedOnly):
+        # sequences to build by name, the first file with a name wins
+        pending = OrderedDict()
+        for (path, parsed, changed) in sequences:
+            if not parsed:
+                self._logger.info("Unable to load sequence (%s)" % os.path.basename(path))
+            elif parsed[0] in seen:
+                self._logger.info("Skipping sequence %s, another by the same name already exists" % parsed[0])
+            else:
+                seen.add(parsed[0])
+                if changed or not changedOnly:
+                    pending[parsed[0]] = (path, parsed)
+
+        # Kahn's algorithm over the references between the pending sequences
+        dependents = dict((name, []) for name in pending)
+        waitingOn = {}
+        for (name, (_, parsed)) in pending.iteritems():
+            refs = set(ref for (ref, _) in parsed[1] if ref in pending)
+            waitingOn[name] = len(refs)
+            for ref in refs:
+                dependents[ref].append(name)
+
+        ready = deque(name for name in pending if waitingOn[name] == 0)
+        while ready:
+            name = ready.popleft()
+            (path, parsed) = pending.pop(name)
+            seq = self._actionImporter.buildSequence(parsed, lookup)
+            if seq != None:
+                actions[seq.name] = seq
+                lookup[seq.name] = seq
+                self._cache.accept(path)
+            for dependent in dependents[name]:
+                waitingOn[dependent] -= 1
+                if waitingOn[dependent] == 0:
+                    ready.append(dependent)
+
+        if pending:
+            self._logger.error("Unable to import sequences with circular references: %s" % ', '.join(pending))
+
+    def _buildTriggers(self, keyMaps, triggers, lookup, changedOnly):
+        triggerImporter = TriggerImporter()
+        for (path, lines, changed) in keyMaps:
+            if lines == None or (changedOnly and not changed):
+                continue
+            for trigger in triggerImporter.getTriggers(lines, lookup):
+                if trigger.name in triggers:
+                    self._logger.info("Trigger named %s already imported, skipping" % trigger.name)
                     continue
                 else:
-                    recheck.remove(lines)
-                    progress = True
-                if seq.name not in actions:
-                    actions[seq.name] = seq
+                    triggers[trigger.name] = trigger
+            self._cache.accept(path)
+
+    def _loadRobots(self, subDir, robotConfig, actions, changedOnly):
+        """returns the robots imported from subDir, see load() for robotConfig"""
+        if robotConfig != None and type(robotConfig) != str:
+            if type(robotConfig) != et.Element:
+                self._logger.error("Config not string or Element: %s" % type(robotConfig))
+                return []
+            if robotConfig.tag != 'ROBOT':
+                self._logger.error("Config not ROBOT type: %s" % robotConfig.tag)
+                return []
+            robot = RobotImporter().getRobot(robotConfig, actions)
+            return [robot] if robot else []
+
+        # parent configs live next to the robot configs, any changed xml means the robots changed
+        xmlFiles = [os.path.join(subDir, o) for o in sorted(os.listdir(subDir)) if o.endswith('.xml') and os.path.isfile(os.path.join(subDir, o))]
+        changed = [self._cache.changed(f) for f in xmlFiles]
+        if changedOnly and not any(changed):
+            return []
+
+        if robotConfig == None:
+            configFiles = xmlFiles
+        else:
+            configFile = os.path.join(subDir, robotConfig)
+            if not os.path.isfile(configFile):
+                self._logger.error("Config not found: %s" % configFile)
+                return []
+            configFiles = [configFile]
+
+        robots = []
+        for configFile in configFiles:
+            config = getConfigRoot(configFile)
+            if config.tag != 'ROBOT':
+                if robotConfig == None:
+                    # discovering every xml in the directory also finds the parent configs
+                    self._logger.debug("Skipping %s, not a ROBOT config: %s" % (configFile, config.tag))
                 else:
-                    logger.info("Skipping sequence %s, another by the same name already exists" % seq.name)
-        if recheck:
-            logger.error("Unable to import all sequences, missing reference actions", exc_info=True)
-
-    if loadTriggers:
-        t = TriggerImporter()
-        searchDir = os.path.join(subDir, 'keyMaps')
-        if os.path.exists(searchDir):
-            files = [os.path.join(searchDir, o) for o in os.listdir(searchDir) if os.path.isfile(os.path.join(searchDir, o))]
-            for fileName in files:
-                f = open(fileName)
-                lines = f.readlines()
-                for trigger in t.getTriggers(lines, actions.values(), triggers.keys()):
-                    if trigger.name in triggers:
-                        logger.info("Trigger named %s already imported, skipping" % trigger.name)
-                        continue
-                    else:
-                        triggers[trigger.name] = trigger
-    if loadRobots:
-        if type(robotConfig) == str:
-            robotConfig = os.path.join(subDir, robotConfig)
-            if not os.path.isfile(robotConfig):
-                print "Config not found: %s" % robotConfig
-                return None
-            robotConfig = getConfigRoot(robotConfig)
-        elif type(robotConfig) != et.Element:
-            print "Config not string or Element: %s" % type(robotConfig)
-            return None
-
-        if robotConfig.tag != 'ROBOT':
-            print "Config not ROBOT type: %s" % robotConfig.tag
-            return None
-
-        r = RobotImporter().getRobot(robotConfig, actions)
-        robots.append(r)
+                    self._logger.warning("Config not ROBOT type: %s" % config.tag)
+                continue
+            robot = RobotImporter().getRobot(config, actions)
+            if robot:
+                robots.append(robot)
 
-    return (robots, actions, triggers)
+        for f in xmlFiles:
+            self._cache.accept(f)
+        return robots
 
 
 class RobotImporter(object):
@@ -513,29 +746,49 @@ class ActionImporter(object):
         self._logger = logging.getLogger(self.__class__.__name__)
 
     def getSequence(self, sequenceLines, actions):
+        return self.buildSequence(ActionImporter.parseSequence(sequenceLines), actions)
+
+    @staticmethod
+    def parseSequence(sequenceLines):
         """
             Blink
             ActionName
             ActionName, forcedLength
             Eyes Shut
             Eyes Open
+            returns (name, [(actionName, forcedLength), ...])
         """
-        name = sequenceLines[0].strip()
-        seq = SequenceAction(name=name)
+        if not sequenceLines:
+            return None
 
-        for i in range(1, len(sequenceLines)):
-            parts = sequenceLines[i].strip().split(',', 1)
-            name = parts[0].strip()
+        steps = []
+        for line in sequenceLines[1:]:
+            if not line.strip():
+                continue
+            parts = line.strip().split(',', 1)
             length = parts[1].strip() if len(parts) > 1 else None
-            if name in actions:
-                seq.actions.append(SequenceOrder(actions[name], forcedLength=length))
+            steps.append((parts[0].strip(), length))
+
+        return (sequenceLines[0].strip(), steps)
+
+    def buildSequence(self, parsed, actions):
+        (name, steps) = parsed
+        seq = SequenceAction(name=name)
+
+        for (actionName, length) in steps:
+            if actionName in actions:
+                seq.actions.append(SequenceOrder(actions[actionName], forcedLength=length))
             else:
-                self._logger.error("Unable to find action named %s for sequence %s, skipping step" % (sequenceLines[i], name))
+                self._logger.error("Unable to find action named %s for sequence %s, skipping sequence" % (actionName, name))
                 return None
 
         return seq
 
     def getPose(self, poseLines):
+        return self.buildPose(ActionImporter.parsePose(poseLines))
+
+    @staticmethod
+    def parsePose(poseLines):
         """
             r_down
             JOINT_NAME, position, speed
@@ -556,11 +809,12 @@ class ActionImporter(object):
             MOUTH_OPEN,520,330
             MOUTH_SMILE,740,330
             EYELIDS,614,330
+            returns (name, [(jointName, position, positions, speed), ...])
         """
+        if not poseLines:
+            return None
 
-        name = poseLines[0].strip()
-        pose = PoseAction(name=name)
-
+        joints = []
         for line in poseLines[1:]:
             if not line.strip():
                 continue
@@ -578,7 +832,18 @@ class ActionImporter(object):
                 positions = None
                 position = float(pos.strip())
 
-            jp = JointPosition(jointName=jointName.upper())
+            joints.append((jointName.upper(), position, positions, speed))
+
+        return (poseLines[0].strip(), joints)
+
+    def buildPose(self, parsed):
+        if not parsed:
+            return None
+
+        (name, joints) = parsed
+        pose = PoseAction(name=name)
+        for (jointName, position, positions, speed) in joints:
+            jp = JointPosition(jointName=jointName)
             jp.position = position
             jp.positions = str(positions)
             jp.speed = speed
@@ -592,6 +857,10 @@ class TriggerImporter(object):
     def __init__(self):
         self._logger = logging.getLogger(self.__class__.__name__)
 
+    @staticmethod
+    def parseTriggers(triggerLines):
+        return [line for line in triggerLines if line.strip()]
+
     def getTriggers(self, triggerLines, actions):
         """
             Title:actionName,hotkey/sensor
@@ -616,19 +885,22 @@ class TriggerImporter(object):
             head_right,left_arm
         """
 
+        if not isinstance(actions, dict):
+            # the first action with a name wins
+            actions = dict((a.name, a) for a in reversed(list(actions)))
+
         triggers = []
         for line in triggerLines:
             vals = line.split(',')
             actionName = vals[0].strip()
             if actionName.count(':'):
-                (title, actionName) = actionName.split(',')
+                (title, actionName) = [v.strip() for v in actionName.split(':', 1)]
             else:
                 title = actionName
 
-            try:
-                action = filter(lambda x: x.name == actionName, actions)[0]
-            except:
-                self._logger.error("Action %s not found, skipping" % actionName, exc_info=True)
+            action = actions.get(actionName)
+            if action == None:
+                self._logger.error("Action %s not found, skipping" % actionName)
                 continue
 
             if len(vals) == 1:
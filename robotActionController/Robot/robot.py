@@ -1,21 +1,32 @@
 from collections import namedtuple
 from robotActionController.Robot.ServoInterface import ServoInterface
 from robotActionController.Processor.SensorInterface import SensorInterface
+from robotActionController.Data.configSnapshot import ConfigSnapshot
 
 
 class Robot(object):
-    Robot = namedtuple('Robot', ['name', 'id', 'servos', 'sensors'])
+    Robot = namedtuple('Robot', ['name', 'id', 'servos', 'sensors', 'servosByJoint', 'sensorsByName'])
     _robots = {}
+    _configs = {}
 
     @staticmethod
     def getRunableRobot(robot):
-        if robot.id not in Robot._robots:
+        # rebuilt whenever a reload swapped in a new configuration snapshot
+        robot = ConfigSnapshot.resolve(robot)
+        if robot.id not in Robot._robots or Robot._configs.get(robot.id) is not robot:
             interfaces = []
             sensors = []
+            servosByJoint = {}
+            sensorsByName = {}
             for servo in robot.servos:
-                interfaces.append(ServoInterface.getServoInterface(servo))
+                interface = ServoInterface.getServoInterface(servo)
+                interfaces.append(interface)
+                servosByJoint.setdefault(servo.jointName, []).append(interface)
             for sensor in robot.sensors:
-                sensors.append(SensorInterface.getSensorInterface(sensor))
+                interface = SensorInterface.getSensorInterface(sensor)
+                sensors.append(interface)
+                sensorsByName.setdefault(sensor.name, interface)
 
-            Robot._robots[robot.id] = Robot.Robot(robot.name, robot.id, interfaces, sensors)
+            Robot._robots[robot.id] = Robot.Robot(robot.name, robot.id, interfaces, sensors, servosByJoint, sensorsByName)
+            Robot._configs[robot.id] = robot
         return Robot._robots[robot.id]
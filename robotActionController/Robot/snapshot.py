@@ -0,0 +1,313 @@
+import struct
+import pickle
+import logging
+from sqlalchemy import select
+
+from robotActionController.Data.storage import StorageFactory
+from robotActionController.Data.Model import Base, SoundAction
+
+__all__ = ['Snapshot', ]
+
+
+"""
+Binary snapshot of the configuration tables
+
+Layout, all integers big endian:
+    header   '4s H I'  magic, format version, number of tables
+    table    name, 'H' number of columns, column names, 'I' number of rows, row values
+    value    one tag byte followed by the packed value, see _Codec
+
+Sound actions are stored with their uuid only, the audio itself stays in the sound file store
+"""
+
+
+class _Codec(object):
+
+    MAGIC = 'RACS'
+    VERSION = 2
+
+    _header = struct.Struct('>4sHI')
+    _count = struct.Struct('>I')
+    _short = struct.Struct('>H')
+    _int = struct.Struct('>q')
+    _float = struct.Struct('>d')
+
+    @staticmethod
+    def dumpHeader(out, tableCount):
+        out.append(_Codec._header.pack(_Codec.MAGIC, _Codec.VERSION, tableCount))
+
+    @staticmethod
+    def dumpValue(out, value):
+        if value is None:
+            out.append('N')
+        elif value is True:
+            out.append('T')
+        elif value is False:
+            out.append('F')
+        elif isinstance(value, (int, long)) and -2 ** 63 <= value < 2 ** 63:
+            out.append('i' + _Codec._int.pack(value))
+        elif isinstance(value, float):
+            out.append('d' + _Codec._float.pack(value))
+        elif isinstance(value, unicode):
+            data = value.encode('utf-8')
+            out.append('s' + _Codec._count.pack(len(data)) + data)
+        elif isinstance(value, str):
+            out.append('b' + _Codec._count.pack(len(value)) + value)
+        elif isinstance(value, (list, tuple)):
+            out.append(('t' if isinstance(value, tuple) else 'l') + _Codec._count.pack(len(value)))
+            for item in value:
+                _Codec.dumpValue(out, item)
+        elif isinstance(value, dict):
+            out.append('D' + _Codec._count.pack(len(value)))
+            for (key, item) in value.iteritems():
+                _Codec.dumpValue(out, key)
+                _Codec.dumpValue(out, item)
+        else:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            out.append('p' + _Codec._count.pack(len(data)) + data)
+
+    @staticmethod
+    def dumpName(out, name):
+        data = name.encode('utf-8')
+        out.append(_Codec._short.pack(len(data)) + data)
+
+    def __init__(self, data):
+        self._data = data
+        self._offset = 0
+
+    def _unpack(self, fmt):
+        value = fmt.unpack_from(self._data, self._offset)[0]
+        self._offset += fmt.size
+        return value
+
+    def _bytes(self, length):
+        value = self._data[self._offset:self._offset + length]
+        if len(value) != length:
+            raise ValueError("Truncated snapshot")
+        self._offset += length
+        return value
+
+    def readHeader(self):
+        if len(self._data) < _Codec._header.size:
+            raise ValueError("Not a snapshot file")
+        (magic, version, tableCount) = _Codec._header.unpack_from(self._data, 0)
+        if magic != _Codec.MAGIC:
+            raise ValueError("Not a snapshot file")
+        if version > _Codec.VERSION:
+            raise ValueError("Unsupported snapshot version %s, expected %s or lower" % (version, _Codec.VERSION))
+        self._offset = _Codec._header.size
+        return (version, tableCount)
+
+    def readName(self):
+        return self._bytes(self._unpack(_Codec._short)).decode('utf-8')
+
+    def readCount(self):
+        return self._unpack(_Codec._count)
+
+    def readShort(self):
+        return self._unpack(_Codec._short)
+
+    def readValue(self):
+        tag = self._bytes(1)
+        if tag == 'N':
+            return None
+        elif tag == 'T':
+            return True
+        elif tag == 'F':
+            return False
+        elif tag == 'i':
+            return self._unpack(_Codec._int)
+        elif tag == 'd':
+            return self._unpack(_Codec._float)
+        elif tag == 's':
+            return self._bytes(self.readCount()).decode('utf-8')
+        elif tag == 'b':
+            return self._bytes(self.readCount())
+        elif tag == 'l':
+            return [self.readValue() for _ in xrange(self.readCount())]
+        elif tag == 't':
+            return tuple([self.readValue() for _ in xrange(self.readCount())])
+        elif tag == 'D':
+            value = {}
+            for _ in xrange(self.readCount()):
+                key = self.readValue()
+                value[key] = self.readValue()
+            return value
+        elif tag == 'p':
+            return pickle.loads(self._bytes(self.readCount()))
+        else:
+            raise ValueError("Corrupt snapshot, unknown value tag %r at offset %s" % (tag, self._offset - 1))
+
+
+class Snapshot(object):
+    """
+    A versioned copy of the robot, action and trigger tables
+    Export once from a configured database, then restore it with importInto (bulk Core inserts)
+    or build the action runables straight from it with getRunables, without touching the ORM
+    """
+
+    def __init__(self, tables, version=_Codec.VERSION):
+        """
+        @param tables: list of (tableName, columnNames, rows) in dependency order, rows are tuples
+        """
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.version = version
+        self.tables = tables
+        self._rows = dict((name, (columns, rows)) for (name, columns, rows) in tables)
+
+    @staticmethod
+    def export(fileName, engine=None, tables=None):
+        """
+        Write all (or the named) tables to fileName
+        @param engine: engine to read from, defaults to the configured data store
+        @param tables: optional list of table names to include
+        """
+        snapshot = Snapshot.fromDatabase(engine, tables)
+        snapshot.save(fileName)
+        return snapshot
+
+    @staticmethod
+    def fromDatabase(engine=None, tables=None):
+        engine = engine or StorageFactory.getDefaultDataStore().engine
+        data = []
+        with engine.connect() as connection:
+            for table in Base.metadata.sorted_tables:
+                if tables != None and table.name not in tables:
+                    continue
+                columns = list(table.columns)
+                rows = [tuple(row[c] for c in columns) for row in connection.execute(select(columns))]
+                data.append((table.name, [c.key for c in columns], rows))
+
+        return Snapshot(data)
+
+    @staticmethod
+    def load(fileName):
+        with open(fileName, 'rb') as f:
+            codec = _Codec(f.read())
+
+        (version, tableCount) = codec.readHeader()
+        data = []
+        for _ in xrange(tableCount):
+            name = codec.readName()
+            columns = [codec.readName() for _ in xrange(codec.readShort())]
+            width = len(columns)
+            rows = []
+            for _ in xrange(codec.readCount()):
+                rows.append(tuple([codec.readValue() for _ in xrange(width)]))
+            data.append((name, columns, rows))
+
+        return Snapshot(data, version)
+
+    def save(self, fileName):
+        out = []
+        _Codec.dumpHeader(out, len(self.tables))
+        for (name, columns, rows) in self.tables:
+            _Codec.dumpName(out, name)
+            out.append(_Codec._short.pack(len(columns)))
+            for column in columns:
+                _Codec.dumpName(out, column)
+            out.append(_Codec._count.pack(len(rows)))
+            for row in rows:
+                for value in row:
+                    _Codec.dumpValue(out, value)
+
+        with open(fileName, 'wb') as f:
+            f.write(''.join(out))
+
+    def rows(self, tableName):
+        """returns the rows of a table as dictionaries"""
+        (columns, rows) = self._rows.get(tableName, ([], []))
+        return [dict(zip(columns, row)) for row in rows]
+
+    def importInto(self, engine=None, replace=True):
+        """
+        Bulk insert the snapshot with one executemany per table, in a single transaction
+        @param replace: delete the existing rows of the snapshot tables first
+        """
+        engine = engine or StorageFactory.getDefaultDataStore().engine
+        metadata = Base.metadata
+        missing = [name for (name, _, _) in self.tables if name not in metadata.tables]
+        if missing:
+            raise ValueError("Snapshot contains unknown tables: %s" % ', '.join(missing))
+
+        with engine.begin() as connection:
+            if replace:
+                for table in reversed(metadata.sorted_tables):
+                    if table.name in self._rows:
+                        connection.execute(table.delete())
+            for table in metadata.sorted_tables:
+                if table.name not in self._rows:
+                    continue
+                rows = self.rows(table.name)
+                if rows:
+                    connection.execute(table.insert(), rows)
+                    self._logger.debug("Imported %s rows into %s" % (len(rows), table.name))
+
+    def getRunables(self):
+        """
+        Build the action runables from the snapshot rows, equal to ActionManager.getRunable on the ORM objects
+        returns {actionId: runable}
+        """
+        from robotActionController.ActionRunner import ActionManager
+        runners = ActionManager._getRunners()
+
+        actions = dict((r['id'], r) for r in self.rows('Action'))
+        poses = dict((r['id'], r) for r in self.rows('PoseAction'))
+        sounds = dict((r['id'], r) for r in self.rows('SoundAction'))
+
+        jointPositions = {}
+        for r in sorted(self.rows('JointPosition'), key=lambda r: r['id']):
+            jointPositions.setdefault(r['pose_id'], []).append(r)
+
+        sequenceOrders = {}
+        for r in sorted(self.rows('SequenceOrder'), key=lambda r: (r['order'], r['id'])):
+            sequenceOrders.setdefault(r['sequence_id'], []).append(r)
+
+        groupMembers = {}
+        for r in self.rows('groupActions'):
+            groupMembers.setdefault(r['Group_id'], []).append(r['Action_id'])
+
+        runables = {}
+        building = set()
+
+        def build(actionId):
+            if actionId in runables:
+                return runables[actionId]
+            action = actions.get(actionId)
+            if action == None:
+                return None
+            if actionId in building:
+                raise ValueError("Circular action reference through %s" % action['name'])
+            building.add(actionId)
+
+            base = (action['name'], action['id'], action['type'])
+            runner = runners.get(action['type'])
+            if runner == None:
+                self._logger.error("Action: %s has an unknown action type: %s" % (action['name'], action['type']))
+                runable = None
+            elif action['type'] == 'PoseAction':
+                positions = [runner.JointPosition(p['jointName'], p['speed'], p['position'], p['positions'])
+                             for p in jointPositions.get(actionId, [])]
+                runable = runner.Runable(*(base + (poses[actionId]['speedModifier'], positions)))
+            elif action['type'] == 'SequenceAction':
+                ordered = [runner.OrderedAction(o['forcedLength'], o['order'], build(o['action_id']))
+                           for o in sequenceOrders.get(actionId, [])]
+                runable = runner.Runable(*(base + (ordered, )))
+            elif action['type'] == 'GroupAction':
+                members = [build(memberId) for memberId in groupMembers.get(actionId, [])]
+                runable = runner.Runable(*(base + (members, )))
+            elif action['type'] == 'SoundAction':
+                sound = sounds[actionId]
+                runable = runner.Runable(*(base + (SoundAction.readData(sound['uuid']), sound['uuid'], sound['volume'])))
+            else:
+                self._logger.error("Action: %s has no snapshot support for type: %s" % (action['name'], action['type']))
+                runable = None
+
+            building.discard(actionId)
+            runables[actionId] = runable
+            return runable
+
+        for actionId in actions:
+            build(actionId)
+
+        return dict((k, v) for (k, v) in runables.iteritems() if v != None)
@@ -0,0 +1,47 @@
+import time
+import ctypes
+import platform
+from datetime import timedelta
+
+__all__ = ['monotonic', 'seconds', ]
+
+
+def seconds(interval, default=0):
+    """intervals are accepted as timedeltas or seconds, None gives default"""
+    if interval == None:
+        return default
+    if isinstance(interval, timedelta):
+        return interval.total_seconds()
+    return float(interval)
+
+
+"""
+Python 2 has no monotonic clock in the standard library, wall clock time jumps
+whenever ntp or the user adjusts the clock which breaks loop timing and latency
+measurements.  Fall back to clock_gettime(CLOCK_MONOTONIC) on Linux.
+"""
+if hasattr(time, 'monotonic'):
+    monotonic = time.monotonic
+elif platform.system() == 'Linux':
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    _CLOCK_MONOTONIC = 1
+
+    try:
+        _clock_gettime = ctypes.CDLL('librt.so.1', use_errno=True).clock_gettime
+    except OSError:
+        _clock_gettime = ctypes.CDLL('libc.so.6', use_errno=True).clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+    def monotonic():
+        t = _timespec()
+        if _clock_gettime(_CLOCK_MONOTONIC, ctypes.pointer(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, 'clock_gettime failed')
+        return t.tv_sec + t.tv_nsec * 1e-9
+elif platform.system() == 'Windows':
+    # time.clock is based on QueryPerformanceCounter on windows
+    monotonic = time.clock
+else:
+    monotonic = time.time
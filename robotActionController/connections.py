@@ -1,77 +1,437 @@
 from gevent.lock import RLock
+from gevent import sleep, get_hub
+from collections import deque
+from contextlib import contextmanager
+from robotActionController.clock import monotonic
 import serial
 import logging
 import platform
 
-__all__ = ['Connection', ]
+__all__ = ['Connection', 'ManagedPort', 'PortStats', 'LoopbackTransport', ]
 
 
 if platform.system() == 'Linux':
     import fcntl
+    import errno
     class SerialLock(object):
+        """
+        Advisory lock on a serial port shared with other processes using the same device.
+        The flock is retried without blocking so other greenlets keep running while another
+        process holds the port.
+        """
+
+        retryInterval = 0.001
+        maxRetryInterval = 0.05
 
         def __init__(self, serial):
             self._serial = serial
             # file descriptor locks are not recursive, so keep a recursive lock
             # in order to make this class recursible
             self._rlock = RLock()
+            self._depth = 0
+            self._fd = None
+            self._stats = getattr(serial, 'stats', None)
 
         def __enter__(self):
-            pass
-            #if self._rlock._is_owned():
-            #    self._rlock.acquire()
-            #    return
-            #else:
-            #    self._rlock.acquire()
-            #    fcntl.flock(self._serial.fileno(), fcntl.LOCK_EX)
+            start = monotonic()
+            self._rlock.acquire()
+            if self._depth == 0:
+                try:
+                    self._fd = self._flock()
+                except:
+                    self._rlock.release()
+                    raise
+                if self._stats != None:
+                    self._stats.addLockWait(monotonic() - start)
+            self._depth += 1
+            return self
 
         def __exit__(self, type, value, tb):
-            pass
-            #self._rlock.release()
-            #if not self._rlock._is_owned():
-            #    fcntl.flock(self._serial.fileno(), fcntl.LOCK_UN)
+            self._depth -= 1
+            if self._depth == 0:
+                fd, self._fd = self._fd, None
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                except (IOError, OSError):
+                    # port was closed while the lock was held, closing the descriptor released the lock
+                    pass
+            self._rlock.release()
+
+        def _flock(self):
+            fd = self._serial.fileno()
+            interval = SerialLock.retryInterval
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except IOError as e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                # held by another process
+                sleep(interval)
+                interval = min(interval * 2, SerialLock.maxRetryInterval)
 else:
     SerialLock = lambda x: RLock()
 
 
+class PortStats(object):
+
+    def __init__(self, historySize=1000):
+        """
+        @param historySize: number of transaction latencies kept for the percentile calculations
+        """
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.transactions = 0
+        self.timeouts = 0
+        self.checksumErrors = 0
+        self.errors = 0
+        self.reconnects = 0
+        self._latencies = deque(maxlen=historySize)
+        self._lockWaits = deque(maxlen=historySize)
+
+    def addTransaction(self, latency):
+        self.transactions += 1
+        self._latencies.append(latency)
+
+    def addLockWait(self, wait):
+        self._lockWaits.append(wait)
+
+    def addChecksumError(self):
+        self.checksumErrors += 1
+
+    @staticmethod
+    def _percentile(values, percentile):
+        values = sorted(values)
+        if not values:
+            return None
+        index = int(round((len(values) - 1) * (percentile / 100.0)))
+        return values[max(0, min(len(values) - 1, index))]
+
+    def getLatencyPercentile(self, percentile):
+        """returns the latency (in seconds) of the given percentile (0-100) of the recent transactions"""
+        return PortStats._percentile(self._latencies, percentile)
+
+    def getLockWaitPercentile(self, percentile):
+        """returns the time (in seconds) taken to acquire the port lock for the given percentile (0-100)"""
+        return PortStats._percentile(self._lockWaits, percentile)
+
+    def snapshot(self):
+        return {
+                'bytesIn': self.bytesIn,
+                'bytesOut': self.bytesOut,
+                'transactions': self.transactions,
+                'timeouts': self.timeouts,
+                'checksumErrors': self.checksumErrors,
+                'errors': self.errors,
+                'reconnects': self.reconnects,
+                'latency': {
+                            'p50': self.getLatencyPercentile(50),
+                            'p90': self.getLatencyPercentile(90),
+                            'p99': self.getLatencyPercentile(99),
+                            'max': self.getLatencyPercentile(100),
+                            },
+                'lockWait': {
+                            'p50': self.getLockWaitPercentile(50),
+                            'p99': self.getLockWaitPercentile(99),
+                            'max': self.getLockWaitPercentile(100),
+                            },
+                }
+
+
+class LoopbackTransport(object):
+    """
+    In-process stand in for a serial port, used for benchmarks and testing without hardware.
+    Everything written is passed to responder (echoed back by default) and the result is made
+    available for reading.  For a pty stand in, open the slave device path as a normal port.
+    """
+
+    def __init__(self, port, baudrate=None, timeout=None, responder=None, **kwargs):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self._responder = responder or (lambda data: data)
+        self._buffer = bytearray()
+        self._open = True
+
+    def isOpen(self):
+        return self._open
+
+    def open(self):
+        self._open = True
+
+    def close(self):
+        self._open = False
+
+    def _checkOpen(self):
+        if not self._open:
+            raise serial.SerialException("Loopback port %s is closed" % self.port)
+
+    def write(self, data):
+        self._checkOpen()
+        response = self._responder(data)
+        if response:
+            self._buffer.extend(response)
+        return len(data)
+
+    def read(self, size=1):
+        self._checkOpen()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def inWaiting(self):
+        return len(self._buffer)
+
+    def flushInput(self):
+        del self._buffer[:]
+
+    def flushOutput(self):
+        pass
+
+
+class ManagedPort(object):
+    """
+    Serial-like wrapper around a transport.  Tracks the open/closed state of the underlying
+    port, re-opens it with an exponential backoff after an I/O failure (i.e. USB re-enumeration)
+    and records per-port statistics.
+    """
+
+    minBackoff = 0.1
+    maxBackoff = 10.0
+
+    def __init__(self, name, opener, isDevice=True, offload=None):
+        """
+        @param name: port name, used for logging
+        @param opener: callable returning a newly opened serial-like transport
+        @param isDevice: True if the transport is backed by a file descriptor
+        @param offload: run blocking reads and writes in the gevent threadpool, defaults to isDevice
+        """
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._name = name
+        self._opener = opener
+        self._isDevice = isDevice
+        self._offload = isDevice if offload == None else offload
+        self._timeout = None
+        self._backoff = ManagedPort.minBackoff
+        self._nextAttempt = 0
+        self.stats = PortStats()
+        self._port = opener()
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def isDevice(self):
+        return self._isDevice
+
+    @property
+    def timeout(self):
+        if self._timeout == None and self._port != None:
+            return self._port.timeout
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self._timeout = value
+        if self._port != None:
+            self._port.timeout = value
+
+    def isOpen(self):
+        try:
+            return self._port != None and self._port.isOpen()
+        except Exception:
+            return False
+
+    def close(self):
+        port, self._port = self._port, None
+        if port != None:
+            try:
+                port.close()
+            except Exception:
+                self._logger.debug("Error closing port %s", self._name, exc_info=True)
+
+    def reopen(self):
+        self.close()
+        self._nextAttempt = 0
+        self._ensureOpen()
+
+    def _ensureOpen(self):
+        if self.isOpen():
+            return self._port
+
+        now = monotonic()
+        if now < self._nextAttempt:
+            raise serial.SerialException("Port %s is closed, next reconnect attempt in %.2fs" % (self._name, self._nextAttempt - now))
+
+        self.close()
+        try:
+            port = self._opener()
+            if self._timeout != None:
+                port.timeout = self._timeout
+        except Exception:
+            self._nextAttempt = now + self._backoff
+            self._backoff = min(self._backoff * 2, ManagedPort.maxBackoff)
+            self._logger.warning("Unable to reopen port %s, retrying in %ss", self._name, self._nextAttempt - now)
+            raise
+
+        self._logger.info("Reopened port %s", self._name)
+        self._backoff = ManagedPort.minBackoff
+        self.stats.reconnects += 1
+        self._port = port
+        return port
+
+    def _fail(self, error):
+        self.stats.errors += 1
+        self._logger.warning("I/O error on port %s, closing connection: %s", self._name, error)
+        self.close()
+
+    def _call(self, func, *args):
+        try:
+            return func(*args)
+        except (serial.SerialException, OSError, IOError) as e:
+            self._fail(e)
+            raise
+
+    def _blockingCall(self, func, *args):
+        """
+        pyserial blocks the calling thread until the device responds or the timeout expires,
+        run the call in the threadpool so only the calling greenlet waits, not the whole hub
+        """
+        if self._offload:
+            return self._call(get_hub().threadpool.apply, func, args)
+        return self._call(func, *args)
+
+    def read(self, size=1):
+        port = self._ensureOpen()
+        if size <= 0:
+            return ''
+        if port.timeout == 0:
+            data = self._call(port.read, size)
+        else:
+            data = self._blockingCall(port.read, size)
+        self.stats.bytesIn += len(data)
+        if len(data) < size:
+            self.stats.timeouts += 1
+        return data
+
+    def write(self, data):
+        port = self._ensureOpen()
+        written = self._blockingCall(port.write, data)
+        self.stats.bytesOut += len(data)
+        return written
+
+    def inWaiting(self):
+        return self._call(self._ensureOpen().inWaiting)
+
+    def flushInput(self):
+        return self._call(self._ensureOpen().flushInput)
+
+    def flushOutput(self):
+        # waits for the output buffer to drain
+        return self._blockingCall(self._ensureOpen().flushOutput)
+
+    def fileno(self):
+        return self._ensureOpen().fileno()
+
+    @contextmanager
+    def transaction(self):
+        """Times a request/response exchange on this port"""
+        start = monotonic()
+        yield self
+        self.stats.addTransaction(monotonic() - start)
+
+    def __getattr__(self, name):
+        # Anything not explicitly managed is passed through to the transport
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._ensureOpen(), name)
+
+    def __repr__(self):
+        return "%s('%s', open: %s)" % (self.__class__.__name__, self._name, self.isOpen())
+
+
 class Connection(object):
 
     _globalLock = RLock()
     _connections = {}
     _locks = {}
+    _transports = {
+                   'loopback': LoopbackTransport,
+                   }
+
+    @staticmethod
+    def registerTransport(scheme, factory):
+        """
+        Register a transport for ports named '<scheme>://<name>'
+        @param factory: callable(port, baudrate, **kwargs) returning a serial-like object
+        """
+        with Connection._globalLock:
+            Connection._transports[scheme] = factory
+
+    @staticmethod
+    def _getOpener(port, speed, kwargs):
+        if '://' in port:
+            scheme = port[:port.index('://')]
+            if scheme in Connection._transports:
+                factory = Connection._transports[scheme]
+                return (lambda: factory(port, baudrate=speed, **kwargs), False)
+            # pyserial has its own set of url handlers (loop://, socket://, rfc2217://, ...)
+            return (lambda: serial.serial_for_url(port, baudrate=speed, **kwargs), False)
+
+        return (lambda: serial.Serial(port=port, baudrate=speed, **kwargs), True)
 
     @staticmethod
     def getLock(connection):
-        if connection not in Connection._locks:
-            if type(connection) == serial.Serial:
-                Connection._locks[connection] = SerialLock(connection)
-            else:
-                Connection._locks[connection] = RLock()
+        with Connection._globalLock:
+            if connection not in Connection._locks:
+                if isinstance(connection, ManagedPort) and connection.isDevice:
+                    Connection._locks[connection] = SerialLock(connection)
+                else:
+                    Connection._locks[connection] = RLock()
 
-        return Connection._locks[connection]
+            return Connection._locks[connection]
+
+    @staticmethod
+    def getStats():
+        """returns a dictionary of {portName: statistics} for all open ports"""
+        with Connection._globalLock:
+            ports = [c for c in Connection._connections.itervalues() if isinstance(c, ManagedPort)]
+        return dict([(p.name, p.stats.snapshot()) for p in ports])
 
     @staticmethod
     def getConnection(connectionType, port, speed, **kwargs):
         log = logging.getLogger(__name__)
         with Connection._globalLock:
-            key = "%s:%s" % (connectionType, port)
-            # TODO: Check for closed connections
+            if connectionType in ('AX12', 'HERKULEX', 'minimaestro'):
+                key = "%s:%s" % (connectionType, port)
+            else:
+                # raw ports are shared by all users of the device, regardless of the type requested
+                key = port
+
             if key not in Connection._connections:
-                logging.info('Creating connection: %s (%s)' % (connectionType, port))
+                log.info('Creating connection: %s (%s)' % (connectionType, port))
                 if connectionType == "AX12":
-                    from Robot.ServoInterface.dynamixel import ServoController as AX12Controller
+                    from robotActionController.Robot.ServoInterface.dynamixel import ServoController as AX12Controller
                     Connection._connections[key] = AX12Controller(port, speed, **kwargs)
                 elif connectionType == "HERKULEX":
-                    from Robot.ServoInterface.herkulex import HerkuleX
+                    from robotActionController.Robot.ServoInterface.herkulex import HerkuleX
                     Connection._connections[key] = HerkuleX(port, speed, **kwargs)
                 elif connectionType == "minimaestro":
-                    from Robot.ServoInterface.minimaestro import minimaestro
+                    from robotActionController.Robot.ServoInterface.minimaestro import minimaestro
                     Connection._connections[key] = minimaestro(port, speed, **kwargs)
                 else:
+                    kwargs.setdefault('timeout', 5)
+                    opener, isDevice = Connection._getOpener(port, speed, kwargs)
+                    Connection._connections[key] = ManagedPort(port, opener, isDevice)
+            else:
+                conn = Connection._connections[key]
+                if isinstance(conn, ManagedPort) and not conn.isOpen():
+                    log.info('Connection %s (%s) is closed, attempting to reopen' % (connectionType, port))
                     try:
-                        kwargs.setdefault('timeout', 5)
-                        Connection._connections[key] = serial.Serial(port=port, baudrate=speed, **kwargs)
-                    except serial.serialutil.SerialException as e:
-                        raise e
+                        conn.reopen()
+                    except Exception:
+                        log.warning('Unable to reopen connection %s (%s)' % (connectionType, port), exc_info=True)
 
             return Connection._connections[key]
@@ -0,0 +1,83 @@
+import os
+import atexit
+import pickle
+import logging
+from gevent import spawn, sleep
+from gevent.lock import RLock
+
+__all__ = ['SnapshotStore', ]
+
+
+class SnapshotStore(object):
+    """
+    In-memory key/value store for the simulated (dummy) backends
+    Values are loaded from the snapshot file once and written back periodically when changed,
+    reads and writes never touch the disk
+    """
+
+    _stores = {}
+    _storesLock = RLock()
+
+    @staticmethod
+    def getStore(fileName, interval=5):
+        """returns the shared store for fileName, an interval of None disables persistence"""
+        with SnapshotStore._storesLock:
+            if fileName not in SnapshotStore._stores:
+                SnapshotStore._stores[fileName] = SnapshotStore(fileName, interval)
+            return SnapshotStore._stores[fileName]
+
+    def __init__(self, fileName, interval=5):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._fileName = fileName
+        self._interval = interval
+        self._lock = RLock()
+        self._dirty = False
+        self._data = self._load()
+        self._writer = None
+        if interval:
+            atexit.register(self.flush)
+
+    def _load(self):
+        if not os.path.exists(self._fileName):
+            return {}
+        try:
+            with open(self._fileName, 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            self._logger.warning("Unable to load snapshot %s" % self._fileName, exc_info=True)
+            return {}
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._data.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._dirty = True
+            if self._interval and self._writer == None:
+                self._writer = spawn(self._persist)
+
+    def _persist(self):
+        while True:
+            sleep(self._interval)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            data = dict(self._data)
+            self._dirty = False
+
+        try:
+            path = os.path.dirname(self._fileName)
+            if path and not os.path.exists(path):
+                os.makedirs(path)
+            # write to a temporary file first so a crash never leaves a half written snapshot
+            tempName = self._fileName + '.tmp'
+            with open(tempName, 'wb') as f:
+                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tempName, self._fileName)
+        except Exception:
+            self._logger.warning("Unable to write snapshot %s" % self._fileName, exc_info=True)
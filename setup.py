@@ -7,6 +7,7 @@ requires = [
           'pyserial',
           'pyaudio>=0.2.8',
           'sqlalchemy==0.9.8',
+          'numpy',
       ]
 
 depend_links = [